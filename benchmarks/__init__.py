@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for the WhatsApp webhook path. Run with `python -m benchmarks.run`.
+"""
@@ -0,0 +1,386 @@
+"""
+In-process stand-ins for the AWS clients used by both Lambdas.
+
+FakeTable understands the subset of DynamoDB expressions this repo uses (SET/REMOVE with
+if_not_exists, list_append and +/-, comparisons, attribute_(not_)exists, AND/OR/NOT, and
+boto3 Key conditions for queries). It is meant for benchmarks and local runs, not as a
+general DynamoDB emulator.
+"""
+import copy
+import io
+import json
+import re
+import threading
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+_TOKEN_RE = re.compile(r'\s*(<=|>=|<>|[=<>(),+\-]|:\w+|#?\w+(?:\[\d+\])*)')
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ValueError('Cannot parse expression at: {}'.format(expression[pos:]))
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def _conditional_check_failed(operation):
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                  'Message': 'The conditional request failed'}}, operation)
+
+
+def _number(value):
+    return Decimal(str(value)) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+
+
+class _Evaluator:
+    """
+    Evaluates update and condition expressions against a single item.
+    """
+    def __init__(self, item, names, values):
+        self.item = item
+        self.names = names or {}
+        self.values = {k: _number(v) for k, v in (values or {}).items()}
+        self.tokens = []
+        self.pos = 0
+
+    # -- token helpers
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _expect(self, token):
+        actual = self._next()
+        if actual != token:
+            raise ValueError('Expected {} but got {}'.format(token, actual))
+
+    # -- paths
+    def _split_path(self, path):
+        match = re.match(r'^(#?\w+)((?:\[\d+\])*)$', path)
+        name = self.names.get(match.group(1), match.group(1))
+        indexes = [int(i) for i in re.findall(r'\[(\d+)\]', match.group(2))]
+        return name, indexes
+
+    def _get(self, path):
+        name, indexes = self._split_path(path)
+        value = self.item.get(name)
+        for i in indexes:
+            if not isinstance(value, list) or i >= len(value):
+                return None
+            value = value[i]
+        return value
+
+    # -- operands
+    def _operand(self):
+        token = self._next()
+        if token.startswith(':'):
+            return copy.deepcopy(self.values[token])
+        if token in ('if_not_exists', 'list_append', 'size'):
+            self._expect('(')
+            if token == 'if_not_exists':
+                path = self._next()
+                self._expect(',')
+                default = self._operand()
+                self._expect(')')
+                value = self._get(path)
+                return default if value is None else value
+            if token == 'size':
+                value = self._get(self._next())
+                self._expect(')')
+                return len(value) if value is not None else 0
+            first = self._operand()
+            self._expect(',')
+            second = self._operand()
+            self._expect(')')
+            return list(first) + list(second)
+        return self._get(token)
+
+    def _value(self):
+        value = self._operand()
+        while self._peek() in ('+', '-'):
+            op = self._next()
+            other = self._operand()
+            value = value + other if op == '+' else value - other
+        return value
+
+    # -- update expressions
+    def apply_update(self, expression):
+        self.tokens, self.pos = _tokenize(expression), 0
+        removals = []
+        while self._peek() is not None:
+            clause = self._next().upper()
+            while True:
+                if clause == 'SET':
+                    path = self._next()
+                    self._expect('=')
+                    name, indexes = self._split_path(path)
+                    value = self._value()
+                    if indexes:
+                        self._get(name)[indexes[0]] = value
+                    else:
+                        self.item[name] = value
+                elif clause == 'REMOVE':
+                    removals.append(self._split_path(self._next()))
+                elif clause == 'ADD':
+                    path = self._next()
+                    name, _ = self._split_path(path)
+                    self.item[name] = (self.item.get(name) or 0) + self._operand()
+                else:
+                    raise ValueError('Unsupported clause: {}'.format(clause))
+                if self._peek() != ',':
+                    break
+                self._next()
+        # List elements are removed from the end so earlier indexes stay valid
+        for name, indexes in sorted(removals, key=lambda r: r[1], reverse=True):
+            if indexes:
+                if isinstance(self.item.get(name), list) and indexes[0] < len(self.item[name]):
+                    del self.item[name][indexes[0]]
+            else:
+                self.item.pop(name, None)
+
+    # -- condition expressions
+    def check(self, expression):
+        self.tokens, self.pos = _tokenize(expression), 0
+        return self._or()
+
+    def _or(self):
+        result = self._and()
+        while self._peek() and self._peek().upper() == 'OR':
+            self._next()
+            result = self._and() or result
+        return result
+
+    def _and(self):
+        result = self._not()
+        while self._peek() and self._peek().upper() == 'AND':
+            self._next()
+            result = self._not() and result
+        return result
+
+    def _not(self):
+        if self._peek() and self._peek().upper() == 'NOT':
+            self._next()
+            return not self._not()
+        return self._primary()
+
+    def _primary(self):
+        token = self._peek()
+        if token == '(':
+            self._next()
+            result = self._or()
+            self._expect(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self._next()
+            self._expect('(')
+            exists = self._get(self._next()) is not None
+            self._expect(')')
+            return exists if token == 'attribute_exists' else not exists
+        left = self._value()
+        op = self._next()
+        right = self._value()
+        if left is None or right is None:
+            return op == '<>' and left != right
+        return {'=': left == right, '<>': left != right, '<': left < right, '<=': left <= right,
+                '>': left > right, '>=': left >= right}[op]
+
+
+def _key_condition_matches(condition, item):
+    # boto3 Key conditions: And / Equals / Between / comparisons / BeginsWith
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(_key_condition_matches(v, item) for v in values)
+    actual = item.get(values[0].name)
+    if actual is None:
+        return False
+    if operator == '=':
+        return actual == values[1]
+    if operator == 'BETWEEN':
+        return values[1] <= actual <= values[2]
+    if operator == 'begins_with':
+        return actual.startswith(values[1])
+    return {'<': actual < values[1], '<=': actual <= values[1],
+            '>': actual > values[1], '>=': actual >= values[1]}[operator]
+
+
+class FakeTable:
+    """
+    A dict-backed DynamoDB table keyed by (partition key, optional sort key).
+    """
+    def __init__(self, name, hash_key, range_key=None):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.items = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return (key[self.hash_key], key.get(self.range_key)) if self.range_key else (key[self.hash_key],)
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _check(self, item, kwargs, operation):
+        expression = kwargs.get('ConditionExpression')
+        if expression and not _Evaluator(item or {}, kwargs.get('ExpressionAttributeNames'),
+                                         kwargs.get('ExpressionAttributeValues')).check(expression):
+            raise _conditional_check_failed(operation)
+
+    @staticmethod
+    def _project(item, projection):
+        if not projection:
+            return copy.deepcopy(item)
+        fields = [f.strip() for f in projection.split(',')]
+        return {f: copy.deepcopy(item[f]) for f in fields if f in item}
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, ExpressionAttributeNames=None):
+        with self._lock:
+            self._count('get_item')
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            projection = ProjectionExpression
+            if projection and ExpressionAttributeNames:
+                for alias, name in ExpressionAttributeNames.items():
+                    projection = projection.replace(alias, name)
+            return {'Item': self._project(item, projection)}
+
+    def put_item(self, Item, **kwargs):
+        with self._lock:
+            self._count('put_item')
+            key = self._key(Item)
+            self._check(self.items.get(key), kwargs, 'PutItem')
+            self.items[key] = {k: _number(v) for k, v in copy.deepcopy(Item).items()}
+            return {}
+
+    def update_item(self, Key, UpdateExpression, ReturnValues='NONE', **kwargs):
+        with self._lock:
+            self._count('update_item')
+            key = self._key(Key)
+            current = self.items.get(key)
+            self._check(current, kwargs, 'UpdateItem')
+            item = copy.deepcopy(current) if current else dict(Key)
+            _Evaluator(item, kwargs.get('ExpressionAttributeNames'),
+                       kwargs.get('ExpressionAttributeValues')).apply_update(UpdateExpression)
+            self.items[key] = item
+            if ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+                return {'Attributes': copy.deepcopy(item)}
+            if ReturnValues in ('ALL_OLD', 'UPDATED_OLD') and current:
+                return {'Attributes': copy.deepcopy(current)}
+            return {}
+
+    def delete_item(self, Key, **kwargs):
+        with self._lock:
+            self._count('delete_item')
+            key = self._key(Key)
+            self._check(self.items.get(key), kwargs, 'DeleteItem')
+            self.items.pop(key, None)
+            return {}
+
+    def query(self, KeyConditionExpression, ProjectionExpression=None, Limit=None, ScanIndexForward=True,
+              ExclusiveStartKey=None, **kwargs):
+        with self._lock:
+            self._count('query')
+            matches = sorted((item for item in self.items.values() if _key_condition_matches(KeyConditionExpression, item)),
+                             key=lambda item: item.get(self.range_key), reverse=not ScanIndexForward)
+            if ExclusiveStartKey:
+                start = ExclusiveStartKey.get(self.range_key)
+                matches = [m for m in matches if (m[self.range_key] > start) == ScanIndexForward and m[self.range_key] != start]
+            response = {'Items': [self._project(m, ProjectionExpression) for m in matches[:Limit]]}
+            if Limit is not None and len(matches) > Limit:
+                last = matches[Limit - 1]
+                response['LastEvaluatedKey'] = {self.hash_key: last[self.hash_key], self.range_key: last[self.range_key]}
+            return response
+
+
+class FakeDynamoResource:
+    """
+    Stand-in for `boto3.resource('dynamodb')`. Tables are created on first access with the
+    key schema registered in `schemas`.
+    """
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self.tables = {}
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name, *self.schemas[name])
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            items = [table.get_item(Key=key, ProjectionExpression=request.get('ProjectionExpression')).get('Item')
+                     for key in request['Keys']]
+            responses[name] = [item for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeLambdaClient:
+    """
+    Stand-in for the Lambda client: `invoke` runs the registered handler in process,
+    including the JSON round trip of a real invoke.
+    """
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.invocations = 0
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload='{}'):
+        self.invocations += 1
+        result = self.handlers[FunctionName](json.loads(Payload), None)
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(result).encode('utf-8'))}
+
+
+class FakeSqsClient:
+    """
+    Stand-in for the SQS client that keeps sent messages in per-queue lists.
+    """
+    def __init__(self):
+        self.queues = {}
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self._lock:
+            messages = self.queues.setdefault(QueueUrl, [])
+            message_id = '{}-{}'.format(len(messages), id(self))
+            messages.append({'messageId': message_id, 'body': MessageBody, 'attributes': kwargs})
+            return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        for entry in Entries:
+            response = self.send_message(QueueUrl, entry['MessageBody'],
+                                         **{k: v for k, v in entry.items() if k not in ('Id', 'MessageBody')})
+            successful.append({'Id': entry['Id'], 'MessageId': response['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def drain(self, queue_url):
+        """
+        Removes and returns the queued messages as SQS event records.
+        """
+        with self._lock:
+            return self.queues.pop(queue_url, [])
+
+
+class FakeSsmClient:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.calls = 0
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.calls += 1
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
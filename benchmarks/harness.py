@@ -0,0 +1,146 @@
+"""
+Wires whatsapp_receiver and musafir-interface to the local stand-ins in `fakes` and
+`servers`, so both handlers can run end to end without AWS or Meta.
+"""
+import json
+import os
+import sys
+import time
+
+from benchmarks.fakes import FakeDynamoResource, FakeLambdaClient, FakeSqsClient, FakeSsmClient
+from benchmarks.servers import GraphApiServer, SmartChatServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECEIVER_PATH = os.path.join(ROOT, 'whatsapp_receiver')
+MUSAFIR_PATH = os.path.join(ROOT, 'musafir-interface')
+
+# Key schemas of the DynamoDB tables used by the receiver
+TABLE_SCHEMAS = {
+    'conversation': ('mobile', 'cr_date'),
+    'webhook_messages': ('message_id', None),
+    'chat_tokens': ('mobile', None),
+    'pending_turns': ('mobile', None),
+    'media_cache': ('media_key', None),
+}
+
+
+class LocalEnvironment:
+    """
+    Starts the stub servers, imports both Lambdas and points every AWS client at a fake.
+
+    Parameters:
+    - smart_chat_latency_ms: Added latency of each smart-chat call
+    - graph_latency_ms: Added latency of each Graph API call
+    - transport: 'lambda' (fake invoke with JSON round trip) or 'inprocess'
+    - store: Conversation store, 'dynamodb' (the fake table) or 'sqlite' (in memory)
+    """
+    def __init__(self, smart_chat_latency_ms=0, graph_latency_ms=0, transport='lambda', store='dynamodb'):
+        self.smart_chat = SmartChatServer(smart_chat_latency_ms).start()
+        self.graph = GraphApiServer(graph_latency_ms).start()
+
+        # Read by the modules at import time
+        os.environ['SMART_CHAT_URL'] = self.smart_chat.url
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-south-1')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        os.environ.setdefault('METRICS_ENABLED', 'false')
+        # Scenarios measure processing latency, so the outbound rate governor is opened wide;
+        # set these lower to study throttling
+        os.environ.setdefault('GRAPH_NUMBER_RATE', '100000')
+        os.environ.setdefault('GRAPH_NUMBER_BURST', '100000')
+        os.environ.setdefault('GRAPH_RECIPIENT_RATE', '100000')
+        os.environ.setdefault('GRAPH_RECIPIENT_BURST', '100000')
+        # Off by default; next_day_user measures the token carry-over
+        os.environ.setdefault('TOKEN_STORE_ENABLED', 'true')
+        os.environ.update({'version': 'v19.0', 'phone_number_id': '1000', 'token': 'graph-token'})
+
+        if RECEIVER_PATH not in sys.path:
+            sys.path.insert(0, RECEIVER_PATH)
+        import aws_clients
+        import graph_api
+        import transport as transport_module
+        import conversation_store
+        import conversation_util
+        import lambda_function as receiver
+
+        transport_module.MUSAFIR_INTERFACE_PATHS = [MUSAFIR_PATH]
+        transport_module.load_musafir_dispatcher()
+        musafir = sys.modules['musafir_interface']
+
+        self.dynamodb = FakeDynamoResource(TABLE_SCHEMAS)
+        self.sqs = FakeSqsClient()
+        self.ssm = FakeSsmClient({'WASecretToken': 'bench-secret'})
+        self.lambda_client = FakeLambdaClient({'musafir-interface': musafir.lambda_handler})
+
+        # Both Lambdas keep an identical aws_clients module, so the receiver's copy serves musafir here too
+        aws_clients.set_resource('dynamodb', self.dynamodb)
+        aws_clients.set_client('lambda', self.lambda_client)
+        aws_clients.set_client('sqs', self.sqs)
+        aws_clients.set_client('ssm', self.ssm)
+        musafir.whats_app_secret.invalidate()
+        # Entries never expire here: the seeded history is older than any sensible TTL
+        if store == 'sqlite':
+            conversation_store.set_conversation_store(conversation_store.SqliteConversationStore(':memory:', ttl_days=0))
+        else:
+            conversation_store.set_conversation_store(conversation_store.DynamoConversationStore(ttl_days=0))
+
+        graph_api.GRAPH_API_URL = self.graph.url
+        graph_api._senders.clear()
+        # Reuse the musafir-interface module patched above rather than letting the transport load a fresh copy
+        transport_module.MUSAFIR_TRANSPORT = transport
+        if transport == 'inprocess':
+            transport_module._transport = transport_module.InProcessTransport(musafir.dispatch)
+        else:
+            transport_module._transport = transport_module.LambdaInvokeTransport(
+                transport_module.MUSAFIR_FUNCTION_NAME, conversation_util.invoke_lambda)
+
+        self.receiver = receiver
+        self.musafir = musafir
+        self.graph_api = graph_api
+        self.conversation_util = conversation_util
+        self.conversation_store = conversation_store.get_conversation_store()
+
+    def seed_conversation(self, mobile, access_token, interactions=None, date=None):
+        """
+        Stores a conversation for `mobile` (without country code) on `date` (default today).
+        """
+        date = date or time.strftime('%Y-%m-%d')
+        self.conversation_store.set_session(mobile, 'Bench User', date, access_token)
+        if interactions:
+            self.conversation_store.append_interactions(mobile, date, interactions)
+
+    def seed_token(self, mobile, access_token, expires_in=86400):
+        """
+        Stores a smart-chat token for `mobile` (without country code), as left by an earlier day.
+        """
+        self.dynamodb.Table('chat_tokens').put_item(Item={
+            'mobile': mobile, 'access_token': access_token, 'expires_at': int(time.time()) + expires_in,
+            'name': 'Bench User'})
+
+    def webhook(self, messages, name='Bench User'):
+        """
+        Builds an API Gateway event carrying a WhatsApp webhook with `messages`.
+        """
+        wa_id = messages[0]['from'] if messages else '0'
+        body = {'object': 'whatsapp_business_account', 'entry': [{'id': '1', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'phone_number_id': '1000'},
+            'contacts': [{'profile': {'name': name}, 'wa_id': wa_id}],
+            'messages': messages
+        }}]}]}
+        return {'httpMethod': 'POST', 'body': json.dumps(body)}
+
+    def status_webhook(self, statuses):
+        """
+        Builds an API Gateway event carrying a WhatsApp status callback with `statuses`.
+        """
+        body = {'object': 'whatsapp_business_account', 'entry': [{'id': '1', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'phone_number_id': '1000'},
+            'statuses': statuses
+        }}]}]}
+        return {'httpMethod': 'POST', 'body': json.dumps(body)}
+
+    def stop(self):
+        self.receiver.outbound_queue.flush(5)
+        self.smart_chat.stop()
+        self.graph.stop()
@@ -0,0 +1,85 @@
+"""
+Measures the cold-start import cost of both Lambda handler modules.
+
+Usage:
+    python -m benchmarks.import_profile [--runs N] [--top N]
+
+Each run imports a handler module in a fresh interpreter with `python -X importtime`, the
+same way the Lambda runtime does on a cold start, and reports the wall time of the import
+plus the heaviest modules it pulled in (cumulative microseconds, as reported by CPython).
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+from benchmarks.harness import MUSAFIR_PATH, RECEIVER_PATH
+
+# (label, directory on sys.path, module imported by the runtime)
+HANDLERS = [
+    ('whatsapp_receiver', RECEIVER_PATH, 'lambda_function'),
+    ('musafir-interface', MUSAFIR_PATH, 'lambda_function'),
+]
+
+# Modules whose presence after import means a dependency was not deferred
+HEAVY_MODULES = ('boto3', 'botocore', 'requests', 'urllib3')
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+_PROBE = (
+    'import sys, time\n'
+    't = time.perf_counter()\n'
+    'import {module}\n'
+    'print((time.perf_counter() - t) * 1000)\n'
+    'print(",".join(m for m in {heavy!r} if m in sys.modules))\n'
+)
+
+
+def profile_import(path, module):
+    """
+    Imports `module` from `path` in a fresh interpreter.
+
+    Returns:
+    - (import wall time in ms, heavy modules loaded, {module: cumulative us} from -X importtime)
+    """
+    env = dict(os.environ, PYTHONPATH=path, AWS_DEFAULT_REGION=os.getenv('AWS_DEFAULT_REGION', 'ap-south-1'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=path, env=env, capture_output=True, text=True, check=True)
+    lines = result.stdout.splitlines()
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        if match.group(4) == 'site' and len(match.group(3)) == 1:
+            # Everything up to here is interpreter startup, paid before the handler is imported
+            cumulative.clear()
+            continue
+        cumulative[match.group(4)] = int(match.group(2))
+    return float(lines[-2]), [m for m in lines[-1].split(',') if m], cumulative
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='heaviest imports to list per handler')
+    args = parser.parse_args(argv)
+
+    for label, path, module in HANDLERS:
+        started = time.perf_counter()
+        runs = [profile_import(path, module) for _ in range(args.runs)]
+        wall = sorted(r[0] for r in runs)
+        _, heavy, cumulative = runs[-1]
+        print('{:<18} import p50 {:>7.1f}ms  min {:>7.1f}ms  ({} runs in {:.1f}s)'.format(
+            label, wall[len(wall) // 2], wall[0], args.runs, time.perf_counter() - started))
+        print('  heavy modules loaded at import: {}'.format(', '.join(heavy) or 'none'))
+        for name, us in sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print('  {:>9.1f}ms  {}'.format(us / 1000, name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
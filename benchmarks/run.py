@@ -0,0 +1,215 @@
+"""
+Offline end-to-end benchmarks of the WhatsApp webhook path.
+
+Usage:
+    python -m benchmarks.run [--iterations N] [--latency-ms MS] [--transport lambda|inprocess]
+                             [--store dynamodb|sqlite]
+                             [--scenarios a,b] [--save-baseline] [--threshold 0.25]
+
+Each scenario drives `whatsapp_receiver.lambda_handler` (and through it musafir-interface)
+against the local stand-ins and reports throughput and latency percentiles. Results are
+compared with the saved baseline and the run fails if a p50 regresses past the threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from benchmarks.harness import LocalEnvironment
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+_ids = itertools.count(1)
+
+
+def _text(mobile, body):
+    return {'from': mobile, 'id': 'wamid.bench.{}'.format(next(_ids)), 'timestamp': str(int(time.time())),
+            'type': 'text', 'text': {'body': body}}
+
+
+def _button(mobile, text):
+    return {'from': mobile, 'id': 'wamid.bench.{}'.format(next(_ids)), 'timestamp': str(int(time.time())),
+            'type': 'button', 'button': {'payload': text, 'text': text}}
+
+
+def _mobile(n):
+    return '91{:010d}'.format(n)
+
+
+def scenario_new_user(env, i):
+    # A mobile never seen before: login, start_chat and a new conversation entry
+    mobile = _mobile(5000000000 + i)
+    return env.receiver.lambda_handler(env.webhook([_text(mobile, 'Looking for a weekend trip')]), None)
+
+
+def setup_returning_user(env):
+    env.seed_conversation('7000000001', 'token-returning')
+
+
+def scenario_returning_user(env, i):
+    return env.receiver.lambda_handler(env.webhook([_text('917000000001', 'Plan a trip to Manali')]), None)
+
+
+def scenario_next_day_user(env, i):
+    # A user with a token from an earlier day but no conversation today: the token is reused
+    mobile = 7200000000 + i
+    env.seed_token(str(mobile), 'token-{}'.format(mobile))
+    return env.receiver.lambda_handler(env.webhook([_text('91{}'.format(mobile), 'Plan a trip to Manali')]), None)
+
+
+def scenario_button_press(env, i):
+    return env.receiver.lambda_handler(env.webhook([_button(_mobile(6000000000 + i), 'Explore trips?')]), None)
+
+
+def scenario_intent_hit(env, i):
+    # Free text answered by the local intent router, without DynamoDB or smart chat
+    return env.receiver.lambda_handler(env.webhook([_text(_mobile(6200000000 + i), 'Hi!')]), None)
+
+
+def scenario_status_callback(env, i):
+    # A delivery receipt: acked from the raw body, without parsing it
+    status = {'id': 'wamid.bench.{}'.format(next(_ids)), 'status': 'delivered', 'timestamp': str(int(time.time())),
+              'recipient_id': _mobile(6300000000 + i)}
+    event = env.status_webhook([status])
+    if env.receiver.may_have_messages(event['body']):
+        # Otherwise this would time the full parse while reporting the fast path
+        raise RuntimeError('status_callback body is not classified as status-only')
+    return env.receiver.lambda_handler(event, None)
+
+
+def scenario_document_send(env, i):
+    response = env.receiver.lambda_handler(env.webhook([_button(_mobile(6100000000 + i), 'Kasol Kheerganga')]), None)
+    # The follow-up template is sent from the outbound queue; drain it so iterations don't overlap
+    env.receiver.outbound_queue.flush(5)
+    return response
+
+
+def setup_history_query(env):
+    interactions = [{'date_time': '2024-01-01 10:{:02d}:00'.format(m), 'type': 'text' if m % 2 else 'reply',
+                     'content': 'message {}'.format(m)} for m in range(40)]
+    for day in range(1, 15):
+        env.seed_conversation('7100000001', 'token-history', interactions, date='2024-01-{:02d}'.format(day))
+
+
+def scenario_history_query(env, i):
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'q': 'filter(mobile:7100000001,from:2024-01-01,limit:7)'}}
+    return env.receiver.lambda_handler(event, None)
+
+
+SCENARIOS = {
+    'new_user': (None, scenario_new_user),
+    'returning_user': (setup_returning_user, scenario_returning_user),
+    'next_day_user': (None, scenario_next_day_user),
+    'button_press': (None, scenario_button_press),
+    'intent_hit': (None, scenario_intent_hit),
+    'status_callback': (None, scenario_status_callback),
+    'document_send': (None, scenario_document_send),
+    'history_query': (setup_history_query, scenario_history_query),
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_scenario(env, name, iterations, warmup):
+    setup, scenario = SCENARIOS[name]
+    if setup:
+        setup(env)
+    for i in range(warmup):
+        scenario(env, iterations + i)
+
+    durations = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        response = scenario(env, i)
+        durations.append((time.perf_counter() - t0) * 1000)
+        if response.get('statusCode') != 200:
+            raise RuntimeError('{} returned {}'.format(name, response))
+    elapsed = time.perf_counter() - started
+
+    durations.sort()
+    return {
+        'iterations': iterations,
+        'throughput_per_s': round(iterations / elapsed, 2),
+        'p50_ms': round(percentile(durations, 0.50), 3),
+        'p90_ms': round(percentile(durations, 0.90), 3),
+        'p99_ms': round(percentile(durations, 0.99), 3),
+        'max_ms': round(durations[-1], 3),
+    }
+
+
+# p50 differences below this are timer noise, e.g. for the microsecond status_callback path
+MIN_REGRESSION_MS = 0.1
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the scenarios whose p50 is more than `threshold` (a fraction), and at least
+    MIN_REGRESSION_MS, slower than the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and base['p50_ms'] and result['p50_ms'] > base['p50_ms'] * (1 + threshold) and \
+                result['p50_ms'] - base['p50_ms'] >= MIN_REGRESSION_MS:
+            regressions.append((name, base['p50_ms'], result['p50_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=5, help='added latency of each smart-chat call')
+    parser.add_argument('--graph-latency-ms', type=float, default=5, help='added latency of each Graph API call')
+    parser.add_argument('--transport', choices=('lambda', 'inprocess'), default='lambda')
+    parser.add_argument('--store', choices=('dynamodb', 'sqlite'), default='dynamodb', help='conversation store')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p50 regression, as a fraction')
+    args = parser.parse_args(argv)
+
+    env = LocalEnvironment(args.latency_ms, args.graph_latency_ms, args.transport, args.store)
+    try:
+        results = {}
+        for name in args.scenarios.split(','):
+            results[name] = run_scenario(env, name, args.iterations, args.warmup)
+            r = results[name]
+            print('{:<16} {:>9.1f}/s  p50 {:>8.2f}ms  p90 {:>8.2f}ms  p99 {:>8.2f}ms  max {:>8.2f}ms'.format(
+                name, r['throughput_per_s'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms']))
+        print('smart-chat requests: {}'.format(json.dumps(env.smart_chat.requests, sort_keys=True)))
+        print('graph requests: {}'.format(sum(env.graph.requests.values())))
+    finally:
+        env.stop()
+
+    if args.save_baseline:
+        # Scenarios not run keep their saved numbers, so one scenario can be re-recorded alone
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION {}: p50 {:.2f}ms -> {:.2f}ms'.format(name, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
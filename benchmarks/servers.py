@@ -0,0 +1,115 @@
+"""
+Local HTTP servers that mimic graph.facebook.com and the smart-chat `/v2/auth` and
+`/v2/chat` endpoints, with a configurable per-request latency.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real endpoints; without TCP_NODELAY the separate header and body
+    # writes hit delayed ACKs and add ~40ms to every call
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, payload, include_body=True):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.record(self.path)
+        status, payload = self.server.respond(self.path, self.headers, body)
+        self._reply(status, payload)
+
+    def do_GET(self):
+        self.server.record(self.path)
+        self._reply(200, {})
+
+    def do_HEAD(self):
+        # Warm-up probes; a HEAD response must not carry a body on a kept-alive connection
+        self.server.record(self.path)
+        self._reply(200, {}, include_body=False)
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_ms=0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.latency = latency_ms / 1000
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def record(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def respond(self, path, headers, body):
+        raise NotImplementedError
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class GraphApiServer(_StubServer):
+    """
+    Accepts `/{version}/{phone_number_id}/messages` and `/media` posts and returns message/media ids.
+    """
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self._ids = itertools.count(1)
+
+    def respond(self, path, headers, body):
+        if path.endswith('/media'):
+            return 200, {'id': 'media.{}'.format(next(self._ids))}
+        if path.endswith('/messages'):
+            return 200, {'messaging_product': 'whatsapp', 'messages': [{'id': 'wamid.{}'.format(next(self._ids))}]}
+        return 404, {'error': {'message': 'Unknown path'}}
+
+
+class SmartChatServer(_StubServer):
+    """
+    Mimics login-for-whatsapp, chat start and chat message of the smart-chat backend.
+    """
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self._tokens = itertools.count(1)
+
+    def respond(self, path, headers, body):
+        if path == '/v2/auth/login-for-whatsapp':
+            return 200, {'accessToken': 'token-{}'.format(next(self._tokens))}
+        if path == '/v2/chat/start':
+            return 200, {'response': json.dumps({'content': 'Hi! Where would you like to travel?'})}
+        if path == '/v2/chat/message':
+            message = json.loads(body or b'{}').get('message', '')
+            return 200, {'response': json.dumps({'content': 'You said: {}'.format(message)})}
+        return 404, {'message': 'Unknown path'}
@@ -1,13 +1,135 @@
 import requests
 import json
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import wraps
+from http_client import PooledHttpClient
+from circuit_breaker import CircuitBreaker
+from tracing import get_correlation_id, get_deadline, remaining_ms, set_correlation_id, set_deadline, traced
+from log_util import get_logger
+
+logger = get_logger(__name__)
 
 # Get the base URL for all APIs from the environment variable
 SMART_CHAT_URL = os.getenv('SMART_CHAT_URL', 'http://localhost:8080')
 
+# Shared keep-alive client, created once per container and reused across warm invocations
+smart_chat_client = PooledHttpClient(SMART_CHAT_URL)
+
+# Fails calls fast while the smart-chat backend is erroring, instead of piling more load on it
+smart_chat_breaker = CircuitBreaker('smart_chat')
+
+# Send a second start_chat if the first has not answered after this many ms (0 disables hedging).
+# Only enable this if the backend tolerates a duplicate chat start for the same token.
+START_CHAT_HEDGE_MS = int(os.getenv('START_CHAT_HEDGE_MS', '0'))
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+# send_chat calls of one send_chat_batch run at most this many at a time, per container
+SEND_CHAT_BATCH_CONCURRENCY = int(os.getenv('SEND_CHAT_BATCH_CONCURRENCY', '8'))
+_batch_executor = None
+
+
+def guarded(func):
+    """
+    Runs a smart-chat call through `smart_chat_breaker`: while the circuit is open the call is
+    not made and a 503 is returned at once. 5xx and 429 responses count as failures.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if remaining_ms() == 0:
+            # The caller has given up already; not the backend's fault, so nothing is recorded
+            return {
+                'statusCode': 504,
+                'message': 'Deadline exceeded before calling smart chat'
+            }
+        if not smart_chat_breaker.allow():
+            logger.warning("Circuit open, not calling %s", func.__name__)
+            return {
+                'statusCode': 503,
+                'message': 'Smart chat is temporarily unavailable',
+                'details': 'Circuit open, retry after {:.0f}s'.format(smart_chat_breaker.retry_after())
+            }
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            # Every allowed call must be recorded, or a half-open trial would stay in flight
+            smart_chat_breaker.record(False)
+            raise
+        status_code = response.get('statusCode', 500)
+        smart_chat_breaker.record(status_code < 500 and status_code != 429)
+        return response
+    return wrapper
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+        return _hedge_executor
+
+
+def _get_batch_executor():
+    global _batch_executor
+    with _hedge_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=SEND_CHAT_BATCH_CONCURRENCY,
+                                                 thread_name_prefix='send-chat-batch')
+        return _batch_executor
+
+
+def _close_response(future):
+    # Returns the losing attempt's connection to the pool
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _post_hedged(path, hedge_after_ms, **kwargs):
+    """
+    Posts to `path`, and if no response arrived within `hedge_after_ms` posts again and returns
+    whichever attempt succeeds first. Raises the last error if both attempts fail.
+    """
+    correlation_id, deadline = get_correlation_id(), get_deadline()
+
+    def attempt():
+        # Worker threads don't inherit the caller's correlation ID and deadline
+        set_correlation_id(correlation_id)
+        set_deadline(deadline)
+        return smart_chat_client.post(path, **kwargs)
+
+    executor = _get_hedge_executor()
+    pending = {executor.submit(attempt)}
+    done, pending = wait(pending, timeout=hedge_after_ms / 1000)
+    if not done:
+        logger.info("No response from %s after %sms, sending a hedged request", path, hedge_after_ms)
+        pending.add(executor.submit(attempt))
+
+    error = None
+    while done or pending:
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_close_response)
+                return future.result()
+            error = future.exception()
+        if not pending:
+            break
+        remaining = remaining_ms()
+        done, pending = wait(pending, timeout=None if remaining is None else remaining / 1000,
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            for other in pending:
+                other.add_done_callback(_close_response)
+            raise requests.exceptions.Timeout('Deadline exceeded waiting for {}'.format(path))
+    raise error
+
+@traced('smart_chat.login_for_whatsapp')
+@guarded
 def login_for_whatsapp(mobile, name, secret_token):
-    # Define the URL of the API endpoint (base URL + specific endpoint)
-    url = SMART_CHAT_URL + '/v2/auth/login-for-whatsapp'
+    # Define the API endpoint (relative to SMART_CHAT_URL)
+    path = '/v2/auth/login-for-whatsapp'
     
     # Define the request body
     payload = {
@@ -16,29 +138,30 @@ def login_for_whatsapp(mobile, name, secret_token):
         "secret_token": secret_token
     }
 
-    print(f"Calling login_for_whatsapp with mobile: {mobile}, name: {name}")
+    logger.info("Calling login_for_whatsapp with mobile: %s, name: %s", mobile, name)
 
     try:
         # Make the POST request to the API
-        print(f"Making POST request to {url} with payload: {json.dumps(payload)}")
-        response = requests.post(url, json=payload)
+        logger.debug("Making POST request to %s with payload: %s", path, payload)
+        # Logging in only issues a token, so it is safe to retry
+        response = smart_chat_client.post(path, idempotent=True, json=payload)
         
         # Check if the response status code is 200
         if response.status_code == 200:
-            print("Login successful. Access token received.")
+            logger.info("Login successful. Access token received.")
             return {
                 'statusCode': 200,
                 'accessToken': response.json().get("accessToken")
             }
         else:
-            print(f"Login failed with status code {response.status_code}. Response: {response.text}")
+            logger.error("Login failed with status code %s. Response: %s", response.status_code, response.text)
             return {
                 'statusCode': response.status_code,
                 'message': 'API call failed',
                 'details': response.text
             }
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred during the API request: {e}")
+        logger.error("An error occurred during the API request: %s", e)
         return {
             'statusCode': 500,
             'message': 'An error occurred during the API request',
@@ -46,49 +169,56 @@ def login_for_whatsapp(mobile, name, secret_token):
         }
 
 
+@traced('smart_chat.start_chat')
+@guarded
 def start_chat(access_token):
-    # Construct the URL for the start chat API (base URL + specific endpoint)
-    url = SMART_CHAT_URL + '/v2/chat/start'
+    # Define the start chat endpoint (relative to SMART_CHAT_URL)
+    path = '/v2/chat/start'
     
     # Set the headers with the Authorization token
     headers = {
         "Authorization": access_token
     }
 
-    print(f"Calling start_chat with access_token: {access_token}")
+    logger.info("Calling start_chat")
 
     try:
         # Make the POST request to the API
-        print(f"Making POST request to {url} with headers: {json.dumps(headers)}")
-        response = requests.post(url, headers=headers)
+        logger.debug("Making POST request to %s", path)
+        if START_CHAT_HEDGE_MS:
+            response = _post_hedged(path, START_CHAT_HEDGE_MS, headers=headers)
+        else:
+            response = smart_chat_client.post(path, headers=headers)
         
         if response.status_code == 200:
             # Parse the response JSON data and extract the content
             response_data = response.json()
             content = json.loads(response_data.get('response', '{}')).get('content', '')
-            print(f"Start chat successful. Content: {content}")
+            logger.debug("Start chat successful. Content: %s", content)
             return {
                 'statusCode': 200,
                 'content': content
             }
         else:
-            print(f"Start chat failed with status code {response.status_code}. Response: {response.text}")
+            logger.error("Start chat failed with status code %s. Response: %s", response.status_code, response.text)
             return {
                 'statusCode': response.status_code,
                 'message': 'API call failed',
                 'details': response.text
             }
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred during the API request: {e}")
+        logger.error("An error occurred during the API request: %s", e)
         return {
             'statusCode': 500,
             'message': 'An error occurred during the API request',
             'error': str(e)
         }
 
+@traced('smart_chat.send_chat')
+@guarded
 def send_chat(access_token, message):
-    # Construct the URL for the send chat API (base URL + specific endpoint)
-    url = SMART_CHAT_URL + '/v2/chat/message'
+    # Define the send chat endpoint (relative to SMART_CHAT_URL)
+    path = '/v2/chat/message'
     
     # Set the headers with the Authorization token
     headers = {
@@ -100,32 +230,70 @@ def send_chat(access_token, message):
         "message": message
     }
 
-    print(f"Calling send_chat with access_token: {access_token}, message: {message}")
+    logger.info("Calling send_chat")
 
     try:
         # Make the POST request to the API
-        print(f"Making POST request to {url} with payload: {json.dumps(payload)}")
-        response = requests.post(url, json=payload, headers=headers)
+        logger.debug("Making POST request to %s with payload: %s", path, payload)
+        response = smart_chat_client.post(path, json=payload, headers=headers)
         
         if response.status_code == 200:
             response_data = response.json()
             content = json.loads(response_data.get('response', '{}')).get('content', '')
-            print(f"Send chat successful. Content: {content}")
+            logger.debug("Send chat successful. Content: %s", content)
             return {
                 'statusCode': 200,
                 'content': content
             }
         else:
-            print(f"Send chat failed with status code {response.status_code}. Response: {response.text}")
+            logger.error("Send chat failed with status code %s. Response: %s", response.status_code, response.text)
             return {
                 'statusCode': response.status_code,
                 'message': 'API call failed',
                 'details': response.text
             }
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred during the API request: {e}")
+        logger.error("An error occurred during the API request: %s", e)
         return {
             'statusCode': 500,
             'message': 'An error occurred during the API request',
             'error': str(e)
         }
+
+
+@traced('smart_chat.send_chat_batch')
+def send_chat_batch(items):
+    """
+    Sends the messages of several users concurrently, over the shared connection pool and at
+    most SEND_CHAT_BATCH_CONCURRENCY at a time. Each call goes through the circuit breaker and
+    deadline like `send_chat`, and one failing item does not fail the others.
+
+    Parameters:
+    - items: A list of dicts with `access_token`, `message` and optionally the `correlation_id`
+      of the user's message
+
+    Returns:
+    - A dict with `statusCode` 200 and `results`, the `send_chat` response of each item in order
+    """
+    correlation_id, deadline = get_correlation_id(), get_deadline()
+
+    def send(item):
+        # Worker threads don't inherit the caller's deadline; each item keeps its own correlation ID
+        set_correlation_id(item.get('correlation_id') or correlation_id)
+        set_deadline(deadline)
+        try:
+            return send_chat(item['access_token'], item['message'])
+        except Exception as e:
+            logger.exception("Unexpected error sending a batched chat message: %s", e)
+            return {
+                'statusCode': 500,
+                'message': 'An error occurred while sending the message',
+                'error': str(e)
+            }
+
+    logger.info("Calling send_chat for %s users", len(items))
+    results = list(_get_batch_executor().map(send, items))
+    return {
+        'statusCode': 200,
+        'results': results
+    }
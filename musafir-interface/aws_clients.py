@@ -0,0 +1,56 @@
+"""
+Lazily created boto3 clients and resources, cached for the life of the container.
+
+Importing boto3 and building a client costs tens of milliseconds of cold start, so nothing
+is created until a code path actually needs AWS. This module is kept identical in
+whatsapp_receiver and musafir-interface.
+"""
+import threading
+
+_cache = {}
+# boto3's default session is not thread-safe, so creation is serialized
+_lock = threading.Lock()
+
+
+def _get(kind, service):
+    key = (kind, service)
+    value = _cache.get(key)
+    if value is None:
+        with _lock:
+            value = _cache.get(key)
+            if value is None:
+                import boto3
+                value = boto3.client(service) if kind == 'client' else boto3.resource(service)
+                _cache[key] = value
+    return value
+
+
+def get_client(service):
+    return _get('client', service)
+
+
+def get_resource(service):
+    return _get('resource', service)
+
+
+def set_client(service, client):
+    """
+    Replaces the cached client, e.g. with a local stand-in.
+    """
+    _cache[('client', service)] = client
+
+
+def set_resource(service, resource):
+    _cache[('resource', service)] = resource
+
+
+def is_initialized(kind, service):
+    return (kind, service) in _cache
+
+
+def error_code(error):
+    """
+    Returns the AWS error code of a botocore ClientError (None for other exceptions),
+    without importing botocore.
+    """
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
@@ -0,0 +1,115 @@
+"""
+A per-container circuit breaker for calls to the smart-chat backend.
+
+Every container keeps its own breaker, so a struggling backend is shed by each warm
+container independently, without shared state.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from tracing import emit_metrics
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Open once at least BREAKER_MIN_CALLS calls in the last BREAKER_WINDOW_SECONDS failed at BREAKER_FAILURE_RATE or more
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '10'))
+BREAKER_WINDOW_SECONDS = float(os.getenv('BREAKER_WINDOW_SECONDS', '30'))
+# How long calls fail fast before a single trial call is let through
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '20'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of recent calls and fails fast while the failure rate is too high.
+
+    - closed: calls go through; outcomes are kept for the sliding window
+    - open: calls are refused until `open_seconds` have passed
+    - half_open: one trial call goes through; its outcome closes or re-opens the circuit
+    """
+    def __init__(self, name, failure_rate=BREAKER_FAILURE_RATE, min_calls=BREAKER_MIN_CALLS,
+                 window_seconds=BREAKER_WINDOW_SECONDS, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._outcomes = deque()
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _transition(self, state):
+        logger.warning("Circuit '%s' is now %s", self.name, state)
+        self.state = state
+        emit_metrics({'CircuitTransition': (1, 'Count')}, {'Circuit': self.name, 'State': state})
+
+    def allow(self):
+        """
+        Returns whether a call may be made now. Every allowed call must be followed by `record`.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record(self, ok):
+        """
+        Records the outcome of an allowed call.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_in_flight = False
+                self._outcomes.clear()
+                self._failures = 0
+                if ok:
+                    self._transition(CLOSED)
+                else:
+                    self._opened_at = now
+                    self._transition(OPEN)
+                return
+            if self.state == OPEN:
+                # A call allowed before the circuit opened; it no longer changes anything
+                return
+
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            self._expire(now)
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= calls * self.failure_rate:
+                self._opened_at = now
+                self._transition(OPEN)
+
+    def retry_after(self):
+        """
+        Seconds until a trial call will be let through (0 unless the circuit is open).
+        """
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from tracing import CORRELATION_HEADER, get_correlation_id, remaining_ms
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Pool and timeout settings, overridable per deployment through the environment
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '4'))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '25'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.2'))
+
+# Status codes that are worth retrying for idempotent calls
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# Set to True by the pools below whenever the calling thread opens a new socket
+_conn_state = threading.local()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _conn_state.opened = True
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _conn_state.opened = True
+        return super()._new_conn()
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection pools flag every newly opened connection, so the
+    client can tell whether a call reused a kept-alive socket or paid a new handshake.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised instead of sending, or retrying, a request once the caller's deadline has passed.
+    """
+
+
+def _within_deadline(timeout):
+    # Caps the (connect, read) timeout to the time left before the current thread's deadline
+    remaining = remaining_ms()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline exceeded before the request was sent')
+    remaining /= 1000
+    return (min(timeout[0], remaining), min(timeout[1], remaining))
+
+
+def _never_sent(error):
+    # requests wraps urllib3's MaxRetryError, whose `reason` tells us why the connection failed
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+class PooledHttpClient:
+    """
+    A keep-alive HTTP client meant to be created once per Lambda container and reused
+    across warm invocations.
+
+    Every call gets a (connect, read) timeout. Failed calls are retried with exponential
+    backoff when they are idempotent; non-idempotent calls are only retried when the
+    connection could not be established, since the request never reached the server.
+    """
+    def __init__(self, base_url, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        self.session = requests.Session()
+        adapter = _CountingHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                       max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'reused': 0, 'new': 0, 'retries': 0}
+
+    def _record(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        """
+        Returns a snapshot of the request, connection reuse and retry counters.
+        """
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _send(self, method, url, timeout, **kwargs):
+        _conn_state.opened = False
+        response = self.session.request(method, url, timeout=timeout, **kwargs)
+        self._record('new' if _conn_state.opened else 'reused')
+        self._record('requests')
+        return response
+
+    def request(self, method, path, idempotent=False, timeout=None, **kwargs):
+        """
+        Sends a request to `base_url + path` over the pooled session.
+
+        Parameters:
+        - method: The HTTP method
+        - path: The endpoint path, appended to the base URL
+        - idempotent: Whether the call can safely be repeated after a timeout or a 5xx
+        - timeout: Optional (connect, read) tuple overriding the client defaults; either part is
+          capped to the time left before the calling thread's deadline (see `tracing.set_deadline`)
+        - kwargs: Passed through to `requests.Session.request`
+
+        Returns:
+        - The `requests.Response` of the last attempt. Raises `requests.exceptions.RequestException`
+          if the last attempt failed at the transport level, or `DeadlineExceeded` if the deadline
+          passed before a request could be sent.
+        """
+        url = self.base_url + path
+        timeout = timeout or self.timeout
+        correlation_id = get_correlation_id()
+        if correlation_id:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{CORRELATION_HEADER: correlation_id})
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, _within_deadline(timeout), **kwargs)
+                if not (idempotent and response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries):
+                    return response
+                logger.warning("%s %s returned %s, retrying.", method, path, response.status_code)
+            except DeadlineExceeded:
+                raise
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries:
+                    raise
+                # A connect failure means the request was never sent, so any call may be retried.
+                # Other connection errors (e.g. reset mid-response) are only retried when idempotent.
+                if not (idempotent or _never_sent(e)):
+                    raise
+                logger.warning("%s %s failed with %s, retrying.", method, path, type(e).__name__)
+                response = None
+            except requests.exceptions.Timeout:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                logger.warning("%s %s timed out, retrying.", method, path)
+                response = None
+
+            attempt += 1
+            delay = self.backoff_factor * (2 ** (attempt - 1))
+            remaining = remaining_ms()
+            if remaining is not None and delay * 1000 >= remaining:
+                # No time left for another attempt: hand back the last response, or give up
+                if response is not None:
+                    return response
+                raise DeadlineExceeded('Deadline exceeded before {} {} could be retried'.format(method, path))
+            if response is not None:
+                # Release the connection back to the pool before the next attempt
+                response.close()
+            self._record('retries')
+            time.sleep(delay)
+
+    def warm(self, path='/'):
+        """
+        Opens a pooled connection to the base URL ahead of the first real request, so that
+        request skips the TCP and TLS handshakes. Any HTTP status counts as warmed.
+
+        Returns:
+        - A dict with the `status` of the probe and whether a `new` connection was opened
+        """
+        _conn_state.opened = False
+        response = self.session.head(self.base_url + path, timeout=self.timeout)
+        # HEAD has no body, so closing returns the connection to the pool
+        response.close()
+        return {'status': response.status_code, 'new': bool(_conn_state.opened)}
+
+    def post(self, path, idempotent=False, **kwargs):
+        return self.request('POST', path, idempotent=idempotent, **kwargs)
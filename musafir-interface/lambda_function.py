@@ -1,66 +1,126 @@
-import boto3
 import json
-from api_client import login_for_whatsapp, start_chat, send_chat
+import os
+from api_client import login_for_whatsapp, start_chat, send_chat, send_chat_batch, smart_chat_client
+from secret_cache import SecretCache, SecretUnavailableError
+from tracing import deadline_after, new_correlation_id, set_correlation_id, set_deadline
+from log_util import get_logger
+from aws_clients import get_client
+from warmup import is_warmup_event, run_warmup
 
-# Initialize the SSM client
-ssm_client = boto3.client('ssm')
+logger = get_logger(__name__)
 
-def get_whats_app_secret_token():
+# How long the secret is served from memory, and how much longer it may be served stale while refreshing
+SECRET_TTL = int(os.getenv('SECRET_TTL', '900'))
+SECRET_STALE_TTL = int(os.getenv('SECRET_STALE_TTL', '300'))
+
+# Most items accepted by one send_chat_batch call
+SEND_CHAT_BATCH_MAX_ITEMS = int(os.getenv('SEND_CHAT_BATCH_MAX_ITEMS', '50'))
+
+
+def fetch_whats_app_secret_token():
     """
     Fetches the WhatsApp secret token from AWS SSM Parameter Store.
-    
+
     Returns:
-    - The WhatsApp secret token if found, or a default token if not found or an error occurs.
+    - The WhatsApp secret token. Raises if it cannot be fetched.
     """
-    try:
-        # Fetch the WhatsApp secret token from SSM Parameter Store
-        response = ssm_client.get_parameter(
-            Name='WASecretToken',  # Parameter name in SSM
-            WithDecryption=True  # Decrypt the value if it's encrypted
-        )
-        secret_token = response['Parameter']['Value']
-        print("Successfully fetched WhatsApp secret token from SSM.")
-        return secret_token
-    except Exception as e:
-        # If an error occurs, log the error and return a default token
-        print(f"Error fetching WhatsApp secret token from SSM: {str(e)}")
-        return 'No-Login-Required-For-Whatsapp-Chats'  # Default token
+    # Fetch the WhatsApp secret token from SSM Parameter Store
+    # The SSM client is created on first use; invocations that don't need the secret never load boto3
+    response = get_client('ssm').get_parameter(
+        Name='WASecretToken',  # Parameter name in SSM
+        WithDecryption=True  # Decrypt the value if it's encrypted
+    )
+    logger.info("Successfully fetched WhatsApp secret token from SSM.")
+    return response['Parameter']['Value']
 
 
-def lambda_handler(event, context):
-    # Fetch the WhatsApp secret token dynamically from SSM Parameter Store
-    whats_app_secret_token = get_whats_app_secret_token()
-    
-    # Print incoming event for debugging purposes
-    print(f"Received event: {json.dumps(event)}")
+whats_app_secret = SecretCache('WASecretToken', fetch_whats_app_secret_token, SECRET_TTL, SECRET_STALE_TTL)
+
+
+def get_whats_app_secret_token():
+    """
+    Returns the WhatsApp secret token, served from the in-memory cache when it is fresh.
+
+    Returns:
+    - The WhatsApp secret token. Raises `SecretUnavailableError` if it cannot be fetched.
+    """
+    return whats_app_secret.get()
+
+
+def _warm_secret():
+    # Loads the secret into the cache (creating the SSM client) without putting it in the report
+    whats_app_secret.get()
+
+
+def warm_up():
+    """
+    Loads the WhatsApp secret and opens the pooled connection to SMART_CHAT_URL, so the
+    first real call after a scale-out pays for neither.
+
+    Returns:
+    - The warm-up report, see `run_warmup`
+    """
+    return run_warmup([
+        ('secret', _warm_secret),
+        ('smart_chat_connection', smart_chat_client.warm),
+    ])
+
+
+def dispatch(event):
+    """
+    Validates the event and calls the requested smart-chat method.
+    Used by `lambda_handler`, and called directly by the receiver when both are packaged together.
+
+    Parameters:
+    - event: A dict with a `method` key and the parameters for that method, and optionally the
+      `correlation_id` and `deadline_ms` (milliseconds the caller will wait) of the request
+
+    Returns:
+    - A dict with the `statusCode` and the response `body` as a dict (not yet JSON-encoded)
+    """
+    set_correlation_id(event.get('correlation_id') or new_correlation_id())
+    # Time the caller can still wait for us; smart-chat timeouts and retries are capped to it
+    deadline_ms = event.get('deadline_ms')
+    set_deadline(deadline_after(deadline_ms) if deadline_ms is not None else None)
+
+    if is_warmup_event(event):
+        return {
+            'statusCode': 200,
+            'body': {
+                'success': True,
+                'message': 'Warmed up',
+                'data': warm_up()
+            }
+        }
     
     # Extract method and validate presence of the method key
     method = event.get("method", "")
     if not method:
-        print("Error: Missing 'method' field.")
+        logger.warning("Missing 'method' field.")
         return {
             'statusCode': 400,
-            'body': json.dumps({
+            'body': {
                 'message': 'Missing required field: method.'
-            })
+            }
         }
 
     # Define a dictionary that maps method names to functions
     method_map = {
         "login_for_whatsapp": login_for_whatsapp,
         "start_chat": start_chat,
-        "send_chat": send_chat
+        "send_chat": send_chat,
+        "send_chat_batch": send_chat_batch
     }
 
     # Check if the method is valid
     method_function = method_map.get(method)
     if not method_function:
-        print(f"Error: Invalid method '{method}'. Valid methods are: {', '.join(method_map.keys())}.")
+        logger.warning("Invalid method '%s'. Valid methods are: %s.", method, ', '.join(method_map.keys()))
         return {
             'statusCode': 400,
-            'body': json.dumps({
+            'body': {
                 'message': f"Invalid method: {method}. Valid methods are: {', '.join(method_map.keys())}."
-            })
+            }
         }
 
     # Extract the required parameters for the selected method
@@ -69,92 +129,146 @@ def lambda_handler(event, context):
             mobile = event.get("mobile")
             name = event.get("name")
 
-            print(f"Calling login_for_whatsapp with mobile: {mobile}, name: {name}")
+            logger.debug("Calling login_for_whatsapp with mobile: %s, name: %s", mobile, name)
 
             if not mobile or not name:
-                print("Error: Missing required fields for login: mobile, name.")
+                logger.warning("Missing required fields for login: mobile, name.")
                 return {
                     'statusCode': 400,
-                    'body': json.dumps({
+                    'body': {
                         'message': 'Missing required fields for login: mobile, name.'
-                    })
+                    }
+                }
+
+            # Only login needs the secret, so it is fetched (or served from cache) here
+            try:
+                whats_app_secret_token = get_whats_app_secret_token()
+            except SecretUnavailableError as e:
+                logger.error("%s", e)
+                return {
+                    'statusCode': 500,
+                    'body': {
+                        'message': 'WhatsApp secret token is unavailable.'
+                    }
                 }
 
             # Call login_for_whatsapp with the provided parameters
             response_data = method_function(mobile, name, whats_app_secret_token)
-            print("Response from login_for_whatsapp:", response_data)
+            logger.debug("Response from login_for_whatsapp: %s", response_data)
 
         elif method == "start_chat":
             access_token = event.get("access_token")
             if not access_token:
-                print("Error: Missing required field: access_token for start_chat.")
+                logger.warning("Missing required field: access_token for start_chat.")
                 return {
                     'statusCode': 400,
-                    'body': json.dumps({
+                    'body': {
                         'message': 'Missing required field: access_token for start_chat.'
-                    })
+                    }
                 }
 
             # Call start_chat with the provided access token
-            print(f"Calling start_chat with access_token: {access_token}")
+            logger.debug("Calling start_chat")
             response_data = method_function(access_token)
-            print("Response from start_chat:", response_data)
+            logger.debug("Response from start_chat: %s", response_data)
 
         elif method == "send_chat":
             access_token = event.get("access_token")
             message = event.get("message")
             if not access_token or not message:
-                print("Error: Missing required fields: access_token or message for send_chat.")
+                logger.warning("Missing required fields: access_token or message for send_chat.")
                 return {
                     'statusCode': 400,
-                    'body': json.dumps({
+                    'body': {
                         'message': 'Missing required fields: access_token or message for send_chat.'
-                    })
+                    }
                 }
 
             # Call send_chat with the provided access token and message
-            print(f"Calling send_chat with access_token: {access_token}, message: {message}")
+            logger.debug("Calling send_chat with message: %s", message)
             response_data = method_function(access_token, message)
-            print("Response from send_chat:", response_data)
+            logger.debug("Response from send_chat: %s", response_data)
+
+        elif method == "send_chat_batch":
+            items = event.get("items")
+            if not isinstance(items, list) or not items or len(items) > SEND_CHAT_BATCH_MAX_ITEMS:
+                logger.warning("Invalid items for send_chat_batch.")
+                return {
+                    'statusCode': 400,
+                    'body': {
+                        'message': f"send_chat_batch needs a list of 1 to {SEND_CHAT_BATCH_MAX_ITEMS} items."
+                    }
+                }
+            invalid = [i for i, item in enumerate(items)
+                       if not isinstance(item, dict) or not item.get('access_token') or not item.get('message')]
+            if invalid:
+                logger.warning("Missing access_token or message in send_chat_batch items %s.", invalid)
+                return {
+                    'statusCode': 400,
+                    'body': {
+                        'message': f"Missing required fields: access_token or message in items {invalid}."
+                    }
+                }
+
+            # Call send_chat for every item; per-item failures are reported in the results
+            logger.debug("Calling send_chat_batch with %s items", len(items))
+            response_data = method_function(items)
+            logger.debug("Response from send_chat_batch: %s", response_data)
 
         else:
-            print(f"Error: Unsupported method: {method}")
+            logger.warning("Unsupported method: %s", method)
             return {
                 'statusCode': 400,
-                'body': json.dumps({
+                'body': {
                     'message': f"Unsupported method: {method}."
-                })
+                }
             }
 
     except Exception as e:
         # Catch any unexpected errors and log them
-        print(f"Error: An unexpected error occurred: {str(e)}")
+        logger.exception("An unexpected error occurred: %s", e)
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': {
                 'message': f"An error occurred while processing the request: {str(e)}"
-            })
+            }
         }
 
     # Check the response data from the called function and format it accordingly
     if response_data.get('statusCode') == 200:
-        print("API call successful. Returning success response.")
+        logger.debug("API call successful. Returning success response.")
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': {
                 'success': True,
                 'message': 'API call successful',
                 'data': response_data
-            })
+            }
         }
     else:
-        print(f"API call failed with statusCode: {response_data.get('statusCode')}.")
+        logger.warning("API call failed with statusCode: %s.", response_data.get('statusCode'))
         return {
             'statusCode': response_data.get('statusCode', 500),
-            'body': json.dumps({
+            'body': {
                 'success': False,
                 'message': response_data.get('message', 'API call failed'),
                 'details': response_data.get('details', ''),
                 'error': response_data.get('error', '')
-            })
+            }
         }
+
+
+def lambda_handler(event, context):
+    # Print incoming event for debugging purposes
+    logger.debug("Received event: %s", event)
+
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        # Never wait on smart chat past our own timeout, whatever the caller allowed
+        own_deadline_ms = max(context.get_remaining_time_in_millis() - 200, 0)
+        event = dict(event, deadline_ms=min(event.get('deadline_ms', own_deadline_ms), own_deadline_ms))
+
+    response = dispatch(event)
+    return {
+        'statusCode': response['statusCode'],
+        'body': json.dumps(response['body'])
+    }
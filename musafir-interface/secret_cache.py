@@ -0,0 +1,73 @@
+import threading
+import time
+
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+
+class SecretUnavailableError(Exception):
+    """
+    Raised when a secret cannot be fetched and there is no usable cached value.
+    """
+
+
+class SecretCache:
+    """
+    Caches a secret fetched by `fetch` for `ttl` seconds.
+
+    Once the TTL has passed the cached value is still served for up to `stale_ttl` more
+    seconds while a background thread refreshes it (stale-while-revalidate). Past that
+    window, or before the first successful fetch, `get` fetches synchronously and raises
+    `SecretUnavailableError` on failure instead of falling back to a default.
+    """
+    def __init__(self, name, fetch, ttl, stale_ttl):
+        self.name = name
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._value = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        try:
+            value = self._fetch()
+        except Exception as e:
+            raise SecretUnavailableError(f"Could not fetch secret '{self.name}': {str(e)}") from e
+        with self._lock:
+            self._value = value
+            self._fetched_at = time.monotonic()
+        return value
+
+    def _refresh_in_background(self):
+        try:
+            self._load()
+            logger.info("Refreshed secret '%s' in the background.", self.name)
+        except SecretUnavailableError as e:
+            # Keep serving the stale value; the next call past the stale window will raise
+            logger.error("Error refreshing secret in the background: %s", e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get(self):
+        """
+        Returns the secret, fetching or refreshing it as needed.
+        """
+        with self._lock:
+            age = time.monotonic() - self._fetched_at
+            if self._value is not None and age < self.ttl:
+                return self._value
+            if self._value is not None and age < self.ttl + self.stale_ttl:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return self._value
+        return self._load()
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._fetched_at = 0.0
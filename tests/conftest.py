@@ -0,0 +1,64 @@
+"""
+Puts both Lambdas on the import path, the way the benchmark harness does: the receiver's
+copies of the shared modules (tracing, log_util, aws_clients, ...) serve musafir-interface too.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in (os.path.join(ROOT, 'musafir-interface'), os.path.join(ROOT, 'whatsapp_receiver'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-south-1')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+
+
+@pytest.fixture
+def dynamodb():
+    """
+    An in-process DynamoDB with the benchmark harness's tables, installed as the shared resource.
+    """
+    import aws_clients
+    from benchmarks.fakes import FakeDynamoResource
+    from benchmarks.harness import TABLE_SCHEMAS
+
+    resource = FakeDynamoResource(TABLE_SCHEMAS)
+    previous = aws_clients._cache.get(('resource', 'dynamodb'))
+    aws_clients.set_resource('dynamodb', resource)
+    yield resource
+    if previous is None:
+        aws_clients._cache.pop(('resource', 'dynamodb'), None)
+    else:
+        aws_clients.set_resource('dynamodb', previous)
+
+
+@pytest.fixture(scope='session')
+def local_env():
+    """
+    Both Lambdas imported against the benchmark harness's stub servers and AWS fakes.
+    """
+    from benchmarks.harness import LocalEnvironment
+
+    env = LocalEnvironment()
+    yield env
+    env.stop()
+
+
+class LambdaContext:
+    """
+    The part of the Lambda context object the handlers read.
+    """
+    def __init__(self, remaining_ms=60000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def text_message(mobile, body, message_id):
+    return {'from': mobile, 'id': message_id, 'timestamp': '1700000000', 'type': 'text', 'text': {'body': body}}
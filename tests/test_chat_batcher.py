@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import conversation_util
+from conversation_util import ChatBatcher
+from transport import InvokeResult
+
+
+def _send_concurrently(batcher, count):
+    results = [None] * count
+
+    def send(i):
+        results[i] = batcher.send('token-{}'.format(i), 'message {}'.format(i))
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_sends_go_out_as_one_batch(monkeypatch):
+    calls = []
+
+    def call_musafir(payload):
+        calls.append(payload)
+        return InvokeResult(True, 200, {'results': [{'statusCode': 200, 'content': 'reply to ' + item['message']}
+                                                    for item in payload['items']]})
+    monkeypatch.setattr(conversation_util, 'call_musafir', call_musafir)
+
+    # A full batch is sent at once, well before the window ends
+    results = _send_concurrently(ChatBatcher(window_ms=5000, max_size=3), 3)
+    assert [call['method'] for call in calls] == ['send_chat_batch']
+    assert len(calls[0]['items']) == 3
+    assert sorted(r['content'] for r in results) == ['reply to message 0', 'reply to message 1', 'reply to message 2']
+    # Each caller gets the result for its own message
+    for call_item in calls[0]['items']:
+        i = int(call_item['access_token'].split('-')[1])
+        assert results[i] == {'success': True, 'status_code': 200, 'content': 'reply to message {}'.format(i)}
+
+
+def test_lone_send_uses_send_chat(monkeypatch):
+    calls = []
+    monkeypatch.setattr(conversation_util, 'call_musafir',
+                        lambda payload: calls.append(payload) or InvokeResult(True, 200, {'content': 'hi'}))
+    assert ChatBatcher(window_ms=0).send('token', 'hello') == {'success': True, 'status_code': 200, 'content': 'hi'}
+    assert [call['method'] for call in calls] == ['send_chat']
+
+
+def test_failed_batch_fails_every_caller(monkeypatch):
+    monkeypatch.setattr(conversation_util, 'call_musafir', lambda payload: InvokeResult(False, 503, message='open'))
+    results = _send_concurrently(ChatBatcher(window_ms=5000, max_size=2), 2)
+    assert results == [{'success': False, 'status_code': 503, 'content': None}] * 2
+
+
+def test_followers_are_released_when_the_leader_raises(monkeypatch):
+    def call_musafir(payload):
+        raise RuntimeError('invoke failed')
+    monkeypatch.setattr(conversation_util, 'call_musafir', call_musafir)
+    batcher = ChatBatcher(window_ms=5000, max_size=2)
+    results = []
+    follower = threading.Thread(target=lambda: results.append(batcher.send('b', 'second')))
+
+    # The first caller leads the batch; the second, started shortly after, fills it and waits
+    threading.Timer(0.05, follower.start).start()
+    with pytest.raises(RuntimeError):
+        batcher.send('a', 'first')
+    follower.join(5)
+    assert results == [{'success': False, 'status_code': 500, 'content': None}]
@@ -0,0 +1,60 @@
+import pytest
+
+import api_client
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+def _open(breaker):
+    for _ in range(breaker.min_calls):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == OPEN
+
+
+def test_opens_once_the_failure_rate_is_reached():
+    breaker = CircuitBreaker('test', failure_rate=0.5, min_calls=4, window_seconds=30, open_seconds=20)
+    for ok in (True, False, True):
+        breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == CLOSED
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() > 0
+
+
+def test_half_open_lets_one_trial_through_and_closes_on_success():
+    breaker = CircuitBreaker('test', min_calls=2, open_seconds=0)
+    _open(breaker)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_half_open_trial_failure_reopens():
+    breaker = CircuitBreaker('test', min_calls=2, open_seconds=0)
+    _open(breaker)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == OPEN
+
+
+def test_guarded_call_that_raises_ends_the_half_open_trial(monkeypatch):
+    breaker = CircuitBreaker('test', min_calls=2, open_seconds=0)
+    _open(breaker)
+    monkeypatch.setattr(api_client, 'smart_chat_breaker', breaker)
+
+    @api_client.guarded
+    def failing_call():
+        raise ValueError('not JSON')
+
+    with pytest.raises(ValueError):
+        failing_call()
+    # The trial was recorded as a failure rather than left in flight
+    assert breaker.state == OPEN
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
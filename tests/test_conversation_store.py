@@ -0,0 +1,22 @@
+import pytest
+
+from conversation_store import ConversationStore, DynamoConversationStore, entry_expiry
+
+
+def test_store_interface_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+
+@pytest.mark.parametrize('ttl_days', [0, 30])
+def test_every_write_sets_the_entry_expiry_when_ttl_is_on(dynamodb, ttl_days):
+    store = DynamoConversationStore('conversation', ttl_days=ttl_days)
+    assert store.claim('1', 'A', '2026-01-01', 'c1', 100, 70)
+    store.set_session('1', 'A', '2026-01-01', 'token-1', expires_at=200)
+    store.append_interactions('1', '2026-01-01', [{'q': 'hi'}])
+
+    item = store.get('1', '2026-01-01')
+    assert item['access_token'] == 'token-1' and item['token_expires_at'] == 200
+    assert 'claim_id' not in item and 'claimed_at' not in item
+    assert item.get('expires_at') == entry_expiry('2026-01-01', ttl_days)
+    assert (item.get('expires_at') is None) == (ttl_days == 0)
@@ -0,0 +1,60 @@
+import pytest
+
+from history_query import (DEFAULT_PAGE_SIZE, QueryError, chunk_messages, decode_cursor, encode_cursor, may_query,
+                           parse_filter)
+
+
+def test_parses_a_date_range_and_paging():
+    query = parse_filter(' filter(mobile:7100000001, date:2024-01-01..2024-01-31, limit:5) ')
+    assert (query.mobile, query.date_from, query.date_to, query.limit) == ('7100000001', '2024-01-01', '2024-01-31', 5)
+    assert parse_filter('filter(mobile:1,date:2024-02-03)').date_to == '2024-02-03'
+    assert parse_filter('filter(mobile:1)').limit == DEFAULT_PAGE_SIZE
+
+
+@pytest.mark.parametrize('text', [
+    'mobile:1',
+    'filter(date:2024-01-01)',
+    'filter(mobile:1,date:01-01-2024)',
+    'filter(mobile:1,limit:0)',
+    'filter(mobile:1,latest:x)',
+    'filter(mobile:1,colour:red)',
+    'filter(mobile:1,from)',
+])
+def test_rejects_malformed_queries(text):
+    with pytest.raises(QueryError):
+        parse_filter(text)
+
+
+def test_next_page_query_round_trips_the_cursor():
+    query = parse_filter('filter(mobile:1,from:2024-01-01,limit:7)')
+    cursor = encode_cursor({'mobile': '1', 'cr_date': '2024-01-07'})
+    follow_up = parse_filter(query.with_cursor(cursor))
+    assert (follow_up.date_from, follow_up.limit) == ('2024-01-01', 7)
+    assert follow_up.start_key == {'mobile': '1', 'cr_date': '2024-01-07'}
+    with pytest.raises(QueryError):
+        decode_cursor('not a cursor!')
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor!',
+    encode_cursor(1),
+    encode_cursor(['1', '2024-01-07']),
+    encode_cursor({'mobile': '2', 'cr_date': '2024-01-07'}),
+    encode_cursor({'mobile': '1', 'cr_date': 20240107}),
+])
+def test_invalid_cursor_is_rejected_while_parsing(cursor):
+    with pytest.raises(QueryError, match='Invalid cursor'):
+        parse_filter('filter(mobile:1,cursor:{})'.format(cursor))
+
+
+def test_users_may_only_query_their_own_history_unless_admin():
+    query = parse_filter('filter(mobile:7100000001)')
+    assert may_query(query, '917100000001', admins=frozenset())
+    assert not may_query(query, '917100000002', admins=frozenset())
+    assert may_query(query, '917100000002', admins=frozenset({'917100000002'}))
+
+
+def test_chunks_stay_under_the_limit():
+    chunks = list(chunk_messages(['aaaa', 'bb', 'c' * 12], 10))
+    assert chunks == ['aaaa\nbb', 'cccccccccc', 'cc']
+    assert all(len(chunk) <= 10 for chunk in chunks)
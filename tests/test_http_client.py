@@ -0,0 +1,80 @@
+import socket
+
+import pytest
+import requests
+
+from benchmarks.servers import _StubServer
+from http_client import PooledHttpClient
+
+
+class _ScriptedServer(_StubServer):
+    """
+    Answers every post with the same status, after the server's latency.
+    """
+    def __init__(self, status=200, latency_ms=0):
+        super().__init__(latency_ms)
+        self.status = status
+
+    def respond(self, path, headers, body):
+        return self.status, {}
+
+
+@pytest.fixture
+def server():
+    server = _ScriptedServer().start()
+    yield server
+    server.stop()
+
+
+def _client(url, **kwargs):
+    kwargs.setdefault('max_retries', 2)
+    return PooledHttpClient(url, backoff_factor=0, **kwargs)
+
+
+def _closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_post_is_not_retried_after_a_5xx(server):
+    server.status = 503
+    client = _client(server.url)
+    assert client.post('/chat').status_code == 503
+    assert server.requests == {'/chat': 1}
+    assert client.get_stats()['retries'] == 0
+
+
+def test_post_is_not_retried_after_a_read_timeout(server):
+    server.latency = 0.3
+    client = _client(server.url, read_timeout=0.05)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post('/chat')
+    assert client.get_stats()['retries'] == 0
+
+
+def test_post_is_retried_when_the_connection_cannot_be_made():
+    client = _client('http://127.0.0.1:{}'.format(_closed_port()))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('/chat')
+    # Never reached the server, so every attempt up to max_retries was safe to make
+    assert client.get_stats()['retries'] == 2
+
+
+def test_idempotent_call_is_retried_a_bounded_number_of_times(server):
+    server.status = 502
+    client = _client(server.url, max_retries=3)
+    assert client.post('/auth', idempotent=True).status_code == 502
+    assert server.requests == {'/auth': 4}
+    assert client.get_stats()['retries'] == 3
+
+    server.status = 200
+    assert client.post('/auth', idempotent=True).status_code == 200
+    assert client.get_stats()['retries'] == 3
+
+
+def test_counts_new_and_reused_connections(server):
+    client = _client(server.url)
+    for _ in range(3):
+        assert client.post('/chat').status_code == 200
+    assert client.get_stats() == {'requests': 3, 'reused': 2, 'new': 1, 'retries': 0}
@@ -0,0 +1,65 @@
+import idempotency
+import ttl_cache
+from idempotency import DONE, IdempotencyStore
+
+
+def test_duplicate_of_a_claimed_message_is_skipped(dynamodb):
+    store = IdempotencyStore('webhook_messages', lease=120)
+    assert store.claim('wamid.1')
+    assert not IdempotencyStore('webhook_messages', lease=120).claim('wamid.1')
+
+
+def test_redelivery_after_a_failed_attempt_takes_over_once_the_lease_runs_out(dynamodb):
+    # A lease that has already run out, as if the first attempt failed long enough ago
+    store = IdempotencyStore('webhook_messages', lease=-1)
+    assert store.claim('wamid.1')
+    # Never completed: the redelivery reaching the same container must not be answered from its cache
+    assert store.claim('wamid.1')
+
+
+def test_completed_message_is_skipped_without_a_dynamodb_call(dynamodb):
+    store = IdempotencyStore('webhook_messages', lease=-1)
+    assert store.claim('wamid.1')
+    store.complete('wamid.1')
+    table = dynamodb.Table('webhook_messages')
+    assert table.items[('wamid.1',)]['status'] == DONE
+    puts = table.calls['put_item']
+    assert not store.claim('wamid.1')
+    assert table.calls['put_item'] == puts
+    # Done messages are never taken over, even by a container that hasn't seen them
+    assert not IdempotencyStore('webhook_messages', lease=-1).claim('wamid.1')
+
+
+def test_filter_new_drops_duplicates(dynamodb):
+    store = IdempotencyStore('webhook_messages')
+    store.claim('wamid.1')
+    records = [{'m_id': 'wamid.1'}, {'m_id': 'wamid.2'}]
+    assert store.filter_new(records) == [{'m_id': 'wamid.2'}]
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+def test_redelivery_to_another_container_takes_over_after_the_lease(dynamodb, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(idempotency, 'time', clock)
+    monkeypatch.setattr(ttl_cache, 'time', clock)
+    first = IdempotencyStore('webhook_messages', lease=120)
+    second = IdempotencyStore('webhook_messages', lease=120)
+
+    assert first.claim('wamid.1')
+    # In progress on the first container: the second skips it
+    assert not second.claim('wamid.1')
+    clock.now += 60
+    assert not second.claim('wamid.1')
+    # The first attempt failed without completing; once its lease is over the second takes over
+    clock.now += 61
+    assert second.claim('wamid.1')
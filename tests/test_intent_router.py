@@ -0,0 +1,40 @@
+import intent_router
+from intent_router import IntentRouter, normalize
+
+REPLIES = {'Explore trips?': {'text': 'trips'}, 'Call a human?': {'text': 'call'}, 'Unused': None}
+
+
+def test_normalize_folds_case_space_and_trailing_punctuation():
+    assert normalize('  Explore   TRIPS?!  ') == 'explore trips'
+
+
+def test_routes_keywords_then_patterns_and_skips_empty_replies():
+    router = IntentRouter(REPLIES, {'hi': 'Explore trips?', 'x': 'Unused'},
+                          {r'(talk to|call) (a )?human': 'Call a human?'})
+    assert router.route('Hi!') == 'Explore trips?'
+    assert router.route('talk to a human') == 'Call a human?'
+    assert router.route('x') is None
+    assert router.route('how much is manali?') is None
+    assert router.get_stats() == {'lookups': 4, 'hits': 2, 'pattern_hits': 1, 'hit_rate': 0.5}
+
+
+def test_metrics_are_batched_until_flush(monkeypatch):
+    records = []
+    monkeypatch.setattr(intent_router, 'emit_metrics', lambda *record: records.append(record))
+    router = IntentRouter(REPLIES, {'hi': 'Explore trips?'}, flush_seconds=60)
+    for text in ('hi', 'hello there', 'hi'):
+        router.route(text)
+    router.flush()
+    assert records == []
+
+    router.flush(force=True)
+    (metrics, dimensions, properties), = records
+    assert metrics['IntentLookups'] == (3, 'Count') and metrics['IntentHits'] == (2, 'Count')
+    assert properties == {'intents': {'Explore trips?': 2}}
+
+    # Only what was counted since the last flush is emitted
+    router.route('hi')
+    router.flush(force=True)
+    assert records[1][0]['IntentLookups'] == (1, 'Count')
+    router.flush(force=True)
+    assert len(records) == 2
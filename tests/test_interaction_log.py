@@ -0,0 +1,32 @@
+import time
+
+from interaction_log import InteractionBuffer
+
+
+class _Store:
+    def __init__(self):
+        self.appended = {}
+
+    def append_interactions(self, mobile, date, interactions):
+        self.appended.setdefault(mobile, []).extend(interactions)
+        return len(self.appended[mobile])
+
+
+def test_flush_writes_one_append_per_conversation():
+    buffer, store = InteractionBuffer(), _Store()
+    buffer.record('1', 'text', 'hi', date='2024-01-01')
+    buffer.record('1', 'reply', 'hello', date='2024-01-01')
+    buffer.record('2', 'button', 'Explore trips?', date='2024-01-01')
+    buffer.flush(store)
+    assert [i['content'] for i in store.appended['1']] == ['hi', 'hello']
+    assert buffer.pending() == 0
+
+
+def test_conversations_left_at_the_deadline_stay_buffered_in_order():
+    buffer, store = InteractionBuffer(), _Store()
+    buffer.record('1', 'text', 'first', date='2024-01-01')
+    buffer.flush(store, deadline=time.monotonic() - 1)
+    assert store.appended == {}
+    buffer.record('1', 'text', 'second', date='2024-01-01')
+    buffer.flush(store, deadline=time.monotonic() + 60)
+    assert [i['content'] for i in store.appended['1']] == ['first', 'second']
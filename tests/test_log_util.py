@@ -0,0 +1,55 @@
+import json
+import logging
+
+import pytest
+
+import log_util
+from log_util import _SamplingRedactingFilter, redact
+
+
+@pytest.mark.parametrize('text', [
+    str({'headers': {'Authorization': 'Bearer s3cr3t'}}),
+    str({'Authorization': 'Basic s3cr3t'}),
+    str({'accessToken': 's3cr3t', 'mobile': '917100000001'}),
+    json.dumps({'access_token': 's3cr3t', 'mobile': '917100000001'}),
+    json.dumps({'secret_token': 's3cr3t'}),
+    'login ok access_token=s3cr3t&mobile=917100000001',
+    'secret_token = s3cr3t',
+    'Authorization: Bearer s3cr3t',
+    'calling smart chat with Bearer s3cr3t',
+])
+def test_tokens_are_masked(text):
+    redacted = redact(text)
+    assert 's3cr3t' not in redacted
+    assert '***' in redacted
+
+
+def test_other_fields_are_left_alone():
+    text = json.dumps({'mobile': '917100000001', 'message': 'plan a trip', 'token_count': 3})
+    assert redact(text) == text
+
+
+def _filter(record_filter, level, msg, *args):
+    record = logging.LogRecord('itt.test', level, __file__, 1, msg, args, None)
+    return record if record_filter.filter(record) else None
+
+
+def test_filter_redacts_and_truncates_the_formatted_message():
+    record_filter = _SamplingRedactingFilter({})
+    record = _filter(record_filter, logging.INFO, 'payload %s', {'accessToken': 's3cr3t'})
+    assert (record.msg, record.args) == ("payload {'accessToken': '***'}", None)
+
+    limit = log_util.LOG_MAX_LENGTH
+    record = _filter(record_filter, logging.INFO, 'reply %s', 'x' * limit)
+    assert record.getMessage() == 'reply ' + 'x' * (limit - 6) + '... [6 more chars]'
+
+
+def test_filter_samples_per_level(monkeypatch):
+    record_filter = _SamplingRedactingFilter({logging.DEBUG: 0.0, logging.INFO: 0.5})
+    assert _filter(record_filter, logging.DEBUG, 'dropped') is None
+    # Unlisted levels keep everything
+    assert _filter(record_filter, logging.WARNING, 'kept') is not None
+    monkeypatch.setattr(log_util.random, 'random', lambda: 0.49)
+    assert _filter(record_filter, logging.INFO, 'kept') is not None
+    monkeypatch.setattr(log_util.random, 'random', lambda: 0.5)
+    assert _filter(record_filter, logging.INFO, 'dropped') is None
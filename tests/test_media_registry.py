@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from media_registry import MediaRegistry
+
+
+@pytest.fixture
+def brochure(tmp_path):
+    path = tmp_path / 'manali.pdf'
+    path.write_bytes(b'%PDF manali')
+    return {'manali': {'filename': 'manali.pdf', 'source': str(path), 'fallback_id': 'fallback'}}
+
+
+def _uploader(uploads):
+    def upload(content, filename, mime_type):
+        uploads.append((filename, mime_type))
+        return 'media-{}'.format(len(uploads))
+    return upload
+
+
+def test_content_is_uploaded_once_across_containers(dynamodb, brochure):
+    uploads = []
+    first = MediaRegistry(brochure, _uploader(uploads), 'media_cache')
+    second = MediaRegistry(brochure, _uploader(uploads), 'media_cache')
+    assert first.refresh() == {'manali': 'uploaded'}
+    # The name item is gone, as in a container that sees the file for the first time
+    dynamodb.Table('media_cache').items.pop(('name:manali',))
+    assert second.refresh() == {'manali': 'linked'}
+    assert uploads == [('manali.pdf', 'application/pdf')]
+    assert second.media_id('manali') == 'media-1'
+
+
+def test_upload_held_by_another_container_is_not_repeated(dynamodb, brochure):
+    uploads = []
+    registry = MediaRegistry(brochure, _uploader(uploads), 'media_cache')
+    registry.refresh()
+    table = dynamodb.Table('media_cache')
+    content_key = next(key for (key,) in table.items if key.startswith('hash:'))
+    # Another container is re-uploading the (expiring) content right now
+    table.items[(content_key,)].update(expires_at=int(time.time()) - 1, upload_until=int(time.time()) + 60)
+    table.items.pop(('name:manali',))
+    assert registry.refresh() == {'manali': 'uploading'}
+    assert len(uploads) == 1
+
+
+def test_failed_upload_releases_the_lease(dynamodb, brochure):
+    def failing_upload(content, filename, mime_type):
+        raise RuntimeError('Graph API down')
+    registry = MediaRegistry(brochure, failing_upload, 'media_cache')
+    assert registry.refresh()['manali'].startswith('error')
+    uploads = []
+    assert MediaRegistry(brochure, _uploader(uploads), 'media_cache').refresh() == {'manali': 'uploaded'}
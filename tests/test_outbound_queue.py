@@ -0,0 +1,39 @@
+import time
+
+import graph_api
+from graph_api import OutboundQueue
+
+
+def test_rate_limited_chain_is_resent_only_after_its_back_off(monkeypatch):
+    monkeypatch.setattr(graph_api, 'GRAPH_RETRY_BASE_SECONDS', 0.1)
+    attempts = []
+
+    def send_chain(item):
+        attempts.append(time.monotonic())
+        # Rate limited twice, then sent
+        return dict(item, attempts=item['attempts'] + 1) if len(attempts) < 3 else None
+    monkeypatch.setattr(graph_api, 'send_chain', send_chain)
+
+    queue = OutboundQueue()
+    queue.submit('918000000001', [('{"type": "text"}', False)])
+    assert queue.flush(5)
+    assert len(attempts) == 3
+    # Waits of GRAPH_RETRY_BASE_SECONDS * 2^attempts: 0.2s, then 0.4s
+    assert attempts[1] - attempts[0] >= 0.2
+    assert attempts[2] - attempts[1] >= 0.4
+
+
+def test_chain_still_rate_limited_after_the_last_requeue_is_dropped(monkeypatch):
+    monkeypatch.setattr(graph_api, 'GRAPH_RETRY_BASE_SECONDS', 0.001)
+    monkeypatch.setattr(graph_api, 'OUTBOUND_MAX_REQUEUES', 2)
+    attempts = []
+
+    def send_chain(item):
+        attempts.append(item['attempts'])
+        return dict(item, attempts=item['attempts'] + 1)
+    monkeypatch.setattr(graph_api, 'send_chain', send_chain)
+
+    queue = OutboundQueue()
+    queue.submit('918000000001', [('{"type": "text"}', False)])
+    assert queue.flush(5)
+    assert attempts == [0, 1, 2]
@@ -0,0 +1,49 @@
+import pytest
+
+from rate_limiter import PAIR_RATE_LIMIT_CODE, RateGovernor, TokenBucket
+
+
+def test_bucket_spaces_reservations_once_the_burst_is_used():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == pytest.approx(0.5)
+    assert bucket.reserve(now) == pytest.approx(1.0)
+    # Refills at `rate`, never above capacity
+    assert bucket.reserve(now + 10) == 0
+    assert bucket.tokens == pytest.approx(1)
+
+
+def test_cancelled_reservation_is_handed_back():
+    bucket = TokenBucket(rate=1, capacity=1)
+    now = bucket.updated
+    bucket.reserve(now)
+    assert bucket.reserve(now) == pytest.approx(1.0)
+    bucket.cancel()
+    assert bucket.reserve(now) == pytest.approx(1.0)
+
+
+def test_pause_holds_back_for_the_given_time():
+    bucket = TokenBucket(rate=10, capacity=10)
+    now = bucket.updated
+    bucket.pause(2, now)
+    assert bucket.reserve(now) == pytest.approx(2.1)
+
+
+def test_governor_refuses_without_waiting_past_max_wait():
+    governor = RateGovernor(number_rate=100, number_burst=100, recipient_rate=1, recipient_burst=1)
+    assert governor.acquire('1000', '91700', max_wait=0) == 0
+    assert governor.acquire('1000', '91700', max_wait=0.1) is None
+    # Other recipients are unaffected, and the refused reservation was handed back
+    assert governor.acquire('1000', '91701', max_wait=0) == 0
+    assert governor.acquire('1000', '91700', max_wait=0.1) is None
+
+
+def test_pair_rate_limit_backs_off_only_that_recipient():
+    governor = RateGovernor(number_rate=100, number_burst=100, recipient_rate=100, recipient_burst=100)
+    governor.back_off('1000', '91700', PAIR_RATE_LIMIT_CODE, 60)
+    assert governor.acquire('1000', '91700', max_wait=1) is None
+    assert governor.acquire('1000', '91701', max_wait=0) == 0
+    governor.back_off('1000', '91701', 130429, 60)
+    assert governor.acquire('1000', '91702', max_wait=1) is None
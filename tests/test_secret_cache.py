@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+import secret_cache
+from secret_cache import SecretCache, SecretUnavailableError
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class _Source:
+    """
+    A secret source whose fetches can be held back and made to fail.
+    """
+    def __init__(self):
+        self.value = 'v1'
+        self.error = None
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.started = threading.Event()
+        self.done = threading.Event()
+
+    def fetch(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        try:
+            if self.error:
+                raise self.error
+            return self.value
+        finally:
+            self.done.set()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(secret_cache, 'time', clock)
+    return clock
+
+
+def test_stale_value_is_served_while_one_background_refresh_runs(clock):
+    source = _Source()
+    cache = SecretCache('smart-chat', source.fetch, ttl=60, stale_ttl=300)
+    assert cache.get() == 'v1'
+    clock.now += 30
+    assert cache.get() == 'v1'
+    assert source.calls == 1
+
+    clock.now += 60
+    source.value = 'v2'
+    source.release.clear()
+    source.started.clear()
+    source.done.clear()
+    # The refresh is held back: every caller still gets the stale value, and only one refresh starts
+    assert cache.get() == 'v1'
+    assert source.started.wait(5)
+    assert [cache.get() for _ in range(3)] == ['v1'] * 3
+    assert source.calls == 2
+    source.release.set()
+    assert source.done.wait(5)
+    deadline = time.monotonic() + 5
+    while cache._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get() == 'v2'
+    assert source.calls == 2
+
+
+def test_failed_background_refresh_keeps_the_stale_value_until_the_window_ends(clock):
+    source = _Source()
+    cache = SecretCache('smart-chat', source.fetch, ttl=60, stale_ttl=300)
+    cache.get()
+    source.error = RuntimeError('ParameterNotFound')
+    source.done.clear()
+    clock.now += 120
+    assert cache.get() == 'v1'
+    assert source.done.wait(5)
+
+    clock.now += 300
+    with pytest.raises(SecretUnavailableError, match='smart-chat'):
+        cache.get()
+
+
+def test_first_fetch_failure_raises(clock):
+    source = _Source()
+    source.error = RuntimeError('AccessDenied')
+    with pytest.raises(SecretUnavailableError):
+        SecretCache('smart-chat', source.fetch, ttl=60, stale_ttl=300).get()
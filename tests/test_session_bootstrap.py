@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+import conversation_store
+import conversation_util
+from conversation_store import SqliteConversationStore
+from transport import InvokeResult
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = SqliteConversationStore(':memory:', ttl_days=0)
+    monkeypatch.setattr(conversation_store, '_store', store)
+    monkeypatch.setattr(conversation_util, 'TOKEN_STORE_ENABLED', False)
+    conversation_util.session_cache.clear()
+    return store
+
+
+def _musafir(calls):
+    def call_musafir(payload):
+        calls.append(payload['method'])
+        if payload['method'] == 'login_for_whatsapp':
+            return InvokeResult(True, 200, {'accessToken': 'token-1'})
+        return InvokeResult(True, 200, {'content': 'Hello!'})
+    return call_musafir
+
+
+def test_failed_conversation_write_releases_the_bootstrap_claim(store, monkeypatch):
+    calls = []
+    monkeypatch.setattr(conversation_util, 'call_musafir', _musafir(calls))
+
+    def failing_set_session(*args, **kwargs):
+        raise RuntimeError('store unavailable')
+    monkeypatch.setattr(store, 'set_session', failing_set_session)
+
+    response = conversation_util.find_conversation_and_communicate('917000000001', 'A', 'hi')
+    assert not response['success']
+    # The next message can bootstrap again right away instead of waiting out the stale claim
+    today = datetime.now().strftime('%Y-%m-%d')
+    assert conversation_util.claim_conversation('917000000001', 'A', today, 'next') is True
+
+
+def test_first_message_logs_in_and_starts_a_chat(store, monkeypatch):
+    calls = []
+    monkeypatch.setattr(conversation_util, 'call_musafir', _musafir(calls))
+
+    response = conversation_util.find_conversation_and_communicate('917000000001', 'A', 'hi')
+    assert response == {'success': True, 'status_code': 200, 'content': 'Hello!'}
+    assert calls == ['login_for_whatsapp', 'start_chat']
+    today = datetime.now().strftime('%Y-%m-%d')
+    assert store.get('917000000001', today)['access_token'] == 'token-1'
+
+
+def test_token_is_stored_only_after_start_chat_succeeds(store, monkeypatch):
+    stored = []
+    monkeypatch.setattr(conversation_util, 'TOKEN_STORE_ENABLED', True)
+    monkeypatch.setattr(conversation_util.token_store, 'put',
+                        lambda mobile, name, token: stored.append(token) or {'expires_at': None})
+
+    def call_musafir(payload):
+        if payload['method'] == 'login_for_whatsapp':
+            return InvokeResult(True, 200, {'accessToken': 'token-1'})
+        return InvokeResult(False, 500, message='start_chat failed')
+    monkeypatch.setattr(conversation_util, 'call_musafir', call_musafir)
+    monkeypatch.setattr(conversation_util.token_store, 'get', lambda mobile: None)
+
+    response = conversation_util.find_conversation_and_communicate('917000000001', 'A', 'hi')
+    assert not response['success']
+    assert stored == []
+
+
+def test_rejected_token_is_not_deleted_from_a_disabled_token_store(store, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(conversation_util.token_store, 'invalidate', lambda *args: invalidated.append(args))
+    conversation_util.forget_token('917000000001', '2024-01-01', 'token-1')
+    assert invalidated == []
@@ -0,0 +1,32 @@
+"""
+Each Lambda is deployed from its own directory, so modules both need (tracing, log_util,
+aws_clients, warmup) are kept as identical copies. A change made to one copy only would
+silently behave differently in the other Lambda; this fails instead.
+"""
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECEIVER = os.path.join(ROOT, 'whatsapp_receiver')
+MUSAFIR = os.path.join(ROOT, 'musafir-interface')
+# Present in both directories but different by design
+ENTRY_POINTS = {'lambda_function.py'}
+
+SHARED_MODULES = sorted(name for name in set(os.listdir(RECEIVER)) & set(os.listdir(MUSAFIR))
+                        if name.endswith('.py') and name not in ENTRY_POINTS)
+
+
+def _read(directory, name):
+    with open(os.path.join(directory, name), 'rb') as f:
+        return f.read()
+
+
+def test_shared_modules_are_found():
+    assert {'aws_clients.py', 'log_util.py', 'tracing.py', 'warmup.py'} <= set(SHARED_MODULES)
+
+
+@pytest.mark.parametrize('name', SHARED_MODULES)
+def test_shared_module_copies_are_identical(name):
+    assert _read(RECEIVER, name) == _read(MUSAFIR, name), \
+        '{} differs between whatsapp_receiver and musafir-interface; change both copies'.format(name)
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from conftest import LambdaContext, text_message
+
+QUEUE_URL = 'https://sqs.local/whatsapp_events'
+
+
+@pytest.fixture
+def receiver(local_env, monkeypatch):
+    receiver = local_env.receiver
+    monkeypatch.setattr(receiver, 'INGEST_QUEUE_URL', QUEUE_URL)
+    monkeypatch.setattr(receiver, 'IDEMPOTENCY_ENABLED', False)
+    local_env.sqs.drain(QUEUE_URL)
+    return receiver
+
+
+def _record(mobile, m_id, content='plan a trip'):
+    return {'mobile': mobile, 'c_name': 'Test User', 'm_id': m_id, 'timestamp': '1700000000', 'type': 'text',
+            'content': content}
+
+
+def _fail_on(receiver, monkeypatch, *failing):
+    processed = []
+
+    def process_record(record, turn_follows=False):
+        if record['m_id'] in failing:
+            raise RuntimeError('musafir-interface unavailable')
+        processed.append(record['m_id'])
+    monkeypatch.setattr(receiver, 'process_record', process_record)
+    return processed
+
+
+def test_partial_failure_reports_the_failed_record_and_the_rest_of_that_user(local_env, receiver, monkeypatch):
+    records = [_record('918000000011', 'wamid.a1'), _record('918000000011', 'wamid.a2'),
+               _record('918000000012', 'wamid.b1'), _record('918000000011', 'wamid.a3')]
+    assert receiver.push_events(records) == []
+    sqs_records = local_env.sqs.drain(QUEUE_URL)
+    message_ids = {json.loads(r['body'])['m_id']: r['messageId'] for r in sqs_records}
+    processed = _fail_on(receiver, monkeypatch, 'wamid.a2')
+
+    result = receiver.sqs_worker_handler({'Records': sqs_records}, LambdaContext())
+    # a3 is retried with a2 so the user's messages stay in order; the other user is unaffected
+    assert result == {'batchItemFailures': [{'itemIdentifier': message_ids['wamid.a2']},
+                                            {'itemIdentifier': message_ids['wamid.a3']}]}
+    assert processed == ['wamid.a1', 'wamid.b1']
+
+
+def test_malformed_body_is_dropped_rather_than_retried(local_env, receiver, monkeypatch):
+    receiver.push_events([_record('918000000013', 'wamid.c1')])
+    sqs_records = [{'messageId': 'garbled', 'body': '{"mobile": '}] + local_env.sqs.drain(QUEUE_URL)
+    processed = _fail_on(receiver, monkeypatch)
+
+    assert receiver.sqs_worker_handler({'Records': sqs_records}, LambdaContext()) == {'batchItemFailures': []}
+    assert processed == ['wamid.c1']
+
+
+def test_records_rejected_by_send_message_batch_are_processed_inline(local_env, receiver, monkeypatch):
+    monkeypatch.setattr(receiver, 'INGEST_MODE', 'sqs')
+    sqs = local_env.sqs
+    send_message_batch = sqs.send_message_batch
+
+    def reject_second(QueueUrl, Entries):
+        response = send_message_batch(QueueUrl, [entry for entry in Entries if entry['Id'] != '1'])
+        response['Failed'] = [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError'}]
+        return response
+    monkeypatch.setattr(sqs, 'send_message_batch', reject_second)
+    processed = _fail_on(receiver, monkeypatch)
+
+    event = local_env.webhook([text_message('918000000014', 'plan a trip', 'wamid.d1'),
+                               text_message('918000000015', 'plan a trip', 'wamid.d2')])
+    assert receiver.lambda_handler(event, LambdaContext()) == {'statusCode': 200, 'body': 'ok'}
+    assert processed == ['wamid.d2']
+    assert [json.loads(r['body'])['m_id'] for r in sqs.drain(QUEUE_URL)] == ['wamid.d1']
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from turn_coalescer import DynamoTurnStore, LocalTurnStore, TurnCoalescer
+
+
+@pytest.fixture(params=['local', 'dynamodb'])
+def store(request):
+    if request.param == 'local':
+        return LocalTurnStore(ttl=300)
+    request.getfixturevalue('dynamodb')
+    return DynamoTurnStore('pending_turns', ttl=300)
+
+
+def test_messages_within_the_window_are_sent_once_by_the_last(store):
+    coalescer = TurnCoalescer(store, window_ms=0, max_messages=5)
+    assert coalescer.coalesce('1', 'hi', wait=False) is None
+    assert coalescer.coalesce('1', 'want trip', wait=False) is None
+    assert coalescer.coalesce('1', 'to manali') == 'hi\nwant trip\nto manali'
+    # Nothing is left over for the next turn
+    assert coalescer.coalesce('1', 'thanks') == 'thanks'
+
+
+def test_older_message_leaves_the_turn_to_the_newer_one(store):
+    seq, _ = store.append('1', 'hi')
+    store.append('1', 'there')
+    assert store.take('1', seq) is None
+    assert store.take('1', seq + 1) == ['hi', 'there']
+
+
+def test_expired_item_not_yet_deleted_by_ttl_starts_a_new_turn(dynamodb):
+    store = DynamoTurnStore('pending_turns', ttl=300)
+    # A handler died after appending; TTL has expired the item but not deleted it yet
+    dynamodb.Table('pending_turns').put_item(Item={'mobile': '1', 'seq': 4, 'messages': ['stale'],
+                                                  'expires_at': int(time.time()) - 10})
+    seq, count = store.append('1', 'hello')
+    assert (seq, count) == (5, 1)
+    assert store.take('1', seq) == ['hello']
+
+
+def test_expired_local_turn_starts_a_new_turn():
+    store = LocalTurnStore(ttl=0)
+    store.append('1', 'stale')
+    time.sleep(0.01)
+    seq, count = store.append('1', 'hello')
+    assert count == 1
+    assert store.take('1', seq) == ['hello']
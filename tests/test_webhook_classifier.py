@@ -0,0 +1,47 @@
+import json
+
+from webhook_classifier import StatusCounter, iter_messages, may_have_messages
+
+
+def _webhook(value):
+    return {'object': 'whatsapp_business_account', 'entry': [{'id': '1', 'changes': [
+        {'field': 'messages', 'value': dict({'messaging_product': 'whatsapp',
+                                             'metadata': {'phone_number_id': '1000'}}, **value)}]}]}
+
+
+STATUS_BODY = _webhook({'statuses': [{'id': 'wamid.1', 'status': 'delivered', 'timestamp': '1',
+                                      'recipient_id': '917000000001'}]})
+MESSAGE_BODY = _webhook({'contacts': [{'profile': {'name': 'A'}, 'wa_id': '917000000001'}],
+                         'messages': [{'from': '917000000001', 'id': 'wamid.2', 'type': 'text',
+                                       'text': {'body': 'hi'}}]})
+
+
+def test_status_callback_takes_the_fast_path():
+    # Every change carries "field": "messages"; that alone must not force a parse
+    assert not may_have_messages(json.dumps(STATUS_BODY))
+    assert not may_have_messages(json.dumps(STATUS_BODY, indent=2))
+
+
+def test_message_body_is_parsed():
+    assert may_have_messages(json.dumps(MESSAGE_BODY))
+    assert may_have_messages(json.dumps(MESSAGE_BODY, separators=(',', ':')))
+    assert may_have_messages(json.dumps(MESSAGE_BODY, indent=2))
+
+
+def test_iter_messages_reads_every_change_and_maps_names_per_sender():
+    body = {'entry': [
+        {'changes': [{'value': {'contacts': [{'wa_id': '1', 'profile': {'name': 'A'}},
+                                             {'wa_id': '2', 'profile': {'name': 'B'}}],
+                                'messages': [{'from': '2'}, {'from': '1'}]}},
+                     {'value': {'statuses': [{'status': 'read'}]}}]},
+        {'changes': [{'value': {'messages': [{'from': '3'}]}}]},
+    ]}
+    assert [(m['from'], name) for m, name in iter_messages(body)] == [('2', 'B'), ('1', 'A'), ('3', None)]
+
+
+def test_status_counter_counts_statuses_from_the_raw_body():
+    counter = StatusCounter(flush_seconds=60)
+    counter.add('{"statuses":[{"status": "read"},{"status":"delivered"},{"status":"read"}]}')
+    assert counter.counts == {'read': 2, 'delivered': 1}
+    counter.flush(force=True)
+    assert counter.counts == {}
@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+
+from conftest import LambdaContext, text_message
+
+
+def test_concurrent_webhook_flushes_only_within_the_webhook_deadline(local_env, monkeypatch):
+    receiver = local_env.receiver
+    monkeypatch.setattr(receiver, 'WEBHOOK_EXECUTION_MODE', 'concurrent')
+    monkeypatch.setattr(receiver, 'WEBHOOK_DEADLINE_MS', 300)
+    monkeypatch.setattr(receiver, 'IDEMPOTENCY_ENABLED', False)
+    flushes = []
+    monkeypatch.setattr(receiver.outbound_queue, 'flush', lambda timeout: flushes.append(timeout) or True)
+    release, sent = threading.Event(), []
+    monkeypatch.setattr(receiver, 'send_msg', lambda msg, fragment=None: sent.append(msg))
+
+    def slow_chat(mobile, name, text):
+        release.wait(5)
+        return {'success': True, 'content': 'ok'}
+    monkeypatch.setattr(receiver, 'find_conversation_and_communicate', slow_chat)
+
+    event = local_env.webhook([text_message('918000000001', 'plan a trip', 'wamid.deadline.1'),
+                               text_message('918000000002', 'plan a trip', 'wamid.deadline.2')])
+    started = time.monotonic()
+    # Plenty of invocation time left: only the webhook budget may bound the flushes
+    assert receiver.lambda_handler(event, LambdaContext(60000)) == {'statusCode': 200, 'body': 'ok'}
+    assert time.monotonic() - started < 0.6
+    assert all(timeout <= 0.3 for timeout in flushes)
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while len(sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_document_follow_up_goes_to_the_sqs_worker_when_configured(local_env, monkeypatch):
+    receiver, graph_api = local_env.receiver, local_env.graph_api
+    queue_url = 'https://sqs.local/outbound'
+    monkeypatch.setattr(receiver, 'deferred_queue', graph_api.SqsOutboundQueue(queue_url))
+    sent_before = local_env.graph.requests.get('/v19.0/1000/messages', 0)
+
+    receiver.send_msg({'mobile': '918000000003', 'document': 'media-1', 'filename': 'kasol.pdf'})
+    # The document went out inline; its follow-up waits for outbound_worker_handler
+    assert local_env.graph.requests.get('/v19.0/1000/messages', 0) == sent_before + 1
+    (record,) = local_env.sqs.drain(queue_url)
+    item = json.loads(record['body'])
+    assert item['mobile'] == '918000000003' and len(item['chain']) == 1
+    assert item['message_id']
+
+
+def test_history_query_with_a_bad_cursor_is_a_400_with_a_reply(local_env, monkeypatch):
+    receiver = local_env.receiver
+    sent = []
+    monkeypatch.setattr(receiver, 'send_msg', lambda msg, fragment=None: sent.append(msg))
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'q': 'filter(mobile:7100000001,cursor:MQ)'}}
+    assert receiver.lambda_handler(event, None)['statusCode'] == 400
+
+    receiver.query_result({'query': 'filter(mobile:8000000004,cursor:MQ)', 'source': 'whatsapp',
+                           'to_mobile': '918000000004', 'msg_id': 'wamid.cursor.1'})
+    assert [msg['text'] for msg in sent] == ['Invalid cursor']
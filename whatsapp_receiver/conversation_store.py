@@ -0,0 +1,473 @@
+"""
+Storage for the per-day conversation entries, keyed by (mobile, cr_date).
+
+`ConversationStore` is the interface the rest of the receiver uses. `DynamoConversationStore`
+keeps the entries in the DynamoDB `conversation` table; `SqliteConversationStore` keeps them
+in SQLite (in memory by default) for local runs and benchmarks without AWS. CONVERSATION_STORE
+picks the implementation.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from aws_clients import error_code, get_resource
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# 'dynamodb' or 'sqlite'
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'dynamodb')
+CONVERSATION_TABLE = os.getenv('CONVERSATION_TABLE', 'conversation')
+CONVERSATION_SQLITE_PATH = os.getenv('CONVERSATION_SQLITE_PATH', ':memory:')
+# Days an entry is kept after its cr_date; DynamoDB TTL on `expires_at` deletes it afterwards (0 = keep forever)
+CONVERSATION_TTL_DAYS = int(os.getenv('CONVERSATION_TTL_DAYS', '0'))
+# Keys per BatchGetItem request, and rounds spent retrying unprocessed keys
+BATCH_GET_SIZE = 100
+BATCH_GET_ATTEMPTS = 3
+
+# Read projections: just the chat session, or the whole entry with its interactions
+TOKEN = 'token'
+FULL = 'full'
+TOKEN_FIELDS = ('access_token', 'token_expires_at')
+
+
+def entry_expiry(date, ttl_days=CONVERSATION_TTL_DAYS):
+    """
+    Returns the epoch seconds after which the entry for `date` (YYYY-MM-DD) may be deleted,
+    or None if entries don't expire.
+    """
+    if not ttl_days:
+        return None
+    return int(datetime.strptime(date, '%Y-%m-%d').timestamp()) + ttl_days * 86400
+
+
+class ConversationStore(ABC):
+    """
+    The conversation entries of each user, one per day.
+
+    Reads return dicts with DynamoDB attribute names and None when there is no entry. Writes
+    raise on storage errors; conditional writes return False when their condition fails.
+    """
+    @abstractmethod
+    def get(self, mobile, date, projection=FULL, consistent=False):
+        """
+        Returns the entry for `mobile` on `date`: only its TOKEN_FIELDS with `projection=TOKEN`,
+        everything including the interactions with FULL. `consistent` asks for a strongly
+        consistent read.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def batch_get(self, mobiles, date, projection=TOKEN, consistent=False):
+        """
+        Returns {mobile: entry} for those of `mobiles` that have an entry on `date`.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim(self, mobile, name, date, claim_id, now, stale_before):
+        """
+        Marks the entry as being bootstrapped by `claim_id`, unless it has a live token or a
+        claim made at or after `stale_before`. Returns whether the claim was won.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_claim(self, mobile, date, claim_id):
+        """
+        Drops the claim if `claim_id` still holds it. Returns whether it did.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_session(self, mobile, name, date, access_token, expires_at=None):
+        """
+        Stores the chat session on the entry (creating it if needed) and clears any claim.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_token(self, mobile, date, access_token):
+        """
+        Marks the entry's token as expired if it is still `access_token`. Returns whether it did.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_interactions(self, mobile, date, interactions):
+        """
+        Appends `interactions` to the entry and returns its new interaction count.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def trim_interactions(self, mobile, date, count, keep):
+        """
+        Removes the oldest interactions so `keep` remain, if the entry still holds `count`.
+        Returns whether it did.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def query_history(self, mobile, date_from=None, date_to=None, limit=None, newest_first=False, start_key=None):
+        """
+        Reads up to `limit` entries of `mobile` with `cr_date` between the inclusive bounds,
+        projected to `cr_date` and `interactions`.
+
+        Returns:
+        - (entries, last_key); `last_key` is set when more entries may follow and is passed
+          back as `start_key` to resume
+        """
+        raise NotImplementedError
+
+
+class DynamoConversationStore(ConversationStore):
+    """
+    Entries in a DynamoDB table with partition key `mobile`, sort key `cr_date` and TTL
+    enabled on `expires_at`.
+    """
+    def __init__(self, table_name=CONVERSATION_TABLE, ttl_days=CONVERSATION_TTL_DAYS):
+        self.table_name = table_name
+        self.ttl_days = ttl_days
+
+    def table(self):
+        # The DynamoDB resource is created on first use, keeping boto3 out of the cold start
+        return get_resource('dynamodb').Table(self.table_name)
+
+    def _with_expiry(self, date, assignments, values, removals=()):
+        """
+        Builds an UpdateExpression from SET `assignments` and REMOVE `removals`. Every write
+        refreshes the TTL attribute, so it is set on entries created by any of them.
+        """
+        expiry = entry_expiry(date, self.ttl_days)
+        if expiry is not None:
+            assignments = ['expires_at = :entry_expires_at'] + list(assignments)
+            values[':entry_expires_at'] = expiry
+        update = 'SET ' + ', '.join(assignments)
+        if removals:
+            update += ' REMOVE ' + ', '.join(removals)
+        return update
+
+    @staticmethod
+    def _projection(projection):
+        return {'ProjectionExpression': ', '.join(TOKEN_FIELDS)} if projection == TOKEN else {}
+
+    def get(self, mobile, date, projection=FULL, consistent=False):
+        response = self.table().get_item(Key={'mobile': mobile, 'cr_date': date}, ConsistentRead=consistent,
+                                         **self._projection(projection))
+        return response.get('Item')
+
+    def batch_get(self, mobiles, date, projection=TOKEN, consistent=False):
+        found = {}
+        mobiles = list(dict.fromkeys(mobiles))
+        # The key attributes come back too, to tell the entries apart
+        fields = {'ProjectionExpression': 'mobile, ' + ', '.join(TOKEN_FIELDS)} if projection == TOKEN else {}
+        for start in range(0, len(mobiles), BATCH_GET_SIZE):
+            request = {self.table_name: dict(fields, ConsistentRead=consistent, Keys=[
+                {'mobile': mobile, 'cr_date': date} for mobile in mobiles[start:start + BATCH_GET_SIZE]])}
+            for _ in range(BATCH_GET_ATTEMPTS):
+                response = get_resource('dynamodb').batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    found[item['mobile']] = item
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+            else:
+                logger.warning("Batch read left %s conversations unread", len(request[self.table_name]['Keys']))
+        return found
+
+    def claim(self, mobile, name, date, claim_id, now, stale_before):
+        values = {':name': name, ':claim_id': claim_id, ':now': now, ':stale': stale_before}
+        try:
+            # An update (rather than a put) keeps any interactions already logged on the entry
+            self.table().update_item(
+                Key={'mobile': mobile, 'cr_date': date},
+                UpdateExpression=self._with_expiry(
+                    date, ['#name = :name', 'claim_id = :claim_id', 'claimed_at = :now'], values),
+                ConditionExpression='attribute_not_exists(mobile) OR '
+                                    '((attribute_not_exists(access_token) OR token_expires_at < :now) AND '
+                                    '(attribute_not_exists(claimed_at) OR claimed_at < :stale))',
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues=values
+            )
+            return True
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def release_claim(self, mobile, date, claim_id):
+        try:
+            self.table().update_item(
+                Key={'mobile': mobile, 'cr_date': date},
+                UpdateExpression='REMOVE claim_id, claimed_at',
+                ConditionExpression='claim_id = :claim_id',
+                ExpressionAttributeValues={':claim_id': claim_id}
+            )
+            return True
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def set_session(self, mobile, name, date, access_token, expires_at=None):
+        values = {':name': name, ':access_token': access_token}
+        assignments = ['#name = :name', 'access_token = :access_token']
+        if expires_at is not None:
+            assignments.append('token_expires_at = :expires_at')
+            values[':expires_at'] = expires_at
+        self.table().update_item(
+            Key={'mobile': mobile, 'cr_date': date},
+            UpdateExpression=self._with_expiry(date, assignments, values, removals=['claim_id', 'claimed_at']),
+            ExpressionAttributeNames={'#name': 'name'},
+            ExpressionAttributeValues=values
+        )
+
+    def expire_token(self, mobile, date, access_token):
+        try:
+            self.table().update_item(
+                Key={'mobile': mobile, 'cr_date': date},
+                UpdateExpression='SET token_expires_at = :expired',
+                ConditionExpression='access_token = :token',
+                ExpressionAttributeValues={':expired': 0, ':token': access_token}
+            )
+            return True
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def append_interactions(self, mobile, date, interactions):
+        values = {':empty': [], ':new': interactions, ':zero': 0, ':n': len(interactions)}
+        response = self.table().update_item(
+            Key={'mobile': mobile, 'cr_date': date},
+            UpdateExpression=self._with_expiry(
+                date, ['interactions = list_append(if_not_exists(interactions, :empty), :new)',
+                       'interaction_count = if_not_exists(interaction_count, :zero) + :n'], values),
+            ExpressionAttributeValues=values,
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['interaction_count'])
+
+    def trim_interactions(self, mobile, date, count, keep):
+        # The condition makes a concurrent flush that already trimmed this entry skip it
+        removals = ', '.join('interactions[{}]'.format(i) for i in range(count - keep))
+        try:
+            self.table().update_item(
+                Key={'mobile': mobile, 'cr_date': date},
+                UpdateExpression='REMOVE {} SET interaction_count = :kept'.format(removals),
+                ConditionExpression='interaction_count = :count',
+                ExpressionAttributeValues={':kept': keep, ':count': count}
+            )
+            return True
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def query_history(self, mobile, date_from=None, date_to=None, limit=None, newest_first=False, start_key=None):
+        # Imported here so only history queries pay for loading boto3
+        from boto3.dynamodb.conditions import Key
+
+        condition = Key('mobile').eq(mobile)
+        if date_from and date_to:
+            condition = condition & Key('cr_date').between(date_from, date_to)
+        elif date_from:
+            condition = condition & Key('cr_date').gte(date_from)
+        elif date_to:
+            condition = condition & Key('cr_date').lte(date_to)
+
+        params = {'KeyConditionExpression': condition, 'ProjectionExpression': 'cr_date, interactions',
+                  'ScanIndexForward': not newest_first}
+        if limit:
+            params['Limit'] = limit
+        if start_key:
+            params['ExclusiveStartKey'] = start_key
+        response = self.table().query(**params)
+        return response.get('Items', []), response.get('LastEvaluatedKey')
+
+
+class SqliteConversationStore(ConversationStore):
+    """
+    Entries in a SQLite table, in memory unless `path` names a file. Expired entries are
+    invisible to reads and deleted by `purge_expired`. Meant for local runs and benchmarks:
+    a single connection is shared by all threads behind a lock.
+    """
+    def __init__(self, path=CONVERSATION_SQLITE_PATH, ttl_days=CONVERSATION_TTL_DAYS):
+        self.ttl_days = ttl_days
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS conversation ('
+            ' mobile TEXT NOT NULL, cr_date TEXT NOT NULL, name TEXT, access_token TEXT,'
+            ' token_expires_at INTEGER, claim_id TEXT, claimed_at INTEGER,'
+            " interactions TEXT NOT NULL DEFAULT '[]', interaction_count INTEGER NOT NULL DEFAULT 0,"
+            ' expires_at INTEGER, PRIMARY KEY (mobile, cr_date))'
+        )
+
+    def _columns(self, projection):
+        if projection == TOKEN:
+            return ('mobile',) + TOKEN_FIELDS
+        return ('mobile', 'cr_date', 'name', 'access_token', 'token_expires_at', 'claim_id', 'claimed_at',
+                'interactions', 'interaction_count')
+
+    @staticmethod
+    def _entry(columns, row):
+        entry = {column: value for column, value in zip(columns, row) if value is not None}
+        if 'interactions' in entry:
+            entry['interactions'] = json.loads(entry['interactions'])
+        return entry
+
+    def _live(self):
+        return '(expires_at IS NULL OR expires_at > {})'.format(int(time.time()))
+
+    def _ensure(self, mobile, date):
+        # Creates the entry if needed; like the DynamoDB writes, refreshes its expiry either way
+        self._db.execute('INSERT INTO conversation (mobile, cr_date, expires_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT (mobile, cr_date) DO UPDATE SET expires_at = excluded.expires_at',
+                         (mobile, date, entry_expiry(date, self.ttl_days)))
+
+    def get(self, mobile, date, projection=FULL, consistent=False):
+        # A single local database is always consistent
+        columns = self._columns(projection)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT {} FROM conversation WHERE mobile = ? AND cr_date = ? AND {}'.format(
+                    ', '.join(columns), self._live()), (mobile, date)).fetchone()
+        return self._entry(columns, row) if row else None
+
+    def batch_get(self, mobiles, date, projection=TOKEN, consistent=False):
+        mobiles = list(dict.fromkeys(mobiles))
+        if not mobiles:
+            return {}
+        columns = self._columns(projection)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT {} FROM conversation WHERE cr_date = ? AND mobile IN ({}) AND {}'.format(
+                    ', '.join(columns), ', '.join('?' * len(mobiles)), self._live()), [date] + mobiles).fetchall()
+        return {row[0]: self._entry(columns, row) for row in rows}
+
+    def claim(self, mobile, name, date, claim_id, now, stale_before):
+        with self._lock:
+            self._ensure(mobile, date)
+            cursor = self._db.execute(
+                'UPDATE conversation SET name = ?, claim_id = ?, claimed_at = ? '
+                'WHERE mobile = ? AND cr_date = ? AND (access_token IS NULL OR token_expires_at < ?) '
+                'AND (claimed_at IS NULL OR claimed_at < ?)',
+                (name, claim_id, now, mobile, date, now, stale_before))
+            return cursor.rowcount == 1
+
+    def release_claim(self, mobile, date, claim_id):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE conversation SET claim_id = NULL, claimed_at = NULL '
+                'WHERE mobile = ? AND cr_date = ? AND claim_id = ?', (mobile, date, claim_id))
+            return cursor.rowcount == 1
+
+    def set_session(self, mobile, name, date, access_token, expires_at=None):
+        with self._lock:
+            self._ensure(mobile, date)
+            self._db.execute(
+                'UPDATE conversation SET name = ?, access_token = ?, '
+                'token_expires_at = COALESCE(?, token_expires_at), claim_id = NULL, claimed_at = NULL '
+                'WHERE mobile = ? AND cr_date = ?', (name, access_token, expires_at, mobile, date))
+
+    def expire_token(self, mobile, date, access_token):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE conversation SET token_expires_at = 0 WHERE mobile = ? AND cr_date = ? AND access_token = ?',
+                (mobile, date, access_token))
+            return cursor.rowcount == 1
+
+    def append_interactions(self, mobile, date, interactions):
+        with self._lock:
+            self._ensure(mobile, date)
+            self._db.execute('BEGIN')
+            try:
+                stored, count = self._db.execute(
+                    'SELECT interactions, interaction_count FROM conversation WHERE mobile = ? AND cr_date = ?',
+                    (mobile, date)).fetchone()
+                count += len(interactions)
+                self._db.execute(
+                    'UPDATE conversation SET interactions = ?, interaction_count = ? WHERE mobile = ? AND cr_date = ?',
+                    (json.dumps(json.loads(stored) + interactions), count, mobile, date))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return count
+
+    def trim_interactions(self, mobile, date, count, keep):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT interactions FROM conversation WHERE mobile = ? AND cr_date = ? AND interaction_count = ?',
+                (mobile, date, count)).fetchone()
+            if row is None:
+                return False
+            self._db.execute(
+                'UPDATE conversation SET interactions = ?, interaction_count = ? WHERE mobile = ? AND cr_date = ?',
+                (json.dumps(json.loads(row[0])[count - keep:]), keep, mobile, date))
+            return True
+
+    def query_history(self, mobile, date_from=None, date_to=None, limit=None, newest_first=False, start_key=None):
+        clauses, params = ['mobile = ?', self._live()], [mobile]
+        if date_from:
+            clauses.append('cr_date >= ?')
+            params.append(date_from)
+        if date_to:
+            clauses.append('cr_date <= ?')
+            params.append(date_to)
+        if start_key:
+            clauses.append('cr_date < ?' if newest_first else 'cr_date > ?')
+            params.append(start_key['cr_date'])
+        sql = 'SELECT cr_date, interactions FROM conversation WHERE {} ORDER BY cr_date {}'.format(
+            ' AND '.join(clauses), 'DESC' if newest_first else 'ASC')
+        if limit:
+            # One extra row tells whether another page follows
+            sql += ' LIMIT {}'.format(int(limit) + 1)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        entries = [self._entry(('cr_date', 'interactions'), row) for row in rows[:limit]]
+        last_key = None
+        if limit and len(rows) > limit:
+            last_key = {'mobile': mobile, 'cr_date': entries[-1]['cr_date']}
+        return entries, last_key
+
+    def purge_expired(self):
+        """
+        Deletes the entries whose TTL has passed, like DynamoDB's TTL sweeper. Returns how many.
+        """
+        with self._lock:
+            return self._db.execute('DELETE FROM conversation WHERE NOT {}'.format(self._live())).rowcount
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store():
+    """
+    Returns the container's ConversationStore, created on first use from CONVERSATION_STORE.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if CONVERSATION_STORE == 'sqlite':
+                    _store = SqliteConversationStore()
+                else:
+                    _store = DynamoConversationStore()
+    return _store
+
+
+def set_conversation_store(store):
+    """
+    Replaces the container's ConversationStore, e.g. with a local one for benchmarks.
+    """
+    global _store
+    with _store_lock:
+        _store = store
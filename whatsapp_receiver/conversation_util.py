@@ -1,10 +1,42 @@
-import boto3
 import json
+import os
+import threading
+import time
+import uuid
 from datetime import datetime
+from ttl_cache import TTLCache
+from transport import InvokeResult, get_transport
+from tracing import emit_metrics, get_correlation_id, remaining_ms, span, traced
+from log_util import get_logger
+from token_store import TOKEN_STORE_ENABLED, expires_soon, is_expired, token_store
+from aws_clients import get_client
+from conversation_store import FULL, TOKEN, get_conversation_store
 
-# Initialize the AWS clients for Lambda and DynamoDB
-lambda_client = boto3.client('lambda')
-dynamodb = boto3.resource('dynamodb')
+logger = get_logger(__name__)
+
+# Per-user chat sessions keyed by (mobile, cr_date), kept across warm invocations
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '2048'))
+SESSION_CACHE_TTL = int(os.getenv('SESSION_CACHE_TTL', '3600'))
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+_session_cache_date = None
+_session_cache_lock = threading.Lock()
+
+# Single-flight session bootstrap: how long a claim is honoured and how long others wait for it
+BOOTSTRAP_STALE_SECONDS = int(os.getenv('BOOTSTRAP_STALE_SECONDS', '30'))
+BOOTSTRAP_WAIT_SECONDS = float(os.getenv('BOOTSTRAP_WAIT_SECONDS', '15'))
+BOOTSTRAP_POLL_INTERVAL = float(os.getenv('BOOTSTRAP_POLL_INTERVAL', '0.3'))
+
+# Time kept back from each musafir-interface call's deadline to still send the user a reply
+CHAT_REPLY_RESERVE_MS = int(os.getenv('CHAT_REPLY_RESERVE_MS', '1500'))
+
+# Status codes with which the smart-chat backend rejects an access token
+REJECTED_TOKEN_STATUS_CODES = (401, 403)
+
+# How long the first of several concurrent send_chat calls waits for others to join its
+# send_chat_batch call (0 disables batching), and the most calls grouped into one
+CHAT_BATCH_WINDOW_MS = int(os.getenv('CHAT_BATCH_WINDOW_MS', '20'))
+CHAT_BATCH_MAX_SIZE = int(os.getenv('CHAT_BATCH_MAX_SIZE', '25'))
+_chat_batch_local = threading.local()
 
 def invoke_lambda(function_name, payload):
     """
@@ -19,10 +51,10 @@ def invoke_lambda(function_name, payload):
     - The response payload returned by the invoked Lambda function, or an error message.
     """
     try:
-        print(f"Invoking Lambda function: {function_name} with payload: {json.dumps(payload)}")
+        logger.debug("Invoking Lambda function: %s with payload: %s", function_name, payload)
         
         # Invoke the Lambda function synchronously (wait for the response)
-        response = lambda_client.invoke(
+        response = get_client('lambda').invoke(
             FunctionName=function_name,
             InvocationType='RequestResponse',  # Synchronous invocation
             Payload=json.dumps(payload)  # Convert the payload to JSON
@@ -30,95 +62,406 @@ def invoke_lambda(function_name, payload):
         
         # Read and decode the response payload
         response_payload = json.loads(response['Payload'].read().decode('utf-8'))
-        print('Lambda response payload:', response_payload)  # Log the response for debugging
+        logger.debug('Lambda response payload: %s', response_payload)  # Log the response for debugging
         return response_payload
 
     except Exception as e:
         # If an error occurs during Lambda invocation, return a failure message
-        print(f"Error invoking Lambda function '{function_name}': {str(e)}")
+        logger.error("Error invoking Lambda function '%s': %s", function_name, e)
         return {
             'success': False,
             'message': f"Error invoking lambda: {str(e)}"
         }
 
 
-def get_conversation(mobile, date):
+def call_musafir(payload):
     """
-    Checks if a conversation exists for the given mobile number and date in the DynamoDB table.
+    Calls a musafir-interface method over the configured transport (Lambda invoke or in-process).
+
+    Parameters:
+    - payload: The method name and its parameters
+
+    Returns:
+    - An `InvokeResult` with the success flag, status code and response data. A 504 failure is
+      returned without calling musafir-interface if the thread's deadline leaves no time for it.
+    """
+    transport = get_transport(invoke_lambda)
+    correlation_id = get_correlation_id()
+    if correlation_id:
+        # Lets musafir-interface and the smart-chat backend tag their work with the same ID
+        payload = dict(payload, correlation_id=correlation_id)
+    remaining = remaining_ms()
+    if remaining is not None:
+        deadline_ms = int(remaining - CHAT_REPLY_RESERVE_MS)
+        if deadline_ms <= 0:
+            logger.warning("No time left to call %s", payload.get('method'))
+            return InvokeResult.failure('Deadline exceeded before calling musafir-interface', 504)
+        payload = dict(payload, deadline_ms=deadline_ms)
+    with span('musafir.' + payload.get('method', ''), transport=transport.name):
+        return transport.call(payload)
+
+
+def get_conversation(mobile, date, consistent=False, projection=FULL):
+    """
+    Checks if a conversation exists for the given mobile number and date in the conversation store.
     Returns the conversation details if it exists, otherwise None.
 
     Parameters:
     - mobile: The mobile number associated with the conversation
     - date: The date of the conversation
+    - consistent: Whether to use a strongly consistent read
+    - projection: TOKEN to read only the access token and its expiry, FULL for the whole entry
 
     Returns:
     - The conversation item if found, otherwise None
     """
-    print(f"Checking for conversation with mobile: {mobile} on date: {date}")
+    logger.debug("Checking for conversation with mobile: %s on date: %s", mobile, date)
     
     try:
-        # Access the 'conversation' table in DynamoDB
-        table = dynamodb.Table('conversation')
-        response = table.get_item(
-            Key={'mobile': mobile, 'cr_date': date}  # Partition and sort key
-        )
-        
-        if 'Item' in response:
-            print(f"Conversation found: {response['Item']}")
-            return response['Item']  # Return the conversation item if found
+        conversation = get_conversation_store().get(mobile, date, projection, consistent)
+        if conversation:
+            logger.debug("Conversation found for mobile: %s", mobile)
+            return conversation
         else:
-            print("No conversation found for this mobile and date.")
+            logger.debug("No conversation found for this mobile and date.")
             return None
         
     except Exception as e:
-        # Print any error messages from DynamoDB
-        print(f"Error fetching conversation: {str(e)}")
+        # Print any error messages from the store
+        logger.error("Error fetching conversation: %s", e)
         return None
 
 
-def create_conversation(mobile, name, access_token):
+def _roll_session_cache(date):
+    # Sessions are per day, so everything cached for the previous date is stale
+    global _session_cache_date
+    if date != _session_cache_date:
+        with _session_cache_lock:
+            if date != _session_cache_date:
+                session_cache.clear()
+                _session_cache_date = date
+
+
+def get_cached_conversation(mobile, date):
+    """
+    Returns the chat session for the given mobile number and date, served from the
+    in-memory session cache when possible and read from the conversation store otherwise.
+
+    Parameters:
+    - mobile: The mobile number associated with the conversation
+    - date: The date of the conversation
+
+    Returns:
+    - A dict holding the conversation's `access_token` and its `expires_at` (None if unknown)
+      if found, otherwise None
+    """
+    _roll_session_cache(date)
+    session = session_cache.get((mobile, date))
+    if session is not None:
+        return session
+
+    # Only the token is read, not the interactions logged on the entry
+    return _cache_session(mobile, date, get_conversation(mobile, date, projection=TOKEN))
+
+
+def _cache_session(mobile, date, conversation):
+    # A conversation still being bootstrapped has no access_token yet and is not cached
+    if conversation and conversation.get('access_token'):
+        expires_at = conversation.get('token_expires_at')
+        session = {'access_token': conversation.get('access_token'),
+                   'expires_at': int(expires_at) if expires_at is not None else None}
+        session_cache.set((mobile, date), session)
+        return session
+    return None
+
+
+def prefetch_conversations(mobiles, date=None):
+    """
+    Loads the chat sessions of several users into the session cache with one batch read,
+    so processing their messages afterwards skips the per-user lookup.
+
+    Parameters:
+    - mobiles: Mobile numbers as stored in the conversation store
+    - date: The conversation date, defaults to today
+
+    Returns:
+    - How many sessions were found
+    """
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    _roll_session_cache(date)
+    missing = [mobile for mobile in set(mobiles) if (mobile, date) not in session_cache]
+    if not missing:
+        return 0
+    try:
+        with span('conversation_prefetch', users=len(missing)):
+            found = get_conversation_store().batch_get(missing, date, TOKEN)
+    except Exception as e:
+        logger.error("Error prefetching conversations: %s", e)
+        return 0
+    return sum(1 for mobile, conversation in found.items() if _cache_session(mobile, date, conversation))
+
+
+def _count_bootstrap(outcome):
+    # One record per session set-up: 'bootstrap', 'coalesced', 'wait_timeout', 'token_reuse' or 'refresh'
+    emit_metrics({'SessionBootstraps': (1, 'Count')}, {'Stage': 'bootstrap', 'Outcome': outcome})
+
+
+def claim_conversation(mobile, name, date, claim_id):
+    """
+    Claims the right to bootstrap the conversation for the given mobile number and date by
+    marking the entry as pending, unless a conversation with a live token or a live claim already
+    exists. Claims older than BOOTSTRAP_STALE_SECONDS are assumed abandoned and can be taken over.
+
+    Parameters:
+    - mobile: The mobile number of the user
+    - name: The name of the user
+    - date: The date of the conversation
+    - claim_id: A unique id identifying this claimant
+
+    Returns:
+    - True if the claim was won, False if someone else holds it, None if the store failed
+    """
+    now = int(time.time())
+    try:
+        return get_conversation_store().claim(mobile, name, date, claim_id, now, now - BOOTSTRAP_STALE_SECONDS)
+    except Exception as e:
+        logger.error("Error claiming conversation bootstrap: %s", e)
+        return None
+
+
+def release_conversation_claim(mobile, date, claim_id):
+    """
+    Drops our claim after a failed bootstrap so the next message can retry right away.
+    The entry itself is kept, along with any interactions already logged on it.
+    """
+    try:
+        get_conversation_store().release_claim(mobile, date, claim_id)
+    except Exception as e:
+        logger.error("Error releasing conversation claim: %s", e)
+
+
+def wait_for_conversation(mobile, date):
+    """
+    Waits for a concurrent bootstrap of the same conversation to finish.
+
+    Returns:
+    - The winner's access_token, or None if it did not appear within BOOTSTRAP_WAIT_SECONDS
+      (or before the current thread's deadline)
+    """
+    wait_seconds = BOOTSTRAP_WAIT_SECONDS
+    remaining = remaining_ms()
+    if remaining is not None:
+        # Leave enough of the request's deadline to send the chat message afterwards
+        wait_seconds = min(wait_seconds, max(remaining - 2 * CHAT_REPLY_RESERVE_MS, 0) / 1000)
+    deadline = time.monotonic() + wait_seconds
+    while time.monotonic() < deadline:
+        time.sleep(BOOTSTRAP_POLL_INTERVAL)
+        session = session_cache.get((mobile, date))
+        if session is None:
+            conversation = get_conversation(mobile, date, consistent=True, projection=TOKEN)
+            if conversation and conversation.get('access_token') and \
+                    not is_expired(conversation.get('token_expires_at')):
+                session = conversation
+        if session is not None:
+            return session.get('access_token')
+    return None
+
+
+def create_conversation(mobile, name, access_token, date=None, expires_at=None):
     """
-    Creates a new conversation entry in the DynamoDB table with the given details.
+    Creates a new conversation entry in the conversation store with the given details.
 
     Parameters:
     - mobile: The mobile number to associate with the conversation
     - name: The name of the user
     - access_token: The access token generated during login for WhatsApp
+    - date: The conversation date, defaults to today
+    - expires_at: When the access token expires (epoch seconds), if known
 
     Returns:
     - True if the conversation is successfully created, otherwise False.
     """
     # Generate the current date in YYYY-MM-DD format for the 'cr_date' field
-    current_date = datetime.now().strftime('%Y-%m-%d')
+    current_date = date or datetime.now().strftime('%Y-%m-%d')
 
-    # Prepare the item to be inserted into the DynamoDB table
-    item = {
-        'mobile': mobile,
-        'cr_date': current_date,  # Date as sort key
-        'name': name,
-        'access_token': access_token
-    }
-
-    print(f"Creating new conversation entry with mobile: {mobile}, name: {name}, access_token: {access_token}")
+    logger.debug("Creating new conversation entry with mobile: %s, name: %s", mobile, name)
 
     try:
-        # Access the 'conversation' table in DynamoDB
-        table = dynamodb.Table('conversation')
-        # Insert the item into the table
-        table.put_item(Item=item)
-        print("Conversation entry created successfully.")
+        # Set the session on the entry, keeping any interactions already logged on it
+        get_conversation_store().set_session(mobile, name, current_date, access_token, expires_at)
+        logger.info("Conversation entry created successfully.")
+        # Write through so the next message from this user skips the store read
+        _roll_session_cache(current_date)
+        session_cache.set((mobile, current_date), {'access_token': access_token, 'expires_at': expires_at})
         return True
     except Exception as e:
         # Log any error that occurs during the insertion
-        print(f"Error creating conversation entry: {str(e)}")
+        logger.error("Error creating conversation entry: %s", e)
         return False
 
 
+class ChatBatcher:
+    """
+    Groups the send_chat calls that threads make at about the same time into one
+    `send_chat_batch` call to musafir-interface, so a burst of users costs one invoke instead
+    of one per user.
+
+    The first caller waits up to `window_ms` (or until `max_size` calls have joined), sends the
+    batch and hands every caller its own result; the others just wait for theirs.
+    """
+    def __init__(self, window_ms=CHAT_BATCH_WINDOW_MS, max_size=CHAT_BATCH_MAX_SIZE):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._pending = []
+        self._cond = threading.Condition()
+
+    def send(self, access_token, input_text):
+        """
+        Sends the message as part of a batch. Returns the same dict as `send_chat_message`.
+        """
+        slot = {'item': {'access_token': access_token, 'message': input_text,
+                         'correlation_id': get_correlation_id()},
+                'done': threading.Event(), 'result': None}
+        with self._cond:
+            self._pending.append(slot)
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_size:
+                self._cond.notify_all()
+        if not leader:
+            slot['done'].wait()
+            return slot['result']
+
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._pending) >= self.max_size, timeout=self.window)
+            batch, self._pending = self._pending, []
+        try:
+            self._send_batch(batch)
+        finally:
+            for other in batch:
+                if other['result'] is None:
+                    other['result'] = {'success': False, 'status_code': 500, 'content': None}
+                other['done'].set()
+        return slot['result']
+
+    @staticmethod
+    def _send_batch(batch):
+        if len(batch) == 1:
+            item = batch[0]['item']
+            batch[0]['result'] = _send_single(item['access_token'], item['message'])
+            return
+        response = call_musafir({'method': 'send_chat_batch', 'items': [slot['item'] for slot in batch]})
+        if not response.success:
+            logger.error("send_chat_batch for %s users failed: %s", len(batch), response.message)
+            for slot in batch:
+                slot['result'] = {'success': False, 'status_code': response.status_code, 'content': None}
+            return
+        for slot, result in zip(batch, response.data.get('results', [])):
+            status_code = result.get('statusCode', 500)
+            slot['result'] = {'success': status_code == 200, 'status_code': status_code,
+                              'content': result.get('content')}
+
+
+def use_chat_batcher(batcher):
+    """
+    Makes the current thread's send_chat calls go through `batcher` (None to send them one by one).
+    """
+    _chat_batch_local.batcher = batcher
+
+
+def send_chat_message(access_token, input_text):
+    """
+    Sends the user's message on an existing chat session, as part of a batch if the thread
+    has a ChatBatcher (see `use_chat_batcher`).
+
+    Returns:
+    - A dict with `success`, the `status_code` from musafir-interface and the `content` of the reply
+    """
+    batcher = getattr(_chat_batch_local, 'batcher', None)
+    if batcher is not None:
+        return batcher.send(access_token, input_text)
+    return _send_single(access_token, input_text)
+
+
+def _send_single(access_token, input_text):
+    # Invoke the `send_chat` method in the "musafir-interface" Lambda
+    payload = {
+        'method': 'send_chat',  # Specify the method to invoke
+        'access_token': access_token,
+        'message': input_text  # The message to send
+    }
+    logger.debug("Sending chat message: %s", input_text)
+    # Call musafir-interface and return the response
+    response = call_musafir(payload)
+    return {
+                'success': response.success,
+                'status_code': response.status_code,
+                'content': response.data.get('content')
+            }
+
+
+def forget_token(mobile, date, access_token):
+    """
+    Drops an access token the backend rejected from the token store, the session cache and
+    the day's conversation entry, so the user's next message logs in again.
+    """
+    logger.warning("Access token of %s was rejected, forgetting it.", mobile)
+    if TOKEN_STORE_ENABLED:
+        token_store.invalidate(mobile, access_token)
+    session_cache.pop((mobile, date))
+    try:
+        if not get_conversation_store().expire_token(mobile, date, access_token):
+            logger.info("Conversation entry of %s holds a newer token, not expired.", mobile)
+    except Exception as e:
+        logger.error("Error expiring the token of %s: %s", mobile, e)
+
+
+def send_on_session(mobile, date, access_token, input_text):
+    """
+    Sends the user's message with `access_token`, forgetting the token if the backend rejects it.
+    """
+    response = send_chat_message(access_token, input_text)
+    if response.get('status_code') in REJECTED_TOKEN_STATUS_CODES:
+        forget_token(mobile, date, access_token)
+    return response
+
+
+def refresh_session(mobile, name, date):
+    """
+    Logs in again, starts a chat on the new token and stores it for today and later days.
+    Runs in the background once the current token is about to expire.
+    """
+    login_response = call_musafir({'method': 'login_for_whatsapp', 'mobile': mobile, 'name': name})
+    if not login_response.success:
+        logger.warning("Background login for %s failed: %s", mobile, login_response.message)
+        return
+    access_token = login_response.data.get('accessToken')
+    start_chat_response = call_musafir({'method': 'start_chat', 'access_token': access_token})
+    if not start_chat_response.success:
+        # Keep the current token rather than storing one without a started chat
+        logger.warning("Background start_chat for %s failed: %s", mobile, start_chat_response.message)
+        return
+    record = token_store.put(mobile, name, access_token)
+    create_conversation(mobile, name, access_token, date, record['expires_at'])
+    _count_bootstrap('refresh')
+
+
+def _refresh_if_expiring(mobile, name, date, expires_at):
+    if TOKEN_STORE_ENABLED and expires_soon(expires_at):
+        token_store.refresh_async(mobile, lambda: refresh_session(mobile, name, date))
+
+
+@traced('find_conversation_and_communicate')
 def find_conversation_and_communicate(mobile, name, input_text):
     """
     Main function to find or create a conversation and communicate with the user.
     If a conversation exists, it uses the existing `access_token` to send a message. 
-    If not, it logs the user in, creates a conversation, and starts a new chat.
+    If not, it reuses the user's stored token from an earlier day when it is still valid, and
+    otherwise logs the user in, creates a conversation, and starts a new chat.
+    Tokens close to expiry are refreshed in the background.
+
+    Session creation is single-flight per (mobile, date): a conditional write claims the
+    bootstrap, and messages arriving while another request holds the claim wait for its
+    access_token and send their text on that session instead of logging in again.
 
     Parameters:
     - mobile: The mobile number of the user
@@ -126,81 +469,104 @@ def find_conversation_and_communicate(mobile, name, input_text):
     - input_text: The message to send in case the conversation already exists
 
     Returns:
-    - The response from the `send_chat` or `start_chat` Lambda function
+    - A dict with `success`, the `content` returned by `send_chat` or `start_chat`, and the
+      `status_code` of the failing musafir-interface call when there is one
     """
     # Generate the current date dynamically
     current_date = datetime.now().strftime('%Y-%m-%d')
 
-    print(f"Checking conversation for mobile: {mobile}, date: {current_date}")
+    logger.debug("Checking conversation for mobile: %s, date: %s", mobile, current_date)
 
-    # Step 1: Check if the conversation exists in the DynamoDB table
-    conversation = get_conversation(mobile, current_date)
+    # Step 1: Check if the conversation exists, in the session cache or the conversation store
+    with span('conversation_lookup'):
+        conversation = get_cached_conversation(mobile, current_date)
 
-    if conversation:
-        # If a conversation exists, retrieve the access_token
-        access_token = conversation.get('access_token')
-        
-        # Step 2: Invoke the `send_chat` method in the "musafir-interface" Lambda
-        payload = {
-            'method': 'send_chat',  # Specify the method to invoke
-            'access_token': access_token,
-            'message': input_text  # The message to send
+    if conversation and not is_expired(conversation.get('expires_at')):
+        # Step 2: If a conversation exists, send the message with its access_token
+        _refresh_if_expiring(mobile, name, current_date, conversation.get('expires_at'))
+        return send_on_session(mobile, current_date, conversation.get('access_token'), input_text)
+
+    # Step 2b: A token from an earlier day that is still valid carries over to today's
+    # conversation, saving the login and start_chat round trips
+    if TOKEN_STORE_ENABLED:
+        with span('token_lookup'):
+            token = token_store.get(mobile)
+        if token:
+            _count_bootstrap('token_reuse')
+            create_conversation(mobile, name, token['access_token'], current_date, token['expires_at'])
+            _refresh_if_expiring(mobile, name, current_date, token['expires_at'])
+            return send_on_session(mobile, current_date, token['access_token'], input_text)
+
+    # Step 3: Claim the bootstrap so concurrent messages don't each log in and start a chat
+    claim_id = uuid.uuid4().hex
+    claimed = claim_conversation(mobile, name, current_date, claim_id)
+    if claimed is False:
+        logger.info("Conversation is being created by another request, waiting for it.")
+        access_token = wait_for_conversation(mobile, current_date)
+        if access_token:
+            _count_bootstrap('coalesced')
+            return send_on_session(mobile, current_date, access_token, input_text)
+        _count_bootstrap('wait_timeout')
+        logger.error("Timed out waiting for the conversation to be created.")
+        return {
+            'success': False,
+            'message': 'Timed out waiting for the conversation to be created.'
         }
-        print(f"Sending chat with access_token: {access_token}, message: {input_text}")
-        # Call the Lambda function and return the response
-        response = invoke_lambda('musafir-interface', payload)
-        response_data = json.loads(response.get('body'))
+
+    # If no conversation exists, log in and start a new chat
+    logger.info("No conversation found, proceeding with login and new chat.")
+    _count_bootstrap('bootstrap')
+
+    # Step 4: Invoke the `login_for_whatsapp` method in the "musafir-interface" Lambda
+    login_payload = {
+        'method': 'login_for_whatsapp',  # Specify the method to invoke
+        'mobile': mobile,
+        'name': name
+    }
+    # Call musafir-interface and get the login response
+    logger.debug("Logging in with mobile: %s, name: %s", mobile, name)
+    login_response = call_musafir(login_payload)
+    logger.debug('login_response: %s', login_response)  # Log the login response for debugging
+
+    if not login_response.success:  # Check if login was successful
+        # Return error response if login fails
+        logger.error("Failed to login for WhatsApp.")
+        if claimed:
+            release_conversation_claim(mobile, current_date, claim_id)
         return {
-                    'success': True,
-                    'content': response_data.get('data', {}).get('content')
-                }
-    else:
-        # If no conversation exists, log in and start a new chat
-        print(f"No conversation found, proceeding with login and new chat.")
-        
-        # Step 3: Invoke the `login_for_whatsapp` method in the "musafir-interface" Lambda
-        login_payload = {
-            'method': 'login_for_whatsapp',  # Specify the method to invoke
-            'mobile': mobile,
-            'name': name
+            'success': False,
+            'status_code': login_response.status_code,
+            'message': 'Error logging in for WhatsApp.'
         }
-        # Call the Lambda function and get the login response
-        print(f"Logging in with mobile: {mobile}, name: {name}")
-        login_response = invoke_lambda('musafir-interface', login_payload)
-        print('login_response:', login_response)  # Log the login response for debugging
-
-        if login_response.get('success', True):  # Check if login was successful
-            response_data = json.loads(login_response.get('body'))
-            access_token = response_data.get('data').get('accessToken')
-
-            # Step 4: Create a new conversation entry in DynamoDB
-            print(f"Creating conversation entry for mobile: {mobile}, name: {name}, access_token: {access_token}")
-            create_response = create_conversation(mobile, name, access_token)
-            if create_response:
-                # Step 5: Invoke the `start_chat` method in the "musafir-interface" Lambda
-                start_chat_payload = {
-                    'method': 'start_chat',  # Specify the method to invoke
-                    'access_token': access_token
-                }
-                print(f"Starting chat with access_token: {access_token}")
-                # Call the Lambda function to start the chat and return the response
-                start_chat_response = invoke_lambda('musafir-interface', start_chat_payload)
-                response_data = json.loads(start_chat_response.get('body'))
-                return {
-                    'success': True,
-                    'content': response_data.get('data', {}).get('content')
-                }
-            else:
-                # Return error response if conversation entry creation fails
-                print("Error: Failed to create conversation entry.")
-                return {
-                    'success': False,
-                    'message': 'Error creating conversation entry.'
-                }
-        else:
-            # Return error response if login fails
-            print("Error: Failed to login for WhatsApp.")
-            return {
-                'success': False,
-                'message': 'Error logging in for WhatsApp.'
-            }
+    access_token = login_response.data.get('accessToken')
+
+    # Step 5: Invoke the `start_chat` method in the "musafir-interface" Lambda
+    start_chat_payload = {
+        'method': 'start_chat',  # Specify the method to invoke
+        'access_token': access_token
+    }
+    logger.debug("Starting chat")
+    start_chat_response = call_musafir(start_chat_payload)
+
+    # Step 6: Store the conversation; this also releases anyone waiting on the claim, so it
+    # happens after start_chat to make sure their send_chat lands on a started session
+    logger.debug("Creating conversation entry for mobile: %s, name: %s", mobile, name)
+    expires_at = None
+    if TOKEN_STORE_ENABLED and start_chat_response.success:
+        # Kept per user, so tomorrow's first message can reuse the token instead of logging in.
+        # Only a token with a started chat is worth reusing.
+        expires_at = token_store.put(mobile, name, access_token)['expires_at']
+    if not create_conversation(mobile, name, access_token, current_date, expires_at):
+        # Return error response if conversation entry creation fails
+        logger.error("Failed to create conversation entry.")
+        if claimed:
+            release_conversation_claim(mobile, current_date, claim_id)
+        return {
+            'success': False,
+            'message': 'Error creating conversation entry.'
+        }
+    return {
+        'success': start_chat_response.success,
+        'status_code': start_chat_response.status_code,
+        'content': start_chat_response.data.get('content')
+    }
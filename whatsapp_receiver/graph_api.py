@@ -0,0 +1,382 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from tracing import emit_metrics, get_correlation_id, set_correlation_id, span
+from log_util import get_logger
+from rate_limiter import RateGovernor
+from aws_clients import get_client
+
+logger = get_logger(__name__)
+
+GRAPH_API_URL = 'https://graph.facebook.com'
+
+# Pool and timeout settings for calls to the Graph API
+GRAPH_POOL_MAXSIZE = int(os.getenv('GRAPH_POOL_MAXSIZE', '10'))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv('GRAPH_CONNECT_TIMEOUT', '3.05'))
+GRAPH_READ_TIMEOUT = float(os.getenv('GRAPH_READ_TIMEOUT', '10'))
+
+# Graph API error codes meaning "slow down": app, account, throughput, spam and pair rate limits
+RATE_LIMIT_ERROR_CODES = (4, 80007, 130429, 131048, 131056)
+# Retries of a rate-limited send, waiting GRAPH_RETRY_BASE_SECONDS * 2^attempt in between
+GRAPH_MAX_RETRIES = int(os.getenv('GRAPH_MAX_RETRIES', '3'))
+GRAPH_RETRY_BASE_SECONDS = float(os.getenv('GRAPH_RETRY_BASE_SECONDS', '1'))
+# Longest a send waits for the rate governor: short inside the webhook, longer in the queue worker
+GRAPH_SEND_MAX_WAIT = float(os.getenv('GRAPH_SEND_MAX_WAIT', '2'))
+OUTBOUND_MAX_WAIT = float(os.getenv('OUTBOUND_MAX_WAIT', '30'))
+# How often a queued chain that is still rate limited is put back before it is dropped
+OUTBOUND_MAX_REQUEUES = int(os.getenv('OUTBOUND_MAX_REQUEUES', '5'))
+
+# 'local' drains queued chains on a background thread, 'sqs' sends them to OUTBOUND_QUEUE_URL
+# for outbound_worker_handler
+OUTBOUND_QUEUE_MODE = os.getenv('OUTBOUND_QUEUE_MODE', 'local')
+OUTBOUND_QUEUE_URL = os.getenv('OUTBOUND_QUEUE_URL', '')
+
+governor = RateGovernor()
+
+# Counters since the last `emit_outbound_metrics`
+send_stats = {'sent': 0, 'failed': 0, 'rate_limited': 0, 'throttled_ms': 0.0, 'requeued': 0, 'dropped': 0}
+_send_stats_lock = threading.Lock()
+
+
+def _count(key, value=1):
+    with _send_stats_lock:
+        send_stats[key] += value
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a message could not be sent within the allowed wait because of rate limits.
+    """
+    def __init__(self, message, error_code=None):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+def get_template(t_type):
+    return {'name': t_type, 'language': {'code': 'en'}}
+
+
+def message_fragment(msg):
+    """
+    Serializes the recipient-independent part of a message (its type and content) once,
+    so static payloads such as the BUTTONS replies don't have to be rebuilt and re-encoded
+    for every send.
+
+    Parameters:
+    - msg: A message dict with one of the keys `template`, `text` or `document`
+
+    Returns:
+    - The JSON fragment (without surrounding braces), or None if the message has no content
+    """
+    payload = {}
+    if 'template' in msg:
+        payload['type'] = 'template'
+        payload['template'] = get_template(msg['template'])
+    if 'text' in msg:
+        payload['type'] = 'text'
+        payload['text'] = {
+            "preview_url": False,
+            "body": msg['text']
+        }
+    if 'document' in msg:
+        payload['type'] = 'document'
+        payload['document'] = {
+            "id": msg['document'],
+            "filename": msg['filename']
+        }
+    if not payload:
+        return None
+    return json.dumps(payload, separators=(',', ':'))[1:-1]
+
+
+def build_body(mobile, fragment, message_id=None):
+    """
+    Joins the per-recipient envelope with a pre-serialized message fragment.
+    """
+    body = '{"messaging_product":"whatsapp","to":' + json.dumps(mobile)
+    if message_id:
+        body += ',"context":{"message_id":' + json.dumps(message_id) + '}'
+    return body + ',' + fragment + '}'
+
+
+class GraphApiSender:
+    """
+    Sends messages for one WhatsApp phone number over a pooled keep-alive session.
+    The URL and authorization headers are built once, when the sender is created.
+    """
+    def __init__(self, version, phone_number_id, token):
+        self.phone_number_id = phone_number_id
+        self.url = '{}/{}/{}/messages'.format(GRAPH_API_URL, version, phone_number_id)
+        self.media_url = '{}/{}/{}/media'.format(GRAPH_API_URL, version, phone_number_id)
+        self.timeout = (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)
+
+        # Deferred so webhooks that never send (status updates, preflights) don't load requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=GRAPH_POOL_MAXSIZE))
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer {}'.format(token)
+        })
+
+    def send(self, mobile, fragment, message_id=None, max_wait=GRAPH_SEND_MAX_WAIT):
+        """
+        Posts a single message and returns the decoded Graph API response.
+
+        The send waits for the rate governor, and rate-limit errors are retried with
+        exponential backoff. RateLimitedError is raised if the message can't go out within
+        `max_wait` seconds of waiting per attempt or after GRAPH_MAX_RETRIES retries.
+
+        Parameters:
+        - mobile: The recipient's WhatsApp number
+        - fragment: The serialized message content, see `message_fragment`
+        - message_id: Optional id of the message this one replies to
+        - max_wait: Longest to wait for the rate governor before each attempt, in seconds
+
+        Returns:
+        - The response JSON as a dict
+        """
+        body = build_body(mobile, fragment, message_id)
+        logger.debug('payload -- %s', body)
+        attempt = 0
+        while True:
+            waited = governor.acquire(self.phone_number_id, mobile, max_wait)
+            if waited is None:
+                raise RateLimitedError('Rate limit wait for {} exceeds {}s'.format(mobile, max_wait))
+            if waited:
+                _count('throttled_ms', waited * 1000)
+            with span('graph_send'):
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+            logger.debug('response of the API -- %s', response.text)
+            data = response.json()
+            error_code = data.get('error', {}).get('code') if isinstance(data, dict) else None
+            if response.status_code != 429 and error_code not in RATE_LIMIT_ERROR_CODES:
+                _count('sent' if response.ok else 'failed')
+                return data
+
+            _count('rate_limited')
+            if attempt >= GRAPH_MAX_RETRIES:
+                raise RateLimitedError('Still rate limited after {} retries'.format(attempt), error_code)
+            delay = GRAPH_RETRY_BASE_SECONDS * (2 ** attempt)
+            logger.warning('Rate limited by the Graph API (code %s), retrying in %ss', error_code, delay)
+            # The next acquire waits out the delay, and other sends hold back as well
+            governor.back_off(self.phone_number_id, mobile, error_code, delay)
+            attempt += 1
+
+    def upload_media(self, content, filename, mime_type):
+        """
+        Uploads a file to the Graph media endpoint, for use in document messages.
+
+        Returns:
+        - The media id. Raises RuntimeError if the upload is rejected.
+        """
+        with span('graph_media_upload'):
+            # A multipart body, so the session's JSON content type is dropped for this request
+            response = self.session.post(self.media_url, data={'messaging_product': 'whatsapp', 'type': mime_type},
+                                         files={'file': (filename, content, mime_type)},
+                                         headers={'Content-Type': None}, timeout=self.timeout)
+        data = response.json()
+        if not response.ok or 'id' not in data:
+            raise RuntimeError('Media upload of {} failed: {}'.format(filename, data.get('error', data)))
+        return data['id']
+
+    def warm(self):
+        """
+        Opens a pooled connection to the Graph API ahead of the first send, so it skips the
+        TCP and TLS handshakes. Any HTTP status counts as warmed.
+
+        Returns:
+        - The status code of the probe
+        """
+        response = self.session.head(GRAPH_API_URL, timeout=self.timeout)
+        response.close()
+        return response.status_code
+
+
+# One sender per phone_number_id, kept across warm invocations
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(phone_number_id=None):
+    """
+    Returns the cached sender for `phone_number_id` (defaults to the configured number),
+    creating it on first use.
+    """
+    phone_number_id = phone_number_id or os.environ['phone_number_id']
+    sender = _senders.get(phone_number_id)
+    if sender is None:
+        with _senders_lock:
+            sender = _senders.get(phone_number_id)
+            if sender is None:
+                sender = GraphApiSender(os.environ['version'], phone_number_id, os.environ['token'])
+                _senders[phone_number_id] = sender
+    return sender
+
+
+def send_chain(item, max_wait=OUTBOUND_MAX_WAIT):
+    """
+    Sends a queued chain of messages (see `OutboundQueue.submit` for the item layout).
+
+    Returns:
+    - None if the chain was sent, or an item holding the steps still to send if the chain
+      hit a rate limit
+    """
+    sender = get_sender(item['phone_number_id'])
+    previous_id = None
+    for i, (fragment, reply_to_previous) in enumerate(item['chain']):
+        reply_to = previous_id if reply_to_previous else item['message_id']
+        try:
+            response = sender.send(item['mobile'], fragment, reply_to, max_wait)
+        except RateLimitedError as e:
+            logger.warning('Chain for %s rate limited at step %s -- %s', item['mobile'], i, e)
+            # The first remaining step keeps replying to the message it was meant to quote
+            rest = [(fragment, False)] + [tuple(step) for step in item['chain'][i + 1:]]
+            return dict(item, chain=rest, message_id=reply_to, attempts=item.get('attempts', 0) + 1)
+        previous_id = response['messages'][0]['id']
+    return None
+
+
+def _new_item(mobile, chain, message_id, phone_number_id):
+    return {'phone_number_id': phone_number_id, 'mobile': mobile, 'chain': chain, 'message_id': message_id,
+            'correlation_id': get_correlation_id(), 'attempts': 0}
+
+
+def requeue(outbound, remaining):
+    """
+    Puts the rest of a rate-limited chain back on `outbound`, or drops it after OUTBOUND_MAX_REQUEUES tries.
+    """
+    if remaining['attempts'] > OUTBOUND_MAX_REQUEUES:
+        logger.error('Dropping %s messages for %s after %s attempts', len(remaining['chain']),
+                     remaining['mobile'], remaining['attempts'])
+        _count('dropped', len(remaining['chain']))
+        return
+    _count('requeued')
+    outbound.put_item(remaining, GRAPH_RETRY_BASE_SECONDS * (2 ** remaining['attempts']))
+
+
+class OutboundQueue:
+    """
+    Ordered outbound queue drained by a single background thread.
+
+    Each submitted chain is a list of (fragment, reply_to_previous) steps for one recipient,
+    sent in order; a step with `reply_to_previous` set quotes the message id returned for the
+    step before it. Chains are sent in the order they were submitted. A chain that stays
+    rate limited is put back at the end of the queue with the steps it has left, and is not
+    sent again before its back-off delay has passed.
+
+    Lambda freezes background threads once the handler returns, so work still queued at
+    that point resumes on the next warm invocation unless the handler calls `flush`.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, mobile, chain, message_id=None, phone_number_id=None):
+        """
+        Queues a chain of messages for `mobile`. The first step replies to `message_id`, if given.
+        """
+        self.put_item(_new_item(mobile, chain, message_id, phone_number_id))
+
+    def put_item(self, item, delay_seconds=0):
+        if delay_seconds:
+            # On the time.monotonic clock, so only meaningful within this container
+            item = dict(item, not_before=time.monotonic() + delay_seconds)
+        self._queue.put(item)
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='outbound-queue', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            set_correlation_id(item['correlation_id'])
+            wait = item.get('not_before', 0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                remaining = send_chain(item)
+                if remaining is not None:
+                    requeue(self, remaining)
+            except Exception as e:
+                logger.error('Exception occurred while sending queued messages -- %s', e)
+            finally:
+                self._queue.task_done()
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self, timeout):
+        """
+        Waits up to `timeout` seconds for queued chains to be sent.
+
+        Returns:
+        - True if the queue is empty, otherwise False
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+
+class SqsOutboundQueue:
+    """
+    Outbound queue backed by SQS: chains are sent as messages to `queue_url` and delivered by
+    `outbound_worker_handler`. Rate-limited chains are re-sent with a delay. Its depth is the
+    queue's ApproximateNumberOfMessagesVisible metric, so `pending` is always 0 here.
+    """
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+    def submit(self, mobile, chain, message_id=None, phone_number_id=None):
+        self.put_item(_new_item(mobile, chain, message_id, phone_number_id))
+
+    def put_item(self, item, delay_seconds=0):
+        get_client('sqs').send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(item),
+                                       DelaySeconds=min(int(delay_seconds), 900))
+
+    def pending(self):
+        return 0
+
+    def flush(self, timeout):
+        return True
+
+
+def emit_outbound_metrics():
+    """
+    Emits the send counters collected since the last call, and the local queue depth.
+    Summed per minute in CloudWatch, MessagesSent is the send throughput.
+    """
+    with _send_stats_lock:
+        stats = dict(send_stats)
+        for key in send_stats:
+            send_stats[key] = 0
+    emit_metrics({
+        'MessagesSent': (stats['sent'], 'Count'),
+        'SendFailures': (stats['failed'], 'Count'),
+        'RateLimited': (stats['rate_limited'], 'Count'),
+        'ThrottledTime': (round(stats['throttled_ms'], 3), 'Milliseconds'),
+        'Requeued': (stats['requeued'], 'Count'),
+        'Dropped': (stats['dropped'], 'Count'),
+        'OutboundQueueDepth': (outbound_queue.pending(), 'Count'),
+    }, {'Stage': 'outbound'})
+
+
+outbound_queue = SqsOutboundQueue(OUTBOUND_QUEUE_URL) if OUTBOUND_QUEUE_MODE == 'sqs' else OutboundQueue()
+# Sends the webhook should not wait for (document follow-ups, rate-limited replies) go to the SQS
+# worker whenever OUTBOUND_QUEUE_URL is set, even with a local outbound queue
+deferred_queue = SqsOutboundQueue(OUTBOUND_QUEUE_URL) if OUTBOUND_QUEUE_URL else outbound_queue
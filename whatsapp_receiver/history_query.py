@@ -0,0 +1,209 @@
+import base64
+import json
+import os
+import re
+
+# Conversations (days) returned per page unless the query sets `limit`
+DEFAULT_PAGE_SIZE = 7
+MAX_PAGE_SIZE = 31
+# Comma-separated WhatsApp numbers (with country code) allowed to query anyone's history over
+# WhatsApp; everyone else may only query their own
+HISTORY_ADMIN_MOBILES = frozenset(m.strip() for m in os.getenv('HISTORY_ADMIN_MOBILES', '').split(',') if m.strip())
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class QueryError(ValueError):
+    """
+    Raised for a malformed `filter(...)` query.
+    """
+
+
+class HistoryQuery:
+    """
+    A parsed conversation history query.
+
+    Attributes:
+    - mobile: The mobile number whose history is requested
+    - date_from, date_to: Inclusive `cr_date` bounds, either may be None
+    - latest: Return only the N most recent conversations
+    - limit: Conversations per page
+    - cursor: Opaque position to resume from, as returned in `next_cursor`
+    - start_key: The store key `cursor` decodes to
+    - next_cursor: Set once the page has been read, if more results exist
+    """
+    def __init__(self, mobile, date_from=None, date_to=None, latest=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        self.mobile = mobile
+        self.date_from = date_from
+        self.date_to = date_to
+        self.latest = latest
+        self.limit = limit
+        self.cursor = cursor
+        self.start_key = None
+        self.next_cursor = None
+
+    def with_cursor(self, cursor):
+        """
+        Renders the query as filter text resuming at `cursor`, for a follow-up request.
+        """
+        parts = ['mobile:' + self.mobile]
+        if self.date_from and self.date_from == self.date_to:
+            parts.append('date:' + self.date_from)
+        else:
+            if self.date_from:
+                parts.append('from:' + self.date_from)
+            if self.date_to:
+                parts.append('to:' + self.date_to)
+        parts.append('limit:{}'.format(self.limit))
+        parts.append('cursor:' + cursor)
+        return 'filter({})'.format(','.join(parts))
+
+
+def _parse_date(value):
+    if not _DATE_RE.match(value):
+        raise QueryError('Invalid date: {}, expected YYYY-MM-DD'.format(value))
+    return value
+
+
+def _parse_int(name, value, maximum):
+    if not value.isdigit() or not 0 < int(value) <= maximum:
+        raise QueryError('Invalid {}: {}, expected a number between 1 and {}'.format(name, value, maximum))
+    return int(value)
+
+
+def parse_filter(text):
+    """
+    Parses a history query of the form `filter(key:value,...)`.
+
+    Supported keys:
+    - mobile: required
+    - date: a single day (YYYY-MM-DD) or a range (YYYY-MM-DD..YYYY-MM-DD)
+    - from, to: open or closed date range bounds
+    - latest: only the N most recent conversations
+    - limit: conversations per page
+    - cursor: resume position returned by a previous page
+
+    Returns:
+    - A HistoryQuery. Raises QueryError if the text is malformed.
+    """
+    text = text.strip()
+    if not (text.startswith('filter(') and text.endswith(')')):
+        raise QueryError('Query must look like filter(mobile:...,date:...)')
+
+    fields = {}
+    for part in text[len('filter('):-1].split(','):
+        if not part.strip():
+            continue
+        name, sep, value = part.partition(':')
+        name, value = name.strip(), value.strip()
+        if not sep or not value:
+            raise QueryError('Invalid filter: {}'.format(part))
+        fields[name] = value
+
+    if 'mobile' not in fields:
+        raise QueryError('Missing required filter: mobile')
+    query = HistoryQuery(fields.pop('mobile'))
+
+    if 'date' in fields:
+        start, _, end = fields.pop('date').partition('..')
+        query.date_from = _parse_date(start)
+        query.date_to = _parse_date(end) if end else query.date_from
+    if 'from' in fields:
+        query.date_from = _parse_date(fields.pop('from'))
+    if 'to' in fields:
+        query.date_to = _parse_date(fields.pop('to'))
+    if 'latest' in fields:
+        query.latest = _parse_int('latest', fields.pop('latest'), MAX_PAGE_SIZE)
+    if 'limit' in fields:
+        query.limit = _parse_int('limit', fields.pop('limit'), MAX_PAGE_SIZE)
+    if 'cursor' in fields:
+        query.cursor = fields.pop('cursor')
+        query.start_key = _parse_cursor(query.cursor, query.mobile)
+    if fields:
+        raise QueryError('Unknown filters: {}'.format(', '.join(fields)))
+    return query
+
+
+def may_query(query, sender, admins=HISTORY_ADMIN_MOBILES):
+    """
+    Returns whether the WhatsApp user `sender` (with country code) may run `query`: their own
+    history, keyed by the number without country code like every conversation, or any
+    history for an admin.
+    """
+    return sender in admins or query.mobile == sender[2:]
+
+
+def _parse_cursor(cursor, mobile):
+    # A cursor only resumes a query for the same mobile, from a conversation key
+    key = decode_cursor(cursor)
+    if not isinstance(key, dict) or key.get('mobile') != mobile or not isinstance(key.get('cr_date'), str):
+        raise QueryError('Invalid cursor')
+    return key
+
+
+def encode_cursor(last_key):
+    raw = json.dumps(last_key, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return json.loads(raw)
+    except ValueError:
+        raise QueryError('Invalid cursor')
+
+
+def readable(event):
+    if event['type'] == 'text':
+        msg = '{} : User sent text - {}'.format(event['date_time'], event['content'])
+    elif event['type'] == 'button':
+        msg = '{} : User pressed button - {}'.format(event['date_time'], event['content'])
+    elif event['type'] == 'reply':
+        msg = '{} : Bot replied - {}'.format(event['date_time'], event['content'])
+    else:
+        msg = '{} : {} - {}'.format(event['date_time'], event['type'], event['content'])
+    return msg
+
+
+def iter_history(query, store):
+    """
+    Reads one page of conversations for the query with a range read on the `cr_date` sort
+    key, projecting only the fields needed, and yields the readable interaction lines one at
+    a time. Sets `query.next_cursor` once the page is exhausted, if there is more.
+
+    Parameters:
+    - query: A HistoryQuery
+    - store: The ConversationStore
+    """
+    # With `latest`, newest first and no further pages once the N latest have been returned
+    items, last_key = store.query_history(query.mobile, query.date_from, query.date_to,
+                                          limit=query.latest or query.limit, newest_first=bool(query.latest),
+                                          start_key=query.start_key)
+    for item in items:
+        for interaction in item.get('interactions', []):
+            yield readable(interaction)
+
+    if last_key and not query.latest:
+        query.next_cursor = encode_cursor(last_key)
+
+
+def chunk_messages(lines, limit):
+    """
+    Packs lines into newline-joined messages no longer than `limit` characters,
+    splitting any single line that is longer than that.
+    """
+    chunk = ''
+    for line in lines:
+        while len(line) > limit:
+            if chunk:
+                yield chunk
+                chunk = ''
+            yield line[:limit]
+            line = line[limit:]
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            yield chunk
+            chunk = ''
+        chunk = chunk + '\n' + line if chunk else line
+    if chunk:
+        yield chunk
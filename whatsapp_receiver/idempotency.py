@@ -0,0 +1,100 @@
+import os
+import time
+
+from aws_clients import error_code, get_resource
+from ttl_cache import TTLCache
+from tracing import emit_metrics
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+# DynamoDB table keyed by `message_id`, with TTL enabled on `expires_at`
+IDEMPOTENCY_TABLE = os.getenv('IDEMPOTENCY_TABLE', 'webhook_messages')
+# Meta keeps redelivering an unacknowledged webhook for up to 7 days
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(7 * 24 * 3600)))
+# How long a claimed message is considered in progress; after that a redelivery may take it over
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', '120'))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '4096'))
+
+PROCESSING = 'processing'
+DONE = 'done'
+
+
+class IdempotencyStore:
+    """
+    Remembers which WhatsApp message ids have been taken for processing, so webhook
+    redeliveries don't repeat the backend calls and the reply.
+
+    A message is claimed with a conditional write of a `processing` marker that holds a lease,
+    and marked `done` once handled. A recent-ids cache answers retries that reach the same
+    warm container without a DynamoDB call. Ids this container completed are kept for the
+    full TTL; ids found claimed elsewhere only for a lease, as that attempt may still fail.
+    """
+    def __init__(self, table_name=IDEMPOTENCY_TABLE, ttl=IDEMPOTENCY_TTL_SECONDS,
+                 lease=IDEMPOTENCY_LEASE_SECONDS, cache_size=IDEMPOTENCY_CACHE_SIZE):
+        self.table_name = table_name
+        self.ttl = ttl
+        self.lease = lease
+        self.recent = TTLCache(cache_size, ttl)
+
+    def _table(self):
+        return get_resource('dynamodb').Table(self.table_name)
+
+    def claim(self, message_id):
+        """
+        Claims `message_id` for processing.
+
+        Returns:
+        - True if the message should be processed, False if it is a duplicate. If DynamoDB
+          fails the message is processed (fail open) rather than dropped.
+        """
+        if message_id in self.recent:
+            return False
+        now = int(time.time())
+        try:
+            self._table().put_item(
+                Item={'message_id': message_id, 'status': PROCESSING, 'lease_until': now + self.lease,
+                      'expires_at': now + self.ttl},
+                ConditionExpression='attribute_not_exists(message_id) OR (#status = :processing AND lease_until < :now)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':processing': PROCESSING, ':now': now}
+            )
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                # Done or still leased elsewhere; remembered no longer than a lease, so a redelivery
+                # after the other attempt failed goes back to DynamoDB and can take it over
+                self.recent.set(message_id, True, ttl=self.lease)
+                return False
+            logger.error("Error claiming message %s, processing it anyway: %s", message_id, e)
+            return True
+        return True
+
+    def complete(self, message_id):
+        """
+        Marks a claimed message as handled, so it is never taken over once its lease runs out.
+        """
+        self.recent.set(message_id, True)
+        try:
+            self._table().update_item(
+                Key={'message_id': message_id},
+                UpdateExpression='SET #status = :done REMOVE lease_until',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':done': DONE}
+            )
+        except Exception as e:
+            logger.error("Error marking message %s as done: %s", message_id, e)
+
+    def filter_new(self, records):
+        """
+        Claims the message id of every record and returns the records that are not duplicates.
+        """
+        fresh = [record for record in records if self.claim(record['m_id'])]
+        duplicates = len(records) - len(fresh)
+        if duplicates:
+            logger.info("Skipping %s redelivered messages", duplicates)
+            emit_metrics({'DuplicateMessages': (duplicates, 'Count')}, {'Stage': 'idempotency'})
+        return fresh
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,170 @@
+"""
+Answers menu keywords and FAQ-style messages locally, without DynamoDB, musafir-interface
+or the LLM.
+
+Free text is normalized (case, whitespace and trailing punctuation) and looked up in a dict
+built once per container, so routing is O(1) per message. A small table of regular
+expressions, compiled into a single alternation, is tried only when the lookup misses.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+from tracing import emit_metrics
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+INTENT_ROUTER_ENABLED = os.getenv('INTENT_ROUTER_ENABLED', 'true').lower() == 'true'
+# Least time between two IntentLookups metric records from one container
+INTENT_FLUSH_SECONDS = float(os.getenv('INTENT_FLUSH_SECONDS', '60'))
+
+# Normalized keyword -> BUTTONS key; extended (or overridden) by INTENT_KEYWORDS, a JSON object
+DEFAULT_KEYWORDS = {
+    'hi': 'Explore trips?',
+    'hello': 'Explore trips?',
+    'hey': 'Explore trips?',
+    'trips': 'Explore trips?',
+    'explore trips': 'Explore trips?',
+    'himachal': 'Himachal Trips',
+    'himachal trips': 'Himachal Trips',
+    'kasol': 'Kasol Kheerganga',
+    'kheerganga': 'Kasol Kheerganga',
+    'manali': 'Manali Solang Kasol',
+    'call a human': 'Call a human?',
+    'talk to a human': 'Call a human?',
+}
+
+# Regex (matched against the whole normalized text) -> BUTTONS key; extended by INTENT_PATTERNS
+DEFAULT_PATTERNS = {
+    r'(show|list|explore|see) (me )?(all )?(the )?trips': 'Explore trips?',
+    r'(trips|tours|packages) (in|to|for) himachal': 'Himachal Trips',
+    r'(call|talk to|speak (to|with)) (a |an )?(human|person|agent|someone)': 'Call a human?',
+}
+
+_PUNCTUATION_RE = re.compile(r'[\s?!.,;:]+$')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize(text):
+    """
+    Case-folds `text`, collapses whitespace and drops trailing punctuation.
+    """
+    text = _SPACE_RE.sub(' ', text.casefold()).strip()
+    return _PUNCTUATION_RE.sub('', text)
+
+
+def _load_table(variable, default):
+    table = dict(default)
+    value = os.getenv(variable)
+    if value:
+        try:
+            table.update(json.loads(value))
+        except ValueError as e:
+            logger.error('Ignoring invalid %s: %s', variable, e)
+    return table
+
+
+class IntentRouter:
+    """
+    Maps messages to static replies.
+
+    Parameters:
+    - replies: The static replies by intent (the BUTTONS table); intents with an empty reply are never routed
+    - keywords: Normalized keyword -> intent
+    - patterns: Regex -> intent, tried only when the keyword lookup misses
+    - flush_seconds: Least time between two metric records written by `flush`
+    """
+    def __init__(self, replies, keywords=None, patterns=None, flush_seconds=INTENT_FLUSH_SECONDS):
+        routable = {intent for intent, reply in replies.items() if reply}
+        self._lookup = {normalize(intent): intent for intent in routable}
+        for keyword, intent in (keywords or {}).items():
+            if intent in routable:
+                self._lookup[normalize(keyword)] = intent
+            else:
+                logger.warning('Keyword %r routes to unknown intent %r', keyword, intent)
+
+        self._pattern_intents = []
+        alternatives = []
+        for pattern, intent in (patterns or {}).items():
+            if intent not in routable:
+                logger.warning('Pattern %r routes to unknown intent %r', pattern, intent)
+                continue
+            alternatives.append('(?P<p{}>{})'.format(len(self._pattern_intents), pattern))
+            self._pattern_intents.append(intent)
+        self._pattern = re.compile('|'.join(alternatives)) if alternatives else None
+
+        self._stats_lock = threading.Lock()
+        self.stats = {'lookups': 0, 'hits': 0, 'pattern_hits': 0}
+        self.flush_seconds = flush_seconds
+        # Counts since the last flush: the stats as they were then, and hits per intent
+        self._flushed_stats = dict(self.stats)
+        self._intent_hits = {}
+        self._flushed_at = time.monotonic()
+
+    @classmethod
+    def from_config(cls, replies):
+        """
+        Builds a router from the default tables merged with INTENT_KEYWORDS and INTENT_PATTERNS.
+        """
+        return cls(replies, _load_table('INTENT_KEYWORDS', DEFAULT_KEYWORDS),
+                   _load_table('INTENT_PATTERNS', DEFAULT_PATTERNS))
+
+    def _match(self, text):
+        intent = self._lookup.get(text)
+        if intent is not None or self._pattern is None:
+            return intent, False
+        match = self._pattern.fullmatch(text)
+        if match is None:
+            return None, False
+        return self._pattern_intents[int(match.lastgroup[1:])], True
+
+    def route(self, text):
+        """
+        Returns the intent (BUTTONS key) that answers `text`, or None if it should go to the backend.
+        """
+        intent, by_pattern = self._match(normalize(text))
+        with self._stats_lock:
+            self.stats['lookups'] += 1
+            if intent is not None:
+                self.stats['hits'] += 1
+                self._intent_hits[intent] = self._intent_hits.get(intent, 0) + 1
+                if by_pattern:
+                    self.stats['pattern_hits'] += 1
+        return intent
+
+    def would_route(self, text):
+        """
+        Returns whether `route(text)` would answer `text` locally, without counting a lookup.
+        """
+        return self._match(normalize(text))[0] is not None
+
+    def flush(self, force=False):
+        """
+        Emits the lookups and hits counted since the last flush as one EMF record, if
+        `flush_seconds` have passed since then (or `force`).
+        """
+        now = time.monotonic()
+        with self._stats_lock:
+            if self.stats['lookups'] == self._flushed_stats['lookups'] or \
+                    (not force and now - self._flushed_at < self.flush_seconds):
+                return
+            counts = {key: value - self._flushed_stats[key] for key, value in self.stats.items()}
+            intents, self._intent_hits = self._intent_hits, {}
+            self._flushed_stats = dict(self.stats)
+            self._flushed_at = now
+        # IntentHits over IntentLookups, summed in CloudWatch, gives the hit rate
+        emit_metrics({'IntentLookups': (counts['lookups'], 'Count'), 'IntentHits': (counts['hits'], 'Count'),
+                      'IntentPatternHits': (counts['pattern_hits'], 'Count')},
+                     {'Stage': 'intent_router'}, {'intents': intents})
+
+    def get_stats(self):
+        """
+        Returns a snapshot of the counters, with the hit rate.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['hit_rate'] = round(stats['hits'] / stats['lookups'], 4) if stats['lookups'] else 0.0
+        return stats
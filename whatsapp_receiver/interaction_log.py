@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Most recent interactions kept on a conversation entry; older ones are trimmed
+INTERACTIONS_MAX = int(os.getenv('INTERACTIONS_MAX', '200'))
+
+
+class InteractionBuffer:
+    """
+    Collects the interactions of an invocation in memory and writes them to the
+    conversation entries in one append (a list_append UpdateItem on DynamoDB) per
+    conversation on `flush`, instead of one write per message.
+    """
+    def __init__(self, max_interactions=INTERACTIONS_MAX):
+        self.max_interactions = max_interactions
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def record(self, mobile, interaction_type, content, date=None):
+        """
+        Buffers an interaction for the conversation of `mobile` on `date` (defaults to today).
+
+        Parameters:
+        - mobile: The mobile number the conversation is stored under
+        - interaction_type: 'text' or 'button' for inbound messages, 'reply' for our answers
+        - content: The message text, button text or a description of the reply
+        """
+        now = datetime.now()
+        key = (mobile, date or now.strftime('%Y-%m-%d'))
+        interaction = {'date_time': now.strftime('%Y-%m-%d %H:%M:%S'), 'type': interaction_type,
+                       'content': content or ''}
+        with self._lock:
+            self._pending.setdefault(key, []).append(interaction)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(v) for v in self._pending.values())
+
+    def flush(self, store, deadline=None):
+        """
+        Appends the buffered interactions to their conversation entries and clears the buffer.
+        Entries that grow past `max_interactions` have their oldest interactions trimmed.
+
+        Parameters:
+        - store: The ConversationStore
+        - deadline: Optional time.monotonic() value; conversations not written by then stay
+          buffered for the next flush
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for (mobile, cr_date), interactions in pending.items():
+            if deadline is not None and time.monotonic() >= deadline:
+                self._restore(pending, (mobile, cr_date))
+                return
+            try:
+                count = store.append_interactions(mobile, cr_date, interactions)
+                if count > self.max_interactions:
+                    self._trim(store, mobile, cr_date, count)
+            except Exception as e:
+                logger.error("Error logging %s interactions for %s: %s", len(interactions), mobile, e)
+
+    def _restore(self, pending, first_key):
+        # Puts the conversations from `first_key` on back in the buffer, ahead of anything logged since
+        keys = list(pending)
+        with self._lock:
+            for key in keys[keys.index(first_key):]:
+                self._pending[key] = pending[key] + self._pending.get(key, [])
+
+    def _trim(self, store, mobile, cr_date, count):
+        # Remove the oldest entries so the item stays small enough for cheap reads. A concurrent
+        # flush that already trimmed this entry makes the store skip it.
+        try:
+            if not store.trim_interactions(mobile, cr_date, count, self.max_interactions):
+                logger.info("Interactions for %s were already trimmed", mobile)
+        except Exception as e:
+            logger.warning("Skipped trimming interactions for %s: %s", mobile, e)
+
+
+interaction_log = InteractionBuffer()
@@ -1,24 +1,69 @@
-import requests
 import json
-import boto3
 import os
-from conversation_util import find_conversation_and_communicate
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from conversation_util import (CHAT_BATCH_WINDOW_MS, ChatBatcher, call_musafir, find_conversation_and_communicate,
+                               prefetch_conversations, use_chat_batcher)
+from conversation_store import TOKEN, get_conversation_store
+from graph_api import (RateLimitedError, deferred_queue, emit_outbound_metrics, get_sender, message_fragment,
+                       outbound_queue, requeue, send_chain)
+from interaction_log import interaction_log
+from tracing import deadline_after, set_correlation_id, set_deadline
+from log_util import get_logger
+from history_query import QueryError, chunk_messages, iter_history, may_query, parse_filter
+from aws_clients import get_client, get_resource
+from warmup import is_warmup_event, run_warmup
+from intent_router import INTENT_ROUTER_ENABLED, IntentRouter
+from idempotency import IDEMPOTENCY_ENABLED, idempotency_store
+from media_registry import MediaRegistry
+from turn_coalescer import COALESCE_WINDOW_MS, turn_coalescer
+from webhook_classifier import STATUS_COUNTER_ENABLED, iter_messages, may_have_messages, status_counter
 
-client = boto3.client('sqs')
+logger = get_logger(__name__)
+
+# 'inline' processes messages inside the webhook, 'sqs' enqueues them for sqs_worker_handler and acks
+INGEST_MODE = os.getenv('INGEST_MODE', 'inline')
+INGEST_QUEUE_URL = os.getenv('INGEST_QUEUE_URL', 'https://sqs.ap-south-1.amazonaws.com/994442116312/whatsapp_events')
+SQS_BATCH_SIZE = 10
 
 def push_event(msg):
 
-    ingest_queue_url = 'https://sqs.ap-south-1.amazonaws.com/994442116312/whatsapp_events'
+    ingest_queue_url = INGEST_QUEUE_URL
     msg = json.dumps(msg)
-    response = client.send_message(QueueUrl=ingest_queue_url, MessageBody=msg)
-    print('Pushed to SQS, Response -- ', response)
+    response = get_client('sqs').send_message(QueueUrl=ingest_queue_url, MessageBody=msg)
+    logger.debug('Pushed to SQS, Response -- %s', response)
+
+def push_events(records):
+    """
+    Enqueues message records to the ingest queue with SendMessageBatch, 10 per call.
+    On a FIFO queue records are grouped by mobile so each user's messages stay in order.
+    Returns the records that could not be enqueued.
+    """
+    fifo = INGEST_QUEUE_URL.endswith('.fifo')
+    failed = []
+    for start in range(0, len(records), SQS_BATCH_SIZE):
+        chunk = records[start:start + SQS_BATCH_SIZE]
+        entries = []
+        for i, record in enumerate(chunk):
+            entry = {'Id': str(i), 'MessageBody': json.dumps(record, separators=(',', ':'))}
+            if fifo:
+                entry['MessageGroupId'] = record['mobile']
+                entry['MessageDeduplicationId'] = record['m_id']
+            entries.append(entry)
+        try:
+            response = get_client('sqs').send_message_batch(QueueUrl=INGEST_QUEUE_URL, Entries=entries)
+        except Exception as e:
+            logger.error('Exception occurred while pushing to SQS -- %s', e)
+            failed.extend(chunk)
+            continue
+        for f in response.get('Failed', []):
+            logger.error('SQS rejected message -- %s', f)
+            failed.append(chunk[int(f['Id'])])
+    return failed
     
 def get_variable(var):
     return os.environ[var]
 
-def get_template(t_type):
-    return {'name': t_type, 'language': {'code': 'en'}}
-
 BUTTONS = {
             'Call a human?': {'text': 'Ok. sure. I will ask my team to contact you, Thank you!'},
             'Explore trips?':{'template': 'trip_state_buttons'},
@@ -28,99 +73,99 @@ BUTTONS = {
             'Manali Solang Kasol': {'document': '500205981511357', 'filename': 'Manali Solang Kasol.pdf'} 
          }
 
-def send_msg(msg):
+# Current media ids of the brochures in BUTTONS; the ids above are the fallback. Brochures
+# configured only in MEDIA_SOURCES become replies as well, sent once they have been uploaded.
+media_registry = MediaRegistry.from_config(BUTTONS, lambda *upload: get_sender().upload_media(*upload))
+for _name, _document in media_registry.documents.items():
+    BUTTONS.setdefault(_name, {'document': _document['fallback_id'], 'filename': _document['filename']})
+
+# Template sent after every document, quoting the document message
+DOCUMENT_FOLLOW_UP = message_fragment({'template': 'interested_trip1'})
+
+# BUTTONS replies serialized once at import. Brochures configured only in MEDIA_SOURCES have no
+# fallback id to serialize; button_fragment builds theirs once the registry has an id.
+_MEDIA_ONLY = {name for name, document in media_registry.documents.items() if document['fallback_id'] is None}
+BUTTON_FRAGMENTS = {k: message_fragment(v) for k, v in BUTTONS.items() if k not in _MEDIA_ONLY}
+# Document replies serialized per media id, as the registry replaces ids
+_document_fragments = {}
+
+# Answers menu keywords and exact button texts typed as free text without calling the backend
+intent_router = IntentRouter.from_config(BUTTONS)
+
+# Seconds the handler waits for queued follow-up messages before returning. Lambda freezes the
+# outbound thread once the handler returns, so whatever is still queued waits for the next invocation.
+OUTBOUND_FLUSH_TIMEOUT = float(os.getenv('OUTBOUND_FLUSH_TIMEOUT', '3'))
+
+def send_msg(msg, fragment=None):
     try:
         mobile = msg['mobile']
-        payload = { 
-            "messaging_product": "whatsapp",
-            "to": mobile
-            }
-    
-        if 'message_id' in msg:
-            payload["context"] = {
-                            "message_id": msg['message_id']
-                        }
-        if 'template' in msg:
-            payload['type'] = 'template'
-            payload['template'] =  get_template(msg['template'])
-            
-        if 'text' in msg:
-            payload['type'] = 'text'
-            payload['text'] = {
-                                "preview_url": False,
-                                "body": msg['text']
-                            }
-        if 'document' in msg:
-            payload['type'] = 'document'
-            payload['document'] = {
-                                 "id": msg['document'],
-                                 "filename": msg['filename']    
-                                } 
-        v = get_variable('version')
-        phone_number_id = get_variable('phone_number_id')
-        token = get_variable('token')
-        url = 'https://graph.facebook.com/{}/{}/messages'.format(v,phone_number_id)
-        
-        headers = {
-          'Content-Type': 'application/json',
-          'Authorization': 'Bearer {}'.format(token)
-         }
-        print('payload --', payload)
-        response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
-        print('response of the API --', response.text)
-        if payload['type'] == 'document':
-            response = json.loads(response.text)
-            message_id = response['messages'][0]['id']
-            msg = {'mobile': mobile, 'message_id': message_id, 'template': 'interested_trip1'}
-            send_msg(msg)
+        fragment = fragment or message_fragment(msg)
+        if fragment is None:
+            logger.warning('Nothing to send for message -- %s', msg)
+            return
+        chain = [(fragment, False), (DOCUMENT_FOLLOW_UP, True)] if 'document' in msg else [(fragment, False)]
+        try:
+            response = get_sender().send(mobile, fragment, msg.get('message_id'))
+        except RateLimitedError as e:
+            # Don't lose the reply: the deferred queue keeps retrying it within the rate limits
+            logger.warning('Reply to %s deferred to the outbound queue -- %s', mobile, e)
+            deferred_queue.submit(mobile, chain, msg.get('message_id'))
+            return
+        if 'document' in msg and response.get('messages'):
+            # The document is sent; only its follow-up template, which quotes it, is queued. With
+            # an SQS worker the webhook doesn't wait for it; otherwise the bounded flush does.
+            deferred_queue.submit(mobile, chain[1:], response['messages'][0]['id'])
     except Exception as e:
-        print('Exception occurred -- ', str(e))
+        logger.error('Exception occurred -- %s', e)
         return {'statusCode': 200, 'body': 'ok'}
 
-def contacts(contact_list):
-    names = []
-    for cl in contact_list:
-        name = cl['profile']['name']
-        names.append(name)
-        print('name -- ', name)
-        print('wa_id --', cl['wa_id'])
-    return names
-
+# WhatsApp rejects text bodies longer than this
+WHATSAPP_TEXT_LIMIT = 4096
+SERVICE_DOWN_REPLY = 'Services are currently down, please try again after sometime.'
+BUSY_REPLY = os.getenv('BUSY_REPLY', 'We are seeing a lot of requests right now, please try again in a few minutes.')
+NO_HISTORY_FOUND = 'No data found, try with different inputs'
+HISTORY_NOT_ALLOWED = 'You can only look up your own conversations'
 
-def readable(event):
-    if event['type'] == 'text':
-        msg = '{} : User sent text - {}'.format(event['date_time'], event['content'])
-    elif event['type'] == 'button':
-        msg = '{} : User pressed button - {}'.format(event['date_time'], event['content'])
-    return msg
+# 'sequential' processes webhook messages one by one, 'concurrent' processes users in parallel
+WEBHOOK_EXECUTION_MODE = os.getenv('WEBHOOK_EXECUTION_MODE', 'sequential')
+WEBHOOK_MAX_WORKERS = int(os.getenv('WEBHOOK_MAX_WORKERS', '8'))
+# Time budget for a webhook before we return 200, kept below Meta's delivery timeout
+WEBHOOK_DEADLINE_MS = int(os.getenv('WEBHOOK_DEADLINE_MS', '8000'))
+DEADLINE_SAFETY_MS = 500
+_executor = None
 
 def query_result(data):
+    headers = { "Access-Control-Allow-Origin" : "*"}
     try:
-        query = data['query']
-        query = query.replace('filter(', '')
-        query = query[:-1]
-        filters = list(map(str,query.split(',')))
-        for f in filters:
-            obj,value = map(str,f.split(':'))
-            if obj=='mobile':
-                mobile = value
-            elif obj == 'date':
-                date = value
-        conv = get_conversation(mobile, date)
-        if conv:
-            msg = []
-            for c in conv['interactions']:
-                msg.append(readable(c))
-            msg_data = {'mobile': mobile, 'messages': msg} 
-        else:
-            msg_data = {'mobile': mobile, 'messages': ['No data found, try with different inputs']}
+        query = parse_filter(data['query'])
+    except QueryError as e:
+        logger.warning('Invalid query -- %s', e)
         if data['source'] == 'whatsapp':
-            msg_data = {'mobile': data['to_mobile'], 'message_id': data['msg_id'], 'type': 'text', 'text': str(msg)}
-            send_msg(msg_data)
-        headers = { "Access-Control-Allow-Origin" : "*"}
+            send_msg({'mobile': data['to_mobile'], 'message_id': data['msg_id'], 'text': str(e)})
+        return {'statusCode': 400, 'headers': headers, 'body': str(e)}
+    if data['source'] == 'whatsapp' and not may_query(query, data['to_mobile']):
+        logger.warning('%s may not query the history of %s', data['to_mobile'], query.mobile)
+        send_msg({'mobile': data['to_mobile'], 'message_id': data['msg_id'], 'text': HISTORY_NOT_ALLOWED})
+        return {'statusCode': 403, 'headers': headers, 'body': HISTORY_NOT_ALLOWED}
+    try:
+        lines = iter_history(query, get_conversation_store())
+        if data['source'] == 'whatsapp':
+            # Stream the history out as it is read, split into messages under WhatsApp's size limit
+            sent = 0
+            for chunk in chunk_messages(lines, WHATSAPP_TEXT_LIMIT):
+                send_msg({'mobile': data['to_mobile'], 'message_id': data['msg_id'], 'text': chunk})
+                sent += 1
+            if not sent:
+                send_msg({'mobile': data['to_mobile'], 'message_id': data['msg_id'], 'text': NO_HISTORY_FOUND})
+            if query.next_cursor:
+                send_msg({'mobile': data['to_mobile'], 'text': 'More results: get=' + query.with_cursor(query.next_cursor)})
+            msg_data = {'mobile': query.mobile, 'sent': sent}
+        else:
+            msg = list(lines)
+            msg_data = {'mobile': query.mobile, 'messages': msg or [NO_HISTORY_FOUND], 'next_cursor': query.next_cursor}
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps(msg_data)}
     except Exception as e:
-        print('Exception occurred -- ', str(e))
+        logger.error('Exception occurred -- %s', e)
         return {'statusCode': 500, 'headers': headers, 'body': str(e)}
         
 def cors_headers():
@@ -131,57 +176,367 @@ def cors_headers():
     }
     return {'statusCode': 200,'headers': headers, 'body': 'ok'}
     
+def _warm_aws_clients():
+    clients = ['dynamodb']
+    get_resource('dynamodb')
+    if INGEST_MODE == 'sqs':
+        get_client('sqs')
+        clients.append('sqs')
+    return clients
+
+def _warm_conversation_store():
+    # Any read opens the keep-alive connection to DynamoDB; the key does not need to exist
+    get_conversation_store().get('warmup', '0000-00-00', TOKEN)
+
+def _warm_musafir():
+    # Warms musafir-interface (secret, smart-chat connection) and our connection to it
+    response = call_musafir({'method': 'warmup'})
+    if not response.success:
+        raise RuntimeError(response.message or 'musafir-interface warm-up failed')
+    return response.data
+
+def _warm_media():
+    # Uploads the brochures whose media ids are missing or about to expire
+    report = media_registry.refresh()
+    errors = {name: outcome for name, outcome in report.items() if outcome.startswith('error')}
+    if errors:
+        raise RuntimeError('Media refresh failed for {}'.format(', '.join(errors)))
+    return report
+
+def warm_up(include_musafir=True):
+    """
+    Initializes the AWS clients and opens the pooled connections to DynamoDB and the Graph
+    API, and optionally warms musafir-interface as well, so the first real message after a
+    scale-out pays for none of it.
+
+    Returns:
+    - The warm-up report, see `run_warmup`
+    """
+    steps = [
+        ('aws_clients', _warm_aws_clients),
+        ('conversation_store', _warm_conversation_store),
+        ('graph_connection', lambda: get_sender().warm()),
+    ]
+    if media_registry.enabled:
+        steps.append(('media_registry', _warm_media))
+    if include_musafir:
+        steps.append(('musafir', _warm_musafir))
+    return run_warmup(steps)
+
+def message_record(message, c_name):
+    """
+    Reduces a webhook message to the compact record used for processing.
+    Returns None for message types we don't handle.
+    """
+    event_type = message['type']
+    if event_type == 'text':
+        content = message['text']['body']
+    elif event_type == 'button':
+        content = message['button']['text']
+    else:
+        return None
+    return {'mobile': message['from'], 'c_name': c_name, 'm_id': message['id'],
+            'timestamp': message['timestamp'], 'type': event_type, 'content': content}
+
+def is_chat_turn(record):
+    # Free text that goes to smart chat, rather than a history query or a routed intent
+    if record['type'] != 'text' or record['content'].startswith('get='):
+        return False
+    return not (INTENT_ROUTER_ENABLED and intent_router.would_route(record['content']))
+
+def process_record(record, turn_follows=False):
+    """
+    Handles one message. `turn_follows` tells that a later chat message of the same user is
+    being processed too, so with coalescing this one is left for it to send.
+    """
+    mobile = record['mobile']
+    content = record['content']
+    if record['type'] == 'text':
+        if content.startswith('get='):
+            data = {'query': content.replace('get=',''), 'source': 'whatsapp', 'to_mobile': mobile, 'msg_id': record['m_id']}
+            return query_result(data)
+        # msg_data = {'mobile': mobile, 'template': 't_greeting'}
+        # send_msg(msg_data)
+        interaction_log.record(mobile[2:], 'text', content)
+        intent = intent_router.route(content) if INTENT_ROUTER_ENABLED else None
+        if intent:
+            send_static_reply(mobile, intent)
+            return
+        if COALESCE_WINDOW_MS:
+            # Rapid follow-ups are sent as one turn, answered by whichever message came last
+            content = turn_coalescer.coalesce(mobile[2:], content, wait=not turn_follows)
+            if content is None:
+                return
+        chat_response = find_conversation_and_communicate(mobile[2:], record['c_name'], content)
+        if chat_response["success"]:
+            text = chat_response.get('content')
+        elif chat_response.get('status_code') == 503:
+            # musafir-interface's circuit is open: it failed fast, so the user hears back at once
+            text = BUSY_REPLY
+        else:
+            text = SERVICE_DOWN_REPLY
+        msg_data = {'mobile': mobile, 'text': text}
+        send_msg(msg_data)
+        interaction_log.record(mobile[2:], 'reply', text)
+    elif record['type'] == 'button':
+        interaction_log.record(mobile[2:], 'button', content)
+        send_static_reply(mobile, content)
+
+def button_fragment(key):
+    """
+    Returns the serialized BUTTONS reply for `key`, with the brochure's current media id for
+    documents. None if a document has no media id yet.
+    """
+    reply = BUTTONS[key]
+    if 'document' not in reply or not media_registry.enabled:
+        return BUTTON_FRAGMENTS.get(key)
+    media_id = media_registry.media_id(key, reply['document'])
+    if media_id is None:
+        return None
+    fragment = _document_fragments.get(media_id)
+    if fragment is None:
+        fragment = _document_fragments[media_id] = message_fragment(dict(reply, document=media_id))
+    return fragment
+
+def send_static_reply(mobile, key):
+    # Sends the BUTTONS reply for `key` and logs it
+    fragment = button_fragment(key)
+    if fragment is None and 'document' in BUTTONS[key]:
+        logger.warning('No media id for %s yet, not sending it', key)
+        return
+    msg_data = {'mobile': mobile}
+    msg_data.update(BUTTONS[key])
+    send_msg(msg_data, fragment)
+    interaction_log.record(mobile[2:], 'reply', describe_reply(BUTTONS[key]))
+
+def describe_reply(msg):
+    # Short description of a static reply for the interaction log
+    if 'text' in msg:
+        return msg['text']
+    if 'template' in msg:
+        return 'template ' + msg['template']
+    if 'document' in msg:
+        return 'document ' + msg['filename']
+    return ''
+
+def process_user_records(records, stop_on_error=False, deadline=None, mark_done=IDEMPOTENCY_ENABLED,
+                         chat_batcher=None):
+    """
+    Processes the records of one user strictly in the order they were received.
+    Returns the records that were not processed: the failed ones, plus every record after
+    the first failure when `stop_on_error` is set.
+    `deadline` (see `tracing.deadline_after`) bounds every musafir-interface call made on the way.
+    With `mark_done`, each processed message is marked done in the idempotency store.
+    With a `chat_batcher`, chat messages are sent together with those of the other users
+    being processed at the same time.
+    """
+    # Set per thread, since records may be processed on the executor
+    set_deadline(deadline)
+    use_chat_batcher(chat_batcher)
+    failed = []
+    try:
+        for i, record in enumerate(records):
+            # The WhatsApp message id follows the message through every stage and backend call
+            set_correlation_id(record['m_id'])
+            try:
+                process_record(record, any(is_chat_turn(later) for later in records[i + 1:]))
+                if mark_done:
+                    idempotency_store.complete(record['m_id'])
+            except Exception as e:
+                logger.exception('Exception occurred while processing message %s -- %s', record['m_id'], e)
+                if stop_on_error:
+                    return records[i:]
+                failed.append(record)
+        return failed
+    finally:
+        use_chat_batcher(None)
+
+def new_chat_batcher(groups):
+    # Only users processed in parallel can share a send_chat_batch call
+    if CHAT_BATCH_WINDOW_MS and len(groups) > 1:
+        return ChatBatcher()
+    return None
+
+def prefetch_user_sessions(by_mobile):
+    # One batch read of the chat sessions of every user with text to send to smart chat,
+    # instead of a read per user
+    mobiles = [mobile[2:] for mobile, records in by_mobile.items()
+               if any(record['type'] == 'text' for record in records)]
+    if len(mobiles) > 1:
+        prefetch_conversations(mobiles)
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WEBHOOK_MAX_WORKERS, thread_name_prefix='webhook')
+    return _executor
+
+def remaining_seconds(context):
+    # Time left in this invocation, minus a safety margin
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return WEBHOOK_DEADLINE_MS / 1000
+    return max(context.get_remaining_time_in_millis() - DEADLINE_SAFETY_MS, 0) / 1000
+
+def webhook_deadline(context):
+    # Seconds we may spend processing before we have to answer the webhook
+    deadline_ms = WEBHOOK_DEADLINE_MS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline_ms = min(deadline_ms, context.get_remaining_time_in_millis() - DEADLINE_SAFETY_MS)
+    return max(deadline_ms, 0) / 1000
+
+def process_records(records, context, respond_by):
+    """
+    Processes the records of one webhook. In 'concurrent' mode records of different users run
+    in parallel on a thread pool while each user's records stay in order, and the call returns
+    at `respond_by` (the webhook deadline, on the time.monotonic clock) even if some users are
+    still being served.
+    """
+    # Chat calls may use the rest of the invocation, not just the webhook budget
+    deadline = deadline_after(remaining_seconds(context) * 1000)
+    if WEBHOOK_EXECUTION_MODE != 'concurrent' or len(records) < 2:
+        process_user_records(records, deadline=deadline)
+        return
+
+    by_mobile = {}
+    for record in records:
+        by_mobile.setdefault(record['mobile'], []).append(record)
+
+    prefetch_user_sessions(by_mobile)
+    chat_batcher = new_chat_batcher(by_mobile)
+    executor = get_executor()
+    futures = [executor.submit(process_user_records, user_records, deadline=deadline, chat_batcher=chat_batcher)
+               for user_records in by_mobile.values()]
+    done, not_done = wait(futures, timeout=max(respond_by - time.monotonic(), 0))
+    if not_done:
+        # Lambda freezes these threads once we return; they resume on the next warm invocation
+        logger.warning('Webhook deadline reached with %s of %s users still in progress', len(not_done), len(futures))
+
 def lambda_handler(event, context):
-    print(event)
+    logger.debug('event -- %s', event)
+    # Clears whatever deadline a previous invocation left on this thread
+    set_deadline(deadline_after(remaining_seconds(context) * 1000))
+    # Everything up to the 200, flushes included, has to fit in the webhook budget
+    respond_by = time.monotonic() + webhook_deadline(context)
+    if is_warmup_event(event):
+        return {'statusCode': 200, 'body': json.dumps(warm_up(event.get('musafir', True)))}
     if 'httpMethod' in event and event['httpMethod'] == 'OPTIONS':
         return cors_headers()
     if "queryStringParameters" in event and event["queryStringParameters"] and 'q' in event["queryStringParameters"]:
         data = {'query': event["queryStringParameters"]['q'], 'source': 'web'}
         return query_result(data)
-    if 'body' in event:
-        event = json.loads(event['body'])
-        print('event body -- ', event)
-        # return {'statusCode': 200, 'body': 'ok'} 
-    else:
+    if 'body' not in event:
         return {'statusCode': 200, 'body': 'ok'}
-    first_entry = event['entry'][0]
-    first_change = first_entry['changes'][0]
-    
-    # main object of the event
-    main_obj = first_change['value']
-    if 'contacts' in main_obj:
-        names = contacts(main_obj['contacts'])
-        c_name = names[0]
-    if 'messages' in main_obj:
-        for message in main_obj['messages']:
-            print('message -- ', message)
-            mobile = message['from']
-            msg_id = message['id']
-            timestamp = message['timestamp']
-            event_type = message['type']
-            if  event_type == 'text':
-                content = message['text']['body']
-                if content.startswith('get='):
-                    data = {'query': content.replace('get=',''), 'source': 'whatsapp', 'to_mobile': mobile, 'msg_id': msg_id}
-                    return query_result(data)
-                # msg_data = {'mobile': mobile, 'template': 't_greeting'}
-                # send_msg(msg_data)
-                chat_response = find_conversation_and_communicate(mobile[2:], c_name, content)
-                if chat_response["success"]:
-                    text = chat_response.get('content')
-                else:
-                    text = 'Services are currently down, please try again after sometime.'
-                msg_data = {'mobile': mobile, 'text': text}
-                send_msg(msg_data)
-            elif event_type == 'button':
-                button = message['button']
-                content = button['text']
-                msg_data = {'mobile': mobile}
-                msg_data.update(BUTTONS[content])
-                send_msg(msg_data)
-            else:
+    raw_body = event['body'] or ''
+    if STATUS_COUNTER_ENABLED and '"statuses"' in raw_body:
+        status_counter.add(raw_body)
+        status_counter.flush()
+    if not may_have_messages(raw_body):
+        # Status callbacks and other changes without user messages are acked unparsed
+        if not STATUS_COUNTER_ENABLED:
+            logger.debug('event body -- %s', raw_body)
+        return {'statusCode': 200, 'body': 'ok'}
+    event = json.loads(raw_body)
+    logger.debug('event body -- %s', event)
+
+    records = []
+    for message, c_name in iter_messages(event):
+        logger.debug('message -- %s', message)
+        record = message_record(message, c_name)
+        if record is not None:
+            records.append(record)
+    if records:
+        if IDEMPOTENCY_ENABLED:
+            # Meta redelivers webhooks we were slow to answer; never handle a message twice
+            records = idempotency_store.filter_new(records)
+            if not records:
                 return {'statusCode': 200, 'body': 'ok'}
-            # sqs_payload = {'mobile': mobile, 'c_name': c_name, 'm_id': msg_id, 'timestamp': timestamp, 'type': event_type, 'content': content}
-            # push_event(sqs_payload)
-        
+        if INGEST_MODE == 'sqs':
+            # Ack right away; sqs_worker_handler does the work. Whatever could not be
+            # enqueued is processed inline so it isn't lost.
+            failed = push_events(records)
+            if IDEMPOTENCY_ENABLED:
+                # Once enqueued, retries are up to SQS
+                for record in records:
+                    if record not in failed:
+                        idempotency_store.complete(record['m_id'])
+            records = failed
+        process_records(records, context, respond_by)
+        # One batched write per conversation for everything logged in this invocation
+        interaction_log.flush(get_conversation_store(), deadline=respond_by)
+
+    flush_timeout = min(OUTBOUND_FLUSH_TIMEOUT, max(respond_by - time.monotonic(), 0))
+    if flush_timeout and not outbound_queue.flush(flush_timeout):
+        logger.warning('%s outbound chains still queued when returning', outbound_queue.pending())
+    emit_outbound_metrics()
+    intent_router.flush()
     return {'statusCode': 200, 'body': 'ok'}
+
+def sqs_worker_handler(event, context):
+    """
+    Entry point for the SQS-triggered worker. Consumes batches of message records pushed by
+    the webhook in 'sqs' ingest mode, processes each user's records in order, and reports
+    partial batch failures so only the failed records (and those after them for the same
+    user) are retried.
+    """
+    by_mobile = {}
+    for sqs_record in event.get('Records', []):
+        try:
+            record = json.loads(sqs_record['body'])
+        except ValueError as e:
+            # A malformed record will never succeed, so don't retry it
+            logger.error('Dropping malformed SQS record %s -- %s', sqs_record['messageId'], e)
+            continue
+        record['sqs_message_id'] = sqs_record['messageId']
+        by_mobile.setdefault(record['mobile'], []).append(record)
+
+    groups = list(by_mobile.values())
+    prefetch_user_sessions(by_mobile)
+    deadline = deadline_after(remaining_seconds(context) * 1000)
+    if WEBHOOK_EXECUTION_MODE == 'concurrent' and len(groups) > 1:
+        executor = get_executor()
+        chat_batcher = new_chat_batcher(groups)
+        # The webhook marked these messages done when it enqueued them
+        results = executor.map(lambda records: process_user_records(records, True, deadline, False, chat_batcher),
+                               groups)
+    else:
+        results = [process_user_records(records, stop_on_error=True, deadline=deadline, mark_done=False)
+                   for records in groups]
+    failures = [{'itemIdentifier': r['sqs_message_id']} for failed in results for r in failed]
+
+    interaction_log.flush(get_conversation_store())
+    outbound_queue.flush(remaining_seconds(context))
+    emit_outbound_metrics()
+    intent_router.flush()
+    if failures:
+        logger.warning('Reporting %s failed SQS records', len(failures))
+    return {'batchItemFailures': failures}
+
+def outbound_worker_handler(event, context):
+    """
+    Entry point for the SQS-triggered sender used with OUTBOUND_QUEUE_MODE=sqs. Sends each
+    queued chain within the rate limits; chains that stay rate limited are re-queued with a
+    delay rather than failed, so the steps already sent are not repeated.
+    """
+    failures = []
+    for sqs_record in event.get('Records', []):
+        try:
+            item = json.loads(sqs_record['body'])
+            set_correlation_id(item.get('correlation_id'))
+            remaining = send_chain(item)
+            if remaining is not None:
+                requeue(outbound_queue, remaining)
+        except Exception as e:
+            logger.exception('Exception occurred while sending queued messages %s -- %s', sqs_record['messageId'], e)
+            failures.append({'itemIdentifier': sqs_record['messageId']})
+    emit_outbound_metrics()
+    return {'batchItemFailures': failures}
+
+def media_refresh_handler(event, context):
+    """
+    Entry point for the scheduled media refresh (e.g. a daily EventBridge rule). Uploads the
+    brochures that changed or whose media ids expire within MEDIA_REFRESH_BEFORE_SECONDS, or
+    all of them with `{"force": true}`.
+    """
+    report = media_registry.refresh(force=bool((event or {}).get('force')))
+    logger.info('Media refresh -- %s', report)
+    return report
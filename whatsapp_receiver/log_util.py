@@ -0,0 +1,87 @@
+"""
+Shared logging setup: levels, lazy %-style formatting, per-level sampling, payload
+truncation and token redaction. Configured once at import; modules get their logger
+with `get_logger(__name__)`. This module is kept identical in whatsapp_receiver and
+musafir-interface.
+"""
+import logging
+import os
+import random
+import re
+import sys
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Longest message written before it is cut off
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', '2000'))
+# Fraction of records kept per level, e.g. "DEBUG=0.05,INFO=0.5"; unlisted levels keep everything
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+_REDACTED = '***'
+_TOKEN_PATTERNS = [
+    # Authorization headers
+    re.compile(r'(Bearer\s+)[^\s\'",}]+', re.IGNORECASE),
+    # Token-like fields in dicts, JSON and key=value text; an auth scheme is masked with its credentials
+    re.compile(r'''(?<!\w)(['"]?(?:access_?token|authorization|secret_?token|token)['"]?\s*[:=]\s*['"]?)'''
+               r'''(?:(?:basic|bearer|digest|token)\s+)?[^\s'",}&]+''', re.IGNORECASE),
+]
+
+
+def _parse_sample_rates(spec):
+    rates = {}
+    for part in spec.split(','):
+        level, sep, rate = part.partition('=')
+        if sep:
+            rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+def redact(text):
+    """
+    Masks bearer tokens and token-like fields in `text`.
+    """
+    for pattern in _TOKEN_PATTERNS:
+        text = pattern.sub(lambda m: m.group(1) + _REDACTED, text)
+    return text
+
+
+def truncate(text, limit=LOG_MAX_LENGTH):
+    if len(text) <= limit:
+        return text
+    return '{}... [{} more chars]'.format(text[:limit], len(text) - limit)
+
+
+class _SamplingRedactingFilter(logging.Filter):
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return False
+        # The message is only formatted here, after the level check and sampling
+        record.msg = truncate(redact(record.getMessage()))
+        record.args = None
+        return True
+
+
+_root = logging.getLogger('itt')
+
+
+def _configure():
+    if _root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(name)s %(message)s'))
+    handler.addFilter(_SamplingRedactingFilter(_parse_sample_rates(LOG_SAMPLE_RATES)))
+    _root.addHandler(handler)
+    _root.setLevel(LOG_LEVEL)
+    # The Lambda runtime has its own root handler; don't log everything twice
+    _root.propagate = False
+
+
+def get_logger(name):
+    return _root.getChild(name)
+
+
+_configure()
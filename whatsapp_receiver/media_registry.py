@@ -0,0 +1,214 @@
+"""
+Keeps valid Graph media ids for the trip brochures sent as documents.
+
+Each brochure name maps to a source file, local or in S3. `refresh` uploads a source to the
+Graph media endpoint when its content has no id yet or the id is about to expire, and
+records the id in DynamoDB keyed by the content hash, so an unchanged file is never uploaded
+twice; a conditional write on the hash item makes sure only one container uploads it. It runs at warm-up and on a schedule (see `lambda_function.media_refresh_handler`);
+sends only ever look ids up, and fall back to the id configured in BUTTONS.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+
+from aws_clients import error_code, get_client, get_resource
+from ttl_cache import TTLCache
+from tracing import emit_metrics
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Directory or s3://bucket/prefix holding the brochure files named in BUTTONS (empty = registry off)
+MEDIA_SOURCE_ROOT = os.getenv('MEDIA_SOURCE_ROOT', '')
+# JSON object of brochure name -> source path or s3:// URI; adds brochures or overrides their source
+MEDIA_SOURCES = os.getenv('MEDIA_SOURCES', '')
+# DynamoDB table keyed by `media_key`: 'hash:<sha256>' -> the uploaded id, 'name:<brochure>' -> its current one
+MEDIA_TABLE = os.getenv('MEDIA_TABLE', 'media_cache')
+# Meta keeps uploaded media for 30 days; ids are replaced this long before that
+MEDIA_ID_TTL_SECONDS = int(os.getenv('MEDIA_ID_TTL_SECONDS', str(30 * 24 * 3600)))
+MEDIA_REFRESH_BEFORE_SECONDS = int(os.getenv('MEDIA_REFRESH_BEFORE_SECONDS', str(3 * 24 * 3600)))
+# How long a container uses an id it looked up before reading it again
+MEDIA_CACHE_SECONDS = int(os.getenv('MEDIA_CACHE_SECONDS', '300'))
+# How long a container holds the upload of a content hash before another may take it over
+MEDIA_UPLOAD_LEASE_SECONDS = int(os.getenv('MEDIA_UPLOAD_LEASE_SECONDS', '300'))
+
+
+def _join(root, filename):
+    return root.rstrip('/') + '/' + filename
+
+
+def _parse_s3(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def source_version(source):
+    """
+    Returns a cheap fingerprint of `source` (S3 ETag, or size and mtime of a local file) that
+    changes when the file does, so unchanged files are not read again.
+    """
+    if source.startswith('s3://'):
+        bucket, key = _parse_s3(source)
+        return get_client('s3').head_object(Bucket=bucket, Key=key)['ETag']
+    stat = os.stat(source)
+    return '{}-{}'.format(stat.st_size, int(stat.st_mtime))
+
+
+def read_source(source):
+    if source.startswith('s3://'):
+        bucket, key = _parse_s3(source)
+        return get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+class MediaRegistry:
+    """
+    Maps brochure names to media ids.
+
+    Parameters:
+    - documents: Brochure name -> {'filename', 'source', 'fallback_id'}
+    - uploader: Callable (content, filename, mime_type) -> media id, used by `refresh` only
+    """
+    def __init__(self, documents, uploader=None, table_name=MEDIA_TABLE):
+        self.documents = documents
+        self.uploader = uploader
+        self.table_name = table_name
+        self.cache = TTLCache(max(len(documents), 1) * 2, MEDIA_CACHE_SECONDS)
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, replies, uploader=None):
+        """
+        Builds a registry for the document replies of the BUTTONS table, with sources under
+        MEDIA_SOURCE_ROOT, extended by MEDIA_SOURCES.
+        """
+        documents = {}
+        for name, reply in replies.items():
+            if 'document' in reply and MEDIA_SOURCE_ROOT:
+                documents[name] = {'filename': reply['filename'], 'source': _join(MEDIA_SOURCE_ROOT, reply['filename']),
+                                   'fallback_id': reply['document']}
+        if MEDIA_SOURCES:
+            try:
+                for name, source in json.loads(MEDIA_SOURCES).items():
+                    document = documents.setdefault(name, {'fallback_id': None})
+                    document.update(source=source, filename=os.path.basename(source))
+            except ValueError as e:
+                logger.error('Ignoring invalid MEDIA_SOURCES: %s', e)
+        return cls(documents, uploader)
+
+    @property
+    def enabled(self):
+        return bool(self.documents)
+
+    def _table(self):
+        return get_resource('dynamodb').Table(self.table_name)
+
+    def media_id(self, name, fallback=None):
+        """
+        Returns the current media id of brochure `name`, or `fallback` if there is no valid one.
+        Never uploads; at most reads the id from DynamoDB when it isn't cached.
+        """
+        if name not in self.documents:
+            return fallback
+        entry = self.cache.get(name)
+        if entry is None:
+            try:
+                entry = self._table().get_item(Key={'media_key': 'name:' + name}).get('Item') or {}
+            except Exception as e:
+                logger.error("Error reading the media id of %s: %s", name, e)
+                entry = {}
+            self.cache.set(name, entry)
+        if entry.get('media_id') and int(entry['expires_at']) > time.time():
+            return entry['media_id']
+        if entry:
+            logger.warning("Media id of %s has expired, sending the fallback", name)
+        return fallback
+
+    def refresh(self, force=False):
+        """
+        Makes sure every brochure has a media id that won't expire soon, uploading the ones
+        that need it. Meant for warm-up and scheduled runs, not the request path.
+
+        Returns:
+        - A dict of brochure name -> 'current', 'linked' (already uploaded content), 'uploaded',
+          'uploading' (by another container) or an error
+        """
+        with self._refresh_lock:
+            report = {name: self._refresh_one(name, document, force) for name, document in self.documents.items()}
+        uploads = sum(1 for outcome in report.values() if outcome == 'uploaded')
+        if uploads:
+            emit_metrics({'MediaUploads': (uploads, 'Count')}, {'Stage': 'media_registry'})
+        return report
+
+    def _refresh_one(self, name, document, force):
+        try:
+            table = self._table()
+            now = int(time.time())
+            current = table.get_item(Key={'media_key': 'name:' + name}, ConsistentRead=True).get('Item') or {}
+            version = source_version(document['source'])
+            if not force and current.get('source_version') == version and \
+                    int(current.get('expires_at', 0)) - now > MEDIA_REFRESH_BEFORE_SECONDS:
+                self.cache.set(name, current)
+                return 'current'
+
+            content = read_source(document['source'])
+            content_hash = hashlib.sha256(content).hexdigest()
+            key = 'hash:' + content_hash
+            uploaded = table.get_item(Key={'media_key': key}, ConsistentRead=True).get('Item') or {}
+            outcome = 'linked'
+            if force or not uploaded.get('media_id') or \
+                    int(uploaded['expires_at']) - now <= MEDIA_REFRESH_BEFORE_SECONDS:
+                if not self._claim_upload(table, key, now, force):
+                    # Another container is uploading this content, or just has
+                    uploaded = table.get_item(Key={'media_key': key}, ConsistentRead=True).get('Item') or {}
+                    if not uploaded.get('media_id') or int(uploaded['expires_at']) <= now:
+                        return 'uploading'
+                else:
+                    uploaded = {'media_key': key, 'media_id': self._upload(table, key, content, document['filename']),
+                                'uploaded_at': now, 'expires_at': now + MEDIA_ID_TTL_SECONDS}
+                    # Replaces the item, dropping the upload lease
+                    table.put_item(Item=uploaded)
+                    outcome = 'uploaded'
+                    logger.info("Uploaded %s as media %s", name, uploaded['media_id'])
+
+            entry = {'media_key': 'name:' + name, 'media_id': uploaded['media_id'], 'content_hash': content_hash,
+                     'source_version': version, 'expires_at': int(uploaded['expires_at'])}
+            table.put_item(Item=entry)
+            self.cache.set(name, entry)
+            return outcome
+        except Exception as e:
+            logger.error("Error refreshing the media id of %s: %s", name, e)
+            return 'error: {}'.format(e)
+
+    @staticmethod
+    def _claim_upload(table, key, now, force):
+        """
+        Takes the upload of content hash `key` with a conditional write, unless another
+        container holds it or (without `force`) has already uploaded it. Returns whether it did.
+        """
+        condition = 'attribute_not_exists(upload_until) OR upload_until < :now'
+        values = {':now': now, ':until': now + MEDIA_UPLOAD_LEASE_SECONDS}
+        if not force:
+            condition = '({}) AND (attribute_not_exists(expires_at) OR expires_at <= :refresh_at)'.format(condition)
+            values[':refresh_at'] = now + MEDIA_REFRESH_BEFORE_SECONDS
+        try:
+            table.update_item(Key={'media_key': key}, UpdateExpression='SET upload_until = :until',
+                              ConditionExpression=condition, ExpressionAttributeValues=values)
+            return True
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def _upload(self, table, key, content, filename):
+        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        try:
+            return self.uploader(content, filename, mime_type)
+        except Exception:
+            # Let the next refresh, here or elsewhere, try again without waiting out the lease
+            table.update_item(Key={'media_key': key}, UpdateExpression='REMOVE upload_until')
+            raise
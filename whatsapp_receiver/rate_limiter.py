@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+from ttl_cache import TTLCache
+
+# Messages per second (and burst) allowed per business phone number, below Cloud API throughput
+GRAPH_NUMBER_RATE = float(os.getenv('GRAPH_NUMBER_RATE', '60'))
+GRAPH_NUMBER_BURST = int(os.getenv('GRAPH_NUMBER_BURST', '60'))
+# Messages per second (and burst) allowed to one recipient, to stay clear of the pair rate limit
+GRAPH_RECIPIENT_RATE = float(os.getenv('GRAPH_RECIPIENT_RATE', '1'))
+GRAPH_RECIPIENT_BURST = int(os.getenv('GRAPH_RECIPIENT_BURST', '5'))
+RECIPIENT_BUCKETS_MAX = int(os.getenv('RECIPIENT_BUCKETS_MAX', '10000'))
+
+# Graph API error code for too many messages to the same recipient
+PAIR_RATE_LIMIT_CODE = 131056
+
+
+class TokenBucket:
+    """
+    A token bucket that hands out reservations: a caller takes a token now and is told how
+    long to wait before using it, so concurrent callers are spaced out instead of retrying.
+    Not thread-safe; RateGovernor serializes access.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """
+        Takes a token and returns the seconds to wait before it may be used.
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def cancel(self):
+        # Hands back a reservation that won't be used
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds, now):
+        """
+        Empties the bucket so nothing more is let through for `seconds` (after a rate-limit error).
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateGovernor:
+    """
+    Spaces out Graph API sends with one token bucket per business phone number and one per
+    recipient. A send waits until both buckets allow it.
+    """
+    def __init__(self, number_rate=GRAPH_NUMBER_RATE, number_burst=GRAPH_NUMBER_BURST,
+                 recipient_rate=GRAPH_RECIPIENT_RATE, recipient_burst=GRAPH_RECIPIENT_BURST):
+        self.number_rate = number_rate
+        self.number_burst = number_burst
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self._numbers = {}
+        # An idle recipient's bucket is full again after burst / rate seconds, so it can be dropped
+        self._recipients = TTLCache(RECIPIENT_BUCKETS_MAX, recipient_burst / recipient_rate + 60)
+        self._lock = threading.Lock()
+
+    def _buckets(self, phone_number_id, mobile):
+        number = self._numbers.get(phone_number_id)
+        if number is None:
+            number = self._numbers[phone_number_id] = TokenBucket(self.number_rate, self.number_burst)
+        recipient = self._recipients.get(mobile)
+        if recipient is None:
+            recipient = TokenBucket(self.recipient_rate, self.recipient_burst)
+        # Re-set on every use so an active recipient's bucket doesn't expire
+        self._recipients.set(mobile, recipient)
+        return number, recipient
+
+    def acquire(self, phone_number_id, mobile, max_wait):
+        """
+        Blocks until a message from `phone_number_id` to `mobile` may be sent.
+
+        Returns:
+        - The seconds waited, or None (without waiting) if that would take longer than `max_wait`
+        """
+        with self._lock:
+            number, recipient = self._buckets(phone_number_id, mobile)
+            now = time.monotonic()
+            delay = max(number.reserve(now), recipient.reserve(now))
+            if delay > max_wait:
+                number.cancel()
+                recipient.cancel()
+                return None
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def back_off(self, phone_number_id, mobile, error_code, seconds):
+        """
+        Holds back sends for `seconds` after a rate-limit error: to the recipient for the pair
+        rate limit, and from the whole phone number otherwise.
+        """
+        with self._lock:
+            number, recipient = self._buckets(phone_number_id, mobile)
+            bucket = recipient if error_code == PAIR_RATE_LIMIT_CODE else number
+            bucket.pause(seconds, time.monotonic())
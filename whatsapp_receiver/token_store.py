@@ -0,0 +1,144 @@
+import base64
+import json
+import os
+import threading
+import time
+
+from aws_clients import get_resource
+from ttl_cache import TTLCache
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Reuse a user's token on later days instead of logging in again (opt-in)
+TOKEN_STORE_ENABLED = os.getenv('TOKEN_STORE_ENABLED', 'false').lower() == 'true'
+# DynamoDB table keyed by `mobile`, holding each user's smart-chat access token and its expiry
+TOKEN_TABLE = os.getenv('TOKEN_TABLE', 'chat_tokens')
+# Lifetime assumed for tokens that don't carry a JWT `exp` claim
+TOKEN_DEFAULT_TTL_SECONDS = int(os.getenv('TOKEN_DEFAULT_TTL_SECONDS', '86400'))
+# Tokens closer than this to expiry are still used, but refreshed in the background
+TOKEN_REFRESH_BEFORE_SECONDS = int(os.getenv('TOKEN_REFRESH_BEFORE_SECONDS', '900'))
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '2048'))
+
+
+def token_expiry(access_token, default_ttl=TOKEN_DEFAULT_TTL_SECONDS):
+    """
+    Returns the expiry (epoch seconds) of `access_token`: its JWT `exp` claim if it has one,
+    otherwise `default_ttl` seconds from now. The signature is not checked.
+    """
+    try:
+        payload = access_token.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return int(exp)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        pass
+    return int(time.time()) + default_ttl
+
+
+def is_expired(expires_at, now=None):
+    return expires_at is not None and int(expires_at) <= (now or time.time())
+
+
+def expires_soon(expires_at, now=None):
+    return expires_at is not None and int(expires_at) - (now or time.time()) < TOKEN_REFRESH_BEFORE_SECONDS
+
+
+class TokenStore:
+    """
+    Keeps each user's smart-chat access token independently of the per-day conversation
+    entries, so a returning user keeps their token across days and only logs in again when
+    it expires or is rejected.
+
+    Reads are served from an in-memory cache whose entries expire with the token.
+    """
+    def __init__(self, table_name=TOKEN_TABLE, cache_size=TOKEN_CACHE_SIZE):
+        self.table_name = table_name
+        self.cache = TTLCache(cache_size, TOKEN_DEFAULT_TTL_SECONDS)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _table(self):
+        return get_resource('dynamodb').Table(self.table_name)
+
+    def _remember(self, mobile, record):
+        ttl = int(record['expires_at']) - time.time()
+        if ttl > 0:
+            self.cache.set(mobile, record, ttl=ttl)
+
+    def get(self, mobile):
+        """
+        Returns the stored token record ({access_token, expires_at, name}) for `mobile`, or None
+        if there is none or it has expired.
+        """
+        record = self.cache.get(mobile)
+        if record is not None:
+            return record
+        try:
+            item = self._table().get_item(Key={'mobile': mobile}).get('Item')
+        except Exception as e:
+            logger.error("Error reading the token of %s: %s", mobile, e)
+            return None
+        if not item or not item.get('access_token') or is_expired(item.get('expires_at')):
+            return None
+        record = {'access_token': item['access_token'], 'expires_at': int(item['expires_at']),
+                  'name': item.get('name')}
+        self._remember(mobile, record)
+        return record
+
+    def put(self, mobile, name, access_token):
+        """
+        Stores a freshly issued token for `mobile`.
+
+        Returns:
+        - The stored record, with its `expires_at`
+        """
+        record = {'access_token': access_token, 'expires_at': token_expiry(access_token), 'name': name}
+        try:
+            self._table().put_item(Item=dict(record, mobile=mobile, updated_at=int(time.time())))
+        except Exception as e:
+            # The token is still usable for this conversation; it just won't be reused tomorrow
+            logger.error("Error storing the token of %s: %s", mobile, e)
+        self._remember(mobile, record)
+        return record
+
+    def invalidate(self, mobile, access_token):
+        """
+        Forgets `access_token` for `mobile` (e.g. after the backend rejected it), unless a newer
+        token has been stored in the meantime.
+        """
+        self.cache.pop(mobile)
+        try:
+            self._table().delete_item(
+                Key={'mobile': mobile},
+                ConditionExpression='access_token = :token',
+                ExpressionAttributeValues={':token': access_token}
+            )
+        except Exception as e:
+            logger.info("Token of %s not invalidated: %s", mobile, e)
+
+    def refresh_async(self, mobile, refresh):
+        """
+        Runs `refresh()` on a background thread, unless a refresh for `mobile` is already running
+        in this container. Like any background work in Lambda it only progresses while an
+        invocation is running.
+        """
+        with self._lock:
+            if mobile in self._refreshing:
+                return
+            self._refreshing.add(mobile)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logger.error("Error refreshing the token of %s: %s", mobile, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(mobile)
+
+        threading.Thread(target=run, name='token-refresh', daemon=True).start()
+
+
+token_store = TokenStore()
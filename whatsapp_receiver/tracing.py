@@ -0,0 +1,135 @@
+"""
+Lightweight per-stage timing, and propagation of the correlation ID and call deadline.
+
+Durations are written to stdout as CloudWatch embedded metric format (EMF) records, which
+CloudWatch Logs turns into metrics without any API calls. This module is kept identical in
+whatsapp_receiver and musafir-interface.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'IttWhatsapp')
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+SERVICE_NAME = os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+# Header carrying the correlation ID to the smart-chat backend
+CORRELATION_HEADER = 'X-Correlation-ID'
+
+_context = threading.local()
+_write_lock = threading.Lock()
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+def set_correlation_id(correlation_id):
+    """
+    Sets the correlation ID for work done on the current thread.
+    """
+    _context.correlation_id = correlation_id
+
+
+def get_correlation_id():
+    return getattr(_context, 'correlation_id', None)
+
+
+def deadline_after(ms):
+    """
+    Returns the deadline `ms` milliseconds from now, on the monotonic clock.
+    """
+    return time.monotonic() + ms / 1000
+
+
+def set_deadline(deadline):
+    """
+    Sets the deadline (from `deadline_after`, or None for no deadline) for work done on the current thread.
+    """
+    _context.deadline = deadline
+
+
+def get_deadline():
+    return getattr(_context, 'deadline', None)
+
+
+def remaining_ms():
+    """
+    Returns the milliseconds left until the current thread's deadline, or None if there is none.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return max(0.0, (deadline - time.monotonic()) * 1000)
+
+
+def emit_metrics(metrics, dimensions=None, properties=None):
+    """
+    Writes one EMF record.
+
+    Parameters:
+    - metrics: A dict of metric name -> (value, unit)
+    - dimensions: A dict of dimension name -> value; `Service` is always added
+    - properties: Extra fields stored with the record but not turned into metrics
+    """
+    if not METRICS_ENABLED:
+        return
+    dimensions = dict(dimensions or {}, Service=SERVICE_NAME)
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+            }]
+        }
+    }
+    record.update(dimensions)
+    record.update({name: value for name, (value, _) in metrics.items()})
+    correlation_id = get_correlation_id()
+    if correlation_id:
+        record['correlation_id'] = correlation_id
+    if properties:
+        record.update(properties)
+    line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+    with _write_lock:
+        sys.stdout.write(line)
+
+
+@contextmanager
+def span(stage, **properties):
+    """
+    Times the enclosed block and emits its duration as the `Duration` metric for `stage`.
+    The `Error` property is set if the block raised.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        if error:
+            properties['Error'] = error
+        emit_metrics({'Duration': (round(duration_ms, 3), 'Milliseconds')}, {'Stage': stage}, properties)
+
+
+def traced(stage):
+    """
+    Decorator form of `span`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,150 @@
+import importlib.util
+import json
+import os
+import sys
+import threading
+
+from log_util import get_logger
+from tracing import get_deadline, set_deadline
+
+logger = get_logger(__name__)
+
+# 'lambda' invokes the musafir-interface Lambda, 'inprocess' calls its dispatcher directly
+MUSAFIR_TRANSPORT = os.getenv('MUSAFIR_TRANSPORT', 'lambda')
+MUSAFIR_FUNCTION_NAME = os.getenv('MUSAFIR_FUNCTION_NAME', 'musafir-interface')
+
+# Where musafir-interface's sources live when both are packaged together
+_HERE = os.path.dirname(os.path.abspath(__file__))
+MUSAFIR_INTERFACE_PATHS = [p for p in (
+    os.getenv('MUSAFIR_INTERFACE_PATH'),
+    os.path.join(_HERE, 'musafir-interface'),
+    os.path.join(os.path.dirname(_HERE), 'musafir-interface')
+) if p]
+
+
+class InvokeResult:
+    """
+    The structured outcome of a musafir-interface call.
+
+    Attributes:
+    - success: True if the method call succeeded
+    - status_code: The status code reported by musafir-interface
+    - data: The method's response data (e.g. `accessToken` or `content`), or {} on failure
+    - message: A description of the failure, if any
+    """
+    __slots__ = ('success', 'status_code', 'data', 'message')
+
+    def __init__(self, success, status_code, data=None, message=''):
+        self.success = success
+        self.status_code = status_code
+        self.data = data or {}
+        self.message = message
+
+    @classmethod
+    def from_response(cls, status_code, body):
+        """
+        Builds a result from musafir-interface's status code and (decoded) response body.
+        """
+        body = body or {}
+        success = status_code == 200 and body.get('success', False)
+        return cls(success, status_code, body.get('data'), body.get('message', ''))
+
+    @classmethod
+    def failure(cls, message, status_code=500):
+        return cls(False, status_code, message=message)
+
+    def __repr__(self):
+        return f"InvokeResult(success={self.success}, status_code={self.status_code}, message={self.message!r})"
+
+
+class LambdaInvokeTransport:
+    """
+    Calls musafir-interface through a synchronous Lambda invoke.
+    """
+    name = 'lambda'
+
+    def __init__(self, function_name, invoke):
+        self.function_name = function_name
+        self._invoke = invoke
+
+    def call(self, payload):
+        response = self._invoke(self.function_name, payload)
+        if 'statusCode' not in response:
+            # Either the invoke itself failed or the function raised
+            return InvokeResult.failure(response.get('message') or response.get('errorMessage', 'Invoke failed'))
+        try:
+            body = json.loads(response.get('body') or '{}')
+        except ValueError as e:
+            return InvokeResult.failure(f"Invalid response body: {str(e)}")
+        return InvokeResult.from_response(response['statusCode'], body)
+
+
+class InProcessTransport:
+    """
+    Calls musafir-interface's dispatcher directly in this process, skipping the invoke
+    and the JSON encoding of the response body.
+    """
+    name = 'inprocess'
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+
+    def call(self, payload):
+        # The dispatcher sets the thread's deadline from the payload (already shortened by the
+        # reply reserve); the caller's own deadline must survive the call
+        deadline = get_deadline()
+        try:
+            response = self._dispatch(payload)
+        except Exception as e:
+            logger.exception("Error calling musafir-interface in process: %s", e)
+            return InvokeResult.failure(f"Error calling musafir-interface: {str(e)}")
+        finally:
+            set_deadline(deadline)
+        return InvokeResult.from_response(response['statusCode'], response['body'])
+
+
+def load_musafir_dispatcher():
+    """
+    Imports musafir-interface's `lambda_function` under a separate module name (the receiver
+    has its own `lambda_function`) and returns its `dispatch` function.
+    """
+    for path in MUSAFIR_INTERFACE_PATHS:
+        source = os.path.join(path, 'lambda_function.py')
+        if os.path.isfile(source):
+            break
+    else:
+        raise ImportError(f"musafir-interface not found in: {', '.join(MUSAFIR_INTERFACE_PATHS)}")
+
+    # Its own imports (api_client, ...) are resolved from its directory
+    if path not in sys.path:
+        sys.path.append(path)
+    spec = importlib.util.spec_from_file_location('musafir_interface', source)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['musafir_interface'] = module
+    spec.loader.exec_module(module)
+    return module.dispatch
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport(invoke):
+    """
+    Returns the transport selected by MUSAFIR_TRANSPORT, created once per container.
+
+    Parameters:
+    - invoke: The function used to invoke a Lambda in 'lambda' mode, called as invoke(function_name, payload)
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                if MUSAFIR_TRANSPORT == 'inprocess':
+                    _transport = InProcessTransport(load_musafir_dispatcher())
+                elif MUSAFIR_TRANSPORT == 'lambda':
+                    _transport = LambdaInvokeTransport(MUSAFIR_FUNCTION_NAME, invoke)
+                else:
+                    raise ValueError(f"Unknown MUSAFIR_TRANSPORT: {MUSAFIR_TRANSPORT}")
+                logger.info("Using '%s' transport for musafir-interface.", _transport.name)
+    return _transport
@@ -0,0 +1,195 @@
+"""
+Coalesces a user's rapid consecutive messages into one chat turn.
+
+Users often split one thought across several quick messages ('hi', 'want trip', 'to manali').
+Every message is appended to the user's pending turn in a store shared by all containers,
+which hands out a sequence number. The message's handler then waits for the coalescing
+window: if a newer message arrived meanwhile, that one will answer for both and this handler
+stops; otherwise it takes the pending messages and sends them as a single turn.
+"""
+import os
+import threading
+import time
+
+from aws_clients import error_code, get_resource
+from tracing import emit_metrics, remaining_ms
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# How long a message waits for follow-ups before it is sent (0 disables coalescing)
+COALESCE_WINDOW_MS = int(os.getenv('COALESCE_WINDOW_MS', '0'))
+# A turn is sent without waiting once it holds this many messages
+COALESCE_MAX_MESSAGES = int(os.getenv('COALESCE_MAX_MESSAGES', '5'))
+# 'dynamodb' shares pending turns between containers; 'local' keeps them in this container
+COALESCE_STORE = os.getenv('COALESCE_STORE', 'dynamodb')
+# DynamoDB table keyed by `mobile`, with TTL enabled on `expires_at`
+COALESCE_TABLE = os.getenv('COALESCE_TABLE', 'pending_turns')
+# Pending messages whose handler died are dropped after this long
+COALESCE_TTL_SECONDS = int(os.getenv('COALESCE_TTL_SECONDS', '300'))
+COALESCE_SEPARATOR = '\n'
+
+
+class LocalTurnStore:
+    """
+    Pending turns in memory, for local runs and single-container deployments.
+    """
+    def __init__(self, ttl=COALESCE_TTL_SECONDS):
+        self.ttl = ttl
+        self._turns = {}
+        self._lock = threading.Lock()
+
+    def append(self, mobile, text):
+        """
+        Adds `text` to the pending turn of `mobile`.
+
+        Returns:
+        - (seq, count): the message's sequence number and how many messages the turn now holds
+        """
+        now = time.monotonic()
+        with self._lock:
+            turn = self._turns.setdefault(mobile, {'seq': 0, 'messages': [], 'expires_at': 0})
+            if turn['expires_at'] < now:
+                turn['messages'] = []
+            turn['seq'] += 1
+            turn['messages'].append(text)
+            turn['expires_at'] = now + self.ttl
+            return turn['seq'], len(turn['messages'])
+
+    def latest(self, mobile):
+        """
+        Returns the sequence number of the newest message of `mobile`.
+        """
+        with self._lock:
+            turn = self._turns.get(mobile)
+            return turn['seq'] if turn else None
+
+    def take(self, mobile, seq):
+        """
+        Removes and returns the pending messages if `seq` is still the newest, otherwise None.
+        """
+        with self._lock:
+            turn = self._turns.get(mobile)
+            if turn is None or turn['seq'] != seq or not turn['messages']:
+                return None
+            messages, turn['messages'] = turn['messages'], []
+            return messages
+
+
+class DynamoTurnStore:
+    """
+    Pending turns in a DynamoDB table, one item per user. The sequence number only ever grows,
+    so a handler can always tell whether a newer message arrived after its own.
+    """
+    def __init__(self, table_name=COALESCE_TABLE, ttl=COALESCE_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl = ttl
+
+    def _table(self):
+        return get_resource('dynamodb').Table(self.table_name)
+
+    def append(self, mobile, text):
+        # TTL deletes expired items lazily, so an expired turn may still be there; its messages
+        # are replaced rather than appended to. Each update only applies if the item is (still)
+        # fresh or expired, so concurrent appends never overwrite one another.
+        now = int(time.time())
+        values = {':text': [text], ':one': 1, ':now': now, ':expires_at': now + self.ttl}
+        updates = [
+            ('SET messages = list_append(if_not_exists(messages, :empty), :text), seq = seq + :one, '
+             'expires_at = :expires_at', 'expires_at >= :now', dict(values, **{':empty': []})),
+            ('SET messages = :text, seq = if_not_exists(seq, :zero) + :one, expires_at = :expires_at',
+             'attribute_not_exists(expires_at) OR expires_at < :now', dict(values, **{':zero': 0})),
+        ]
+        for _ in range(3):
+            for expression, condition, expression_values in updates:
+                try:
+                    response = self._table().update_item(
+                        Key={'mobile': mobile},
+                        UpdateExpression=expression,
+                        ConditionExpression=condition,
+                        ExpressionAttributeValues=expression_values,
+                        ReturnValues='ALL_NEW'
+                    )
+                except Exception as e:
+                    if error_code(e) == 'ConditionalCheckFailedException':
+                        continue
+                    raise
+                item = response['Attributes']
+                return int(item['seq']), len(item['messages'])
+        raise RuntimeError('Pending turn of {} kept changing while appending'.format(mobile))
+
+    def latest(self, mobile):
+        item = self._table().get_item(Key={'mobile': mobile}, ConsistentRead=True,
+                                      ProjectionExpression='seq').get('Item')
+        return int(item['seq']) if item else None
+
+    def take(self, mobile, seq):
+        try:
+            response = self._table().update_item(
+                Key={'mobile': mobile},
+                UpdateExpression='REMOVE messages',
+                ConditionExpression='seq = :seq AND attribute_exists(messages)',
+                ExpressionAttributeValues={':seq': seq},
+                ReturnValues='ALL_OLD'
+            )
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return None
+            raise
+        return response['Attributes']['messages']
+
+
+class TurnCoalescer:
+    """
+    Merges the messages a user sends within `window_ms` of each other into one turn.
+    Store errors fail open: the message is then sent on its own.
+    """
+    def __init__(self, store, window_ms=COALESCE_WINDOW_MS, max_messages=COALESCE_MAX_MESSAGES):
+        self.store = store
+        self.window_ms = window_ms
+        self.max_messages = max_messages
+
+    def _window(self):
+        # Never spend more than half of what is left of the request's deadline waiting
+        remaining = remaining_ms()
+        return self.window_ms if remaining is None else min(self.window_ms, remaining / 2)
+
+    def coalesce(self, mobile, text, wait=True):
+        """
+        Adds `text` to the user's pending turn and decides who sends it.
+
+        Parameters:
+        - wait: False when a later message of the same user is already known to follow;
+          `text` is then left for that message to send
+
+        Returns:
+        - The merged text to send, or None if a newer message will send it
+        """
+        try:
+            seq, count = self.store.append(mobile, text)
+        except Exception as e:
+            logger.error("Error adding to the pending turn of %s, sending the message alone: %s", mobile, e)
+            return text
+        if not wait:
+            return None
+
+        try:
+            if count < self.max_messages:
+                time.sleep(self._window() / 1000)
+                latest = self.store.latest(mobile)
+                if latest is not None and latest > seq:
+                    logger.debug("A newer message of %s will send the turn", mobile)
+                    return None
+            messages = self.store.take(mobile, seq)
+        except Exception as e:
+            logger.error("Error taking the pending turn of %s, sending the message alone: %s", mobile, e)
+            return text
+        if messages is None:
+            # A newer message arrived while the turn was being taken
+            return None
+        if len(messages) > 1:
+            emit_metrics({'CoalescedMessages': (len(messages), 'Count')}, {'Stage': 'coalesce'})
+        return COALESCE_SEPARATOR.join(messages)
+
+
+turn_coalescer = TurnCoalescer(LocalTurnStore() if COALESCE_STORE == 'local' else DynamoTurnStore())
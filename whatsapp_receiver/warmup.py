@@ -0,0 +1,55 @@
+"""
+Recognizes warm-up pings and runs the warm-up steps of a Lambda with per-step timings.
+
+A warm-up event is `{"warmup": true}` (or `{"method": "warmup"}`), or an EventBridge
+scheduled event. This module is kept identical in whatsapp_receiver and musafir-interface.
+"""
+import time
+
+from tracing import span
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+
+def is_warmup_event(event):
+    if not isinstance(event, dict):
+        return False
+    return bool(event.get('warmup')) or event.get('method') == 'warmup' or \
+        (event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event')
+
+
+def run_warmup(steps):
+    """
+    Runs the warm-up steps in order and times each one. A failing step is reported and
+    does not stop the steps after it.
+
+    Parameters:
+    - steps: A list of (name, func) pairs; whatever `func` returns is added to the report
+
+    Returns:
+    - A dict with `ok`, `total_ms` and the list of `steps` with their `ms`, `ok` and `result` or `error`
+    """
+    report = {'ok': True, 'steps': []}
+    started = time.perf_counter()
+    for name, func in steps:
+        step = {'step': name}
+        t0 = time.perf_counter()
+        try:
+            with span('warmup.' + name):
+                result = func()
+            # A nested report (e.g. from musafir-interface) carries its own `ok`
+            step['ok'] = not (isinstance(result, dict) and result.get('ok') is False)
+            report['ok'] = report['ok'] and step['ok']
+            if result is not None:
+                step['result'] = result
+        except Exception as e:
+            logger.warning('Warm-up step %s failed: %s', name, e)
+            step['ok'] = False
+            step['error'] = '{}: {}'.format(type(e).__name__, e)
+            report['ok'] = False
+        step['ms'] = round((time.perf_counter() - t0) * 1000, 3)
+        report['steps'].append(step)
+    report['total_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    logger.info('Warm-up finished in %sms', report['total_ms'])
+    return report
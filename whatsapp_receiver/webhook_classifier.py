@@ -0,0 +1,87 @@
+"""
+Classifies webhook bodies before they are parsed.
+
+Most webhooks Meta sends are delivery/read `statuses` callbacks and other changes that carry
+no user message. Those are recognised by scanning the raw body for a "messages" key and are
+acknowledged without `json.loads`; only bodies that may hold messages are parsed and walked.
+"""
+import os
+import re
+import threading
+import time
+
+from tracing import emit_metrics
+from log_util import get_logger
+
+logger = get_logger(__name__)
+
+# Count status callbacks into a batched metric instead of logging them
+STATUS_COUNTER_ENABLED = os.getenv('STATUS_COUNTER_ENABLED', 'true').lower() == 'true'
+# Least time between two StatusCallbacks metric records from one container
+STATUS_FLUSH_SECONDS = float(os.getenv('STATUS_FLUSH_SECONDS', '60'))
+
+# A "messages" key holding a list. Every change also carries "field": "messages", so the bare
+# word says nothing; a false positive (the pattern inside some text) only costs a full parse.
+_MESSAGES_RE = re.compile(r'"messages"\s*:\s*\[')
+_STATUS_RE = re.compile(r'"status"\s*:\s*"(\w+)"')
+
+
+def may_have_messages(raw_body):
+    """
+    Returns whether the raw webhook body may carry user messages and needs a full parse.
+    """
+    return _MESSAGES_RE.search(raw_body) is not None
+
+
+def iter_messages(body):
+    """
+    Yields (message, contact name) for every message in every entry and change of a parsed
+    webhook body. Names are looked up by the sender's wa_id within the same change.
+    """
+    for entry in body.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            messages = value.get('messages')
+            if not messages:
+                continue
+            names = {contact.get('wa_id'): contact.get('profile', {}).get('name')
+                     for contact in value.get('contacts') or []}
+            for message in messages:
+                yield message, names.get(message.get('from'))
+
+
+class StatusCounter:
+    """
+    Counts status callbacks by status (sent, delivered, read, failed) and writes them as one
+    EMF record at most every `flush_seconds`, rather than a log line per callback.
+    """
+    def __init__(self, flush_seconds=STATUS_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.counts = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, raw_body):
+        """
+        Counts the statuses in a raw webhook body, without parsing it.
+        """
+        statuses = _STATUS_RE.findall(raw_body) or ['other']
+        with self._lock:
+            for status in statuses:
+                self.counts[status] = self.counts.get(status, 0) + 1
+
+    def flush(self, force=False):
+        """
+        Emits and resets the counts if `flush_seconds` have passed since the last flush (or `force`).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not self.counts or (not force and now - self._flushed_at < self.flush_seconds):
+                return
+            counts, self.counts = self.counts, {}
+            self._flushed_at = now
+        emit_metrics({'StatusCallbacks': (sum(counts.values()), 'Count')}, {'Stage': 'webhook'},
+                     {'statuses': counts})
+
+
+status_counter = StatusCounter()